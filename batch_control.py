@@ -0,0 +1,48 @@
+import moderngl
+
+from camera_poses import load_poses
+from gen_control import GenerationQueue
+from orbit_control import OrbitScheduler
+from pointcloud import SDPointCloud
+
+
+def create_context(backend: str = None) -> moderngl.Context:
+    """Create a standalone context without a window.
+    The "egl" backend renders without a display, e.g. on render servers."""
+    settings = {"backend": backend} if backend else {}
+    return moderngl.create_standalone_context(require=330, **settings)
+
+
+def retexture_batch(
+    sd_pcd: SDPointCloud,
+    ctx: moderngl.Context,
+    poses_file: str,
+    prompt: str,
+    webui_api: str,
+    width: int,
+    height: int,
+    batch_size: int = 1,
+    debug: bool = False,
+) -> None:
+    """Capture and retexture the views of a poses file in groups of batch_size views,
+    pipelined like the orbit of the viewer."""
+    mvps = load_poses(poses_file, aspect_ratio=width / height)
+    generation_queue = GenerationQueue(webui_api, debug=debug)
+    scheduler = OrbitScheduler(
+        sd_pcd,
+        generation_queue,
+        prompt,
+        width,
+        height,
+        batch_size=batch_size,
+        debug=debug,
+    )
+
+    scheduler.start_views(mvps)
+    try:
+        while not scheduler.done:
+            scheduler.step(ctx)
+            # nothing to render in between, wait for the running generation
+            generation_queue.poll(timeout=0.1)
+    finally:
+        generation_queue.shutdown()
@@ -0,0 +1,327 @@
+import json
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import fire
+import laspy
+import numpy as np
+from pyrr import Matrix44
+
+import depth_utils
+import pcd_io
+import point_cloud_rendering_utils as pcru
+from batch_control import create_context
+from camera_poses import FAR, FOV, NEAR, orbit_poses
+from gen_control import capture_params
+from gpu_resources import GPUResources
+from pointcloud import SDPointCloud, normalize
+from screen_capture import create_screen_capture
+from webui_api import ImageCodec, WebUIClient, build_payload
+
+SIZES = (100_000, 1_000_000, 10_000_000, 100_000_000)
+# points generated and written at once, bounds the memory of the synthetic clouds
+CHUNK_SIZE = 2**20
+# camera of the captures, looking down onto the synthetic terrain
+EYE = (0.0, 1.2, 2.0)
+
+
+def synthetic_cloud(n_points: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Return float32 points and colors in [0, 1] of a noisy terrain of 100m x 100m.
+    Chunks are seeded by their position, the cloud only depends on n_points and seed.
+    """
+    points = np.empty((n_points, 3), dtype=np.float32)
+    colors = np.empty((n_points, 3), dtype=np.float32)
+    for start in range(0, n_points, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, n_points)
+        rng = np.random.default_rng([seed, start])
+        x, z = rng.random((2, stop - start)) * 100
+        y = 5 * np.sin(x / 8) * np.cos(z / 11) + rng.normal(0, 0.05, stop - start)
+        points[start:stop] = np.stack((x, y, z), axis=1)
+        height = (y[:, None] + 5) / 10
+        colors[start:stop] = np.clip(
+            height * [0.4, 0.7, 0.3] + rng.random((stop - start, 3)) * 0.2, 0, 1
+        )
+    return points, colors
+
+
+def write_las(filename: str, points: np.ndarray, colors: np.ndarray) -> None:
+    """Write points in meters and colors in [0, 1] chunk by chunk to a .las file."""
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = np.array([0.001, 0.001, 0.001])
+    header.offsets = points.min(axis=0).astype(np.float64)
+    with laspy.open(filename, mode="w", header=header) as writer:
+        for start in range(0, len(points), CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            record = laspy.ScaleAwarePointRecord.zeros(
+                len(points[chunk]), header=header
+            )
+            record.x, record.y, record.z = points[chunk].T
+            rgb = np.round(colors[chunk] * (2**16 - 1)).astype(np.uint16)
+            record.red, record.green, record.blue = rgb.T
+            writer.write_points(record)
+
+
+class StandInWebUI:
+    """Local HTTP server answering the img2img and txt2img endpoints of the WebUI
+    with the init image after a fixed latency, to measure encoding and transfer."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        latency_ = latency
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                time.sleep(latency_)
+                images = payload.get("init_images", [])[: payload.get("batch_size", 1)]
+                body = json.dumps({"images": images}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Benchmark:
+    """Times the stages of the pipeline and collects the results."""
+
+    def __init__(self, repeat: int) -> None:
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, stage: str, n_points: int, function, setup=None, repeat=None):
+        """Time function, setup runs untimed before every repetition.
+        Return the result of the last run."""
+        timings = []
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - start)
+        self.results.append(
+            {
+                "stage": stage,
+                "points": n_points,
+                "seconds": timings,
+                "best": min(timings),
+                "median": float(np.median(timings)),
+            }
+        )
+        print(f"{n_points:>11,} {stage:<28} {min(timings) * 1000:10.2f} ms")
+        return result
+
+
+def run_size(
+    bench: Benchmark, ctx, n_points: int, width: int, height: int, tmp_dir: Path
+) -> None:
+    points, colors = synthetic_cloud(n_points)
+    las_file = str(tmp_dir / f"cloud_{n_points}.las")
+    write_las(las_file, points, colors)
+    del points, colors
+
+    # parsing is slow and deterministic, large clouds are only read once
+    repeat = 1 if n_points >= 10_000_000 else None
+    bench.time(
+        "extract_las", n_points, lambda: pcd_io.extract_las(las_file), None, repeat
+    )
+
+    def clear_cache():
+        for file in pcd_io.CACHE_DIR.glob("*"):
+            file.unlink()
+
+    bench.time(
+        "read_pcd (cache miss)",
+        n_points,
+        lambda: pcd_io.read_pcd(las_file),
+        clear_cache,
+        repeat,
+    )
+    pcd = bench.time(
+        "read_pcd (cache hit)", n_points, lambda: pcd_io.read_pcd(las_file)
+    )
+    raw_points = np.array(pcd._points)
+    bench.time("normalize", n_points, lambda: normalize(raw_points), None, repeat)
+    del raw_points
+
+    resources = GPUResources.of(ctx)
+
+    def upload():
+        resources.point_buffers(pcd)
+        ctx.finish()
+
+    bench.time(
+        "vbo upload", n_points, upload, lambda: resources.release_point_cloud(pcd)
+    )
+    bench.time(
+        "octree", n_points, lambda: pcd.octree, lambda: setattr(pcd, "_octree", None)
+    )
+
+    projection = Matrix44.perspective_projection(FOV, width / height, NEAR, FAR)
+    mvp = projection * orbit_poses(EYE, 1)[0]
+    params = (ctx, pcd, mvp, width, height)
+    # warm up shaders, vertex arrays and framebuffers
+    pcru.capture_pointcloud(*params)
+    bench.time("render_pointcloud", n_points, lambda: pcru.render_pointcloud(*params))
+    bench.time("obtain_point_ids", n_points, lambda: pcru.obtain_point_ids(*params))
+    bench.time("create_depth_image", n_points, lambda: pcru.create_depth_image(*params))
+    bench.time(
+        "capture_pointcloud (no cull)",
+        n_points,
+        lambda: pcru.capture_pointcloud(*params, cull=False),
+    )
+    _, raw_ids, depth_buffer = bench.time(
+        "capture_pointcloud", n_points, lambda: pcru.capture_pointcloud(*params)
+    )
+
+    buffer = depth_buffer.copy()
+    bench.time(
+        "fill_zero_pixels",
+        n_points,
+        lambda: depth_utils.fill_zero_pixels(buffer),
+        lambda: np.copyto(buffer, depth_buffer),
+    )
+    depth_image = depth_utils.create_depth_image(depth_buffer, filter=False)
+    depth_filtered = bench.time(
+        "create_depth_map (cpu)",
+        n_points,
+        lambda: depth_utils.create_depth_image(depth_buffer, filter=True),
+    )
+    bench.time(
+        "filter_ids",
+        n_points,
+        lambda: depth_utils.filter_ids(raw_ids, depth_filtered, depth_image),
+    )
+
+    bench.time(
+        "create_depth_maps (gpu)",
+        n_points,
+        lambda: pcru.create_depth_maps(ctx, depth_buffer),
+    )
+
+    def capture_maps():
+        *arrays, _ = pcru.capture_maps(*params)
+        for array in arrays:
+            resources.release_host_array(array)
+
+    bench.time("capture_maps", n_points, capture_maps)
+
+    bench.time(
+        "project_points",
+        n_points,
+        lambda: pcru.project_points(ctx, pcd, mvp, depth_buffer),
+    )
+
+    capture = create_screen_capture(*params)
+    sd_pcd = SDPointCloud(pcd)
+    bench.time(
+        "retexture",
+        n_points,
+        lambda: sd_pcd.retexture(capture.color_image, capture.ids, capture.projected),
+        sd_pcd.reset,
+    )
+    mask = bench.time(
+        "mask_retextured", n_points, lambda: sd_pcd.mask_retextured(capture.ids)
+    )
+
+    payload_params = capture_params(capture, "benchmark", mask)
+    server = StandInWebUI()
+    client = WebUIClient(server.url)
+    for codec in (ImageCodec(), ImageCodec("WEBP", 0)):
+        name = f"{codec.format.lower()} {codec.compress_level}"
+        payload = bench.time(
+            f"build_payload ({name})",
+            n_points,
+            lambda: build_payload(payload_params, codec),
+        )
+        bench.time(
+            f"img2img round trip ({name})", n_points, lambda: client.img2img(payload)
+        )
+    client.close()
+    server.close()
+    resources.release_point_cloud(pcd)
+
+
+def _metadata(ctx) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "gl_renderer": ctx.info["GL_RENDERER"],
+    }
+
+
+def main(
+    sizes: tuple = SIZES,
+    output: str = "benchmark_results.json",
+    width: int = 512,
+    height: int = 512,
+    repeat: int = 3,
+    backend: str = None,
+):
+    """Benchmark the stages of the pipeline on synthetic point clouds.
+
+    Args:
+        sizes: The numbers of points of the synthetic clouds.
+        output: The JSON file the results are written to.
+        width: The width of the captures.
+        height: The height of the captures.
+        repeat: The number of timed runs per stage, the best and median are reported.
+        backend: The backend of the OpenGL context, "egl" to run without a display.
+    """
+    sizes = (sizes,) if isinstance(sizes, int) else sizes
+    ctx = create_context(backend)
+    bench = Benchmark(repeat)
+    cache_dir = pcd_io.CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the user's cache is left untouched
+        pcd_io.CACHE_DIR = Path(tmp_dir) / "cache"
+        pcd_io.CACHE_DIR.mkdir()
+        try:
+            for n_points in sizes:
+                run_size(bench, ctx, int(n_points), width, height, Path(tmp_dir))
+        finally:
+            pcd_io.CACHE_DIR = cache_dir
+    results = {
+        "metadata": _metadata(ctx),
+        "width": width,
+        "height": height,
+        "results": bench.results,
+    }
+    Path(output).write_text(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
+    GPUResources.of(ctx).release()
+    ctx.release()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,108 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from pyrr import Matrix44
+
+# same projection as the viewer's camera
+FOV = 60.0
+NEAR = 0.01
+FAR = 10.0
+
+
+def orbit_eyes(
+    eye: np.ndarray, views: int, target=(0.0, 0.0, 0.0), up=(0.0, 1.0, 0.0)
+) -> np.ndarray:
+    """Return (views, 3) camera positions evenly spaced on the circle of eye around
+    the up axis through target, starting at eye."""
+    eye, target, up = (np.asarray(v, dtype=np.float64) for v in (eye, target, up))
+    axis = up / np.linalg.norm(up)
+    offset = eye - target
+    angles = np.arange(views) * 2 * np.pi / views
+    cos, sin = np.cos(angles)[:, None], np.sin(angles)[:, None]
+    # Rodrigues' rotation of the offset around the axis
+    rotated = (
+        offset * cos + np.cross(axis, offset) * sin + axis * (axis @ offset) * (1 - cos)
+    )
+    return target + rotated
+
+
+def orbit_poses(
+    eye: np.ndarray, views: int, target=(0.0, 0.0, 0.0), up=(0.0, 1.0, 0.0)
+) -> list[Matrix44]:
+    """Return the view matrices of the orbit_eyes cameras, all looking at target."""
+    return [
+        Matrix44.look_at(position, target, up, dtype="f4")
+        for position in orbit_eyes(eye, views, target, up)
+    ]
+
+
+def load_poses(filename: str, aspect_ratio: float = 1.0) -> list[Matrix44]:
+    """Read the MVP matrices of camera poses from a file.
+
+    .npy files hold (n, 4, 4) MVP matrices as written to the shaders, i.e.
+    clip = [point, 1] @ mvp. .json files hold a list of poses, either
+    {"mvp": 4x4} or {"eye": [x, y, z]} with the optional keys "target", "up",
+    "fov", "near" and "far". A pose with "views" expands to an orbit of that many
+    poses through eye around the up axis through target."""
+    path = Path(filename)
+    if path.suffix == ".npy":
+        return [Matrix44(mvp, dtype="f4") for mvp in np.load(path)]
+    if path.suffix != ".json":
+        raise ValueError("Only .npy and .json pose files are supported.")
+
+    mvps = []
+    for pose in json.loads(path.read_text()):
+        if "mvp" in pose:
+            mvps.append(Matrix44(pose["mvp"], dtype="f4"))
+            continue
+        projection = Matrix44.perspective_projection(
+            pose.get("fov", FOV),
+            aspect_ratio,
+            pose.get("near", NEAR),
+            pose.get("far", FAR),
+            dtype="f4",
+        )
+        target = pose.get("target", (0.0, 0.0, 0.0))
+        up = pose.get("up", (0.0, 1.0, 0.0))
+        views = orbit_poses(pose["eye"], pose.get("views", 1), target, up)
+        mvps.extend(projection * view for view in views)
+    return mvps
+
+
+def test_orbit_poses():
+    eye = np.array([0.0, 0.5, 2.0])
+    eyes = orbit_eyes(eye, 4)
+    assert np.allclose(eyes[0], eye)
+    assert np.allclose(eyes[1], [2.0, 0.5, 0.0])
+    assert np.allclose(eyes[2], [0.0, 0.5, -2.0])
+    for position, view in zip(eyes, orbit_poses(eye, 4)):
+        # the target is straight ahead of every camera, the camera looks along -z
+        target = np.append(np.zeros(3), 1.0) @ np.asarray(view)
+        assert np.allclose(target[:2], 0.0, atol=1e-6)
+        assert np.isclose(-target[2], np.linalg.norm(position), atol=1e-5)
+    print("Orbit poses look at the target.")
+
+
+def test_load_poses():
+    import tempfile
+
+    projection = Matrix44.perspective_projection(FOV, 1.0, NEAR, FAR, dtype="f4")
+    expected = [projection * view for view in orbit_poses([0.0, 0.5, 2.0], 3)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = Path(tmp_dir) / "poses.json"
+        json_file.write_text(
+            json.dumps(
+                [{"eye": [0.0, 0.5, 2.0], "views": 3}, {"mvp": np.eye(4).tolist()}]
+            )
+        )
+        npy_file = Path(tmp_dir) / "poses.npy"
+        np.save(npy_file, np.array(expected))
+        assert np.allclose(load_poses(json_file), expected + [np.eye(4)], atol=1e-6)
+        assert np.allclose(load_poses(npy_file), expected)
+    print("Poses are loaded from .json and .npy files.")
+
+
+if __name__ == "__main__":
+    test_orbit_poses()
+    test_load_poses()
@@ -1,13 +1,30 @@
+from functools import partial
+
 import numpy as np
 from PIL import Image
-from scipy.ndimage import gaussian_filter, median_filter
+from scipy.ndimage import gaussian_filter, median_filter, uniform_filter
 
+import tracing
 from pointcloud import PointCloud
 
+# rounds of hole filling, holes up to this many radii away from a point are filled
+FILL_ITERATIONS = 8
+
 
-def create_depth_image(buffer: np.ndarray, filter: bool = False):
+def create_depth_image(
+    buffer: np.ndarray, filter: bool = False, fill_radius: int = 1
+) -> Image:
     """Converts a depth buffer to a 8-bit depth image, with min and max depth as range.
-    Optionally applies a suite of heuristic filters."""
+    Optionally applies a suite of heuristic filters, holes are filled from neighbors
+    within fill_radius pixels."""
+    return Image.fromarray(create_depth_map(buffer, filter, fill_radius), mode="L")
+
+
+@tracing.traced
+def create_depth_map(
+    buffer: np.ndarray, filter: bool = False, fill_radius: int = 1
+) -> np.ndarray:
+    """Like create_depth_image, but return the 8-bit depth map as array."""
     depth_buffer = buffer.copy()
     bits_per_pixel = 8
     res_per_pixel = 2**bits_per_pixel - 1
@@ -15,34 +32,43 @@ def create_depth_image(buffer: np.ndarray, filter: bool = False):
     max_depth = np.max(depth_buffer[depth_buffer < 1.0])
     depth_step = (max_depth - min_depth) / res_per_pixel
     if filter:
-        fill_zero_pixels(depth_buffer)
+        fill_zero_pixels(depth_buffer, fill_radius)
         depth_buffer = median_filter(depth_buffer, size=3)
         depth_buffer = gaussian_filter(depth_buffer, sigma=1)
 
     depth_buffer[depth_buffer == 1.0] = max_depth
-    depth_buffer = np.round((depth_buffer - min_depth) / depth_step, 0).astype(np.uint8)
+    depth_buffer = np.round((depth_buffer - min_depth) / depth_step, 0)
+    # filtered holes may lie slightly beyond the range, don't wrap around
+    depth_buffer = np.clip(depth_buffer, 0, res_per_pixel).astype(np.uint8)
     depth_buffer = res_per_pixel - depth_buffer
-    depth_image = Image.fromarray(depth_buffer, mode="L")
-    return depth_image
-
-
-def fill_zero_pixels(depth_buffer: np.ndarray):
-    """Fills zero pixels with the average of their non zero neighbors."""
-    rows, cols = depth_buffer.shape
-    kernel_size = 3
-    kernel_radius = kernel_size // 2
-    for i in range(rows):
-        for j in range(cols):
-            if depth_buffer[i, j] == 1.0:
-                neighborhood = depth_buffer[
-                    max(i - kernel_radius, 0) : min(i + kernel_radius + 1, rows),
-                    max(j - kernel_radius, 0) : min(j + kernel_radius + 1, cols),
-                ]
-                neighborhood = neighborhood[neighborhood < 1.0]
-                if neighborhood.size > 0:
-                    depth_buffer[i, j] = np.mean(neighborhood)
+    return depth_buffer
+
+
+@tracing.traced
+def fill_zero_pixels(
+    depth_buffer: np.ndarray, kernel_radius: int = 1, iterations: int = FILL_ITERATIONS
+):
+    """Fills zero pixels with the average of their non zero neighbors. Holes without
+    non zero neighbors take the average of the holes filled in the rounds before,
+    for up to iterations rounds. The cost of a round is independent of the radius."""
+    holes = depth_buffer == 1.0
+    kernel_size = 2 * kernel_radius + 1
+    # ratio of the box filtered depths and valid pixels is the mean of the valid neighbors
+    box_filter = partial(
+        uniform_filter, size=kernel_size, output=np.float64, mode="constant"
+    )
+    for _ in range(iterations):
+        depth_sum = box_filter(np.where(holes, 0.0, depth_buffer))
+        valid_count = box_filter(~holes)
+        # running sums leave rounding residue instead of exact zeros
+        filled = holes & (valid_count * kernel_size**2 > 0.5)
+        if not filled.any():
+            break
+        depth_buffer[filled] = depth_sum[filled] / valid_count[filled]
+        holes &= ~filled
 
 
+@tracing.traced
 def filter_ids(
     ids: np.ndarray,
     depth_filtered: Image,
@@ -52,28 +78,51 @@ def filter_ids(
 ) -> tuple[np.ndarray, np.ndarray]:
     """Given a 2D array of ids, a depth image, and a depth image without filtering,
     filter out ids that deviate too much from the filtered depth image."""
-    ids_filtered = ids.copy()
-    ids_removed = ids.copy()
-    depth_filtered = np.array(depth_filtered)
-    depth_unfiltered = np.array(depth_unfiltered)
-    filter_mask = np.zeros_like(depth_filtered, dtype=np.uint8)
-    changed = 0
-    for x in range(ids.shape[1]):
-        for y in range(ids.shape[0]):
-            id = ids[y, x]
-            if id == PointCloud.EMPTY:
-                continue
-            upper = depth_filtered[y, x] * (1 + deviation)
-            lower = depth_filtered[y, x] * (1 - deviation)
-            if depth_unfiltered[y, x] > upper or depth_unfiltered[y, x] < lower:
-                changed += 1
-                filter_mask[y, x] = 255
-                ids_filtered[y, x] = PointCloud.EMPTY
-            else:
-                ids_removed[y, x] = PointCloud.EMPTY
-    # convert filter mask to image
-    filter_mask = Image.fromarray(filter_mask, mode="L")
+    depth_filtered = np.asarray(depth_filtered, dtype=np.float64)
+    depth_unfiltered = np.asarray(depth_unfiltered)
+    upper = depth_filtered * (1 + deviation)
+    lower = depth_filtered * (1 - deviation)
+    valid = ids != PointCloud.EMPTY
+    deviates = valid & ((depth_unfiltered > upper) | (depth_unfiltered < lower))
+    ids_filtered = np.where(deviates, PointCloud.EMPTY, ids).astype(ids.dtype)
+    ids_removed = np.where(valid & ~deviates, PointCloud.EMPTY, ids).astype(ids.dtype)
     if debug:
+        filter_mask = Image.fromarray(deviates.astype(np.uint8) * 255, mode="L")
         filter_mask.show(title="Filter Mask")
-        print(f"Filtered {changed} ids.")
+        print(f"Filtered {np.count_nonzero(deviates)} ids.")
     return ids_filtered, ids_removed
+
+
+def test_fill_zero_pixels():
+    def fill_loop(depth_buffer, kernel_radius):
+        rows, cols = depth_buffer.shape
+        for i in range(rows):
+            for j in range(cols):
+                if depth_buffer[i, j] == 1.0:
+                    neighborhood = depth_buffer[
+                        max(i - kernel_radius, 0) : min(i + kernel_radius + 1, rows),
+                        max(j - kernel_radius, 0) : min(j + kernel_radius + 1, cols),
+                    ]
+                    neighborhood = neighborhood[neighborhood < 1.0]
+                    if neighborhood.size > 0:
+                        depth_buffer[i, j] = np.mean(neighborhood)
+
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:60, :80] / 60
+    for kernel_radius in (1, 2, 6):
+        # a smooth surface with scattered holes and larger gaps
+        depth_buffer = (0.5 + 0.1 * np.sin(3 * x) * np.cos(2 * y)).astype(np.float32)
+        depth_buffer[rng.random(depth_buffer.shape) < 0.3] = 1.0
+        depth_buffer[20:26, 30:40] = 1.0
+        expected = depth_buffer.copy()
+        fill_loop(expected, kernel_radius)
+        fill_zero_pixels(depth_buffer, kernel_radius)
+        assert not np.any(depth_buffer == 1.0) and not np.any(expected == 1.0)
+        # only holes filled from other holes differ, within a tenth of the depth range
+        error = np.abs(depth_buffer - expected)
+        assert error.max() < 0.02 and error.mean() < 0.001
+    print("Holes are filled like the scan order loop.")
+
+
+if __name__ == "__main__":
+    test_fill_zero_pixels()
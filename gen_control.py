@@ -1,16 +1,27 @@
+import hashlib
+import os
+import queue
+import select
+import sys
+import threading
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 from PIL import Image
 
+import tracing
+
 
 @dataclass
 class SDParams:
     """StableDiffusion parameters"""
 
     prompt: str
-    init_image: Image = None
+    init_image: Image = None  # or an uint8 (h, w, 3) array
     mask: np.ndarray = None  # set to 1 to keep pixels, 0 to discard
     negative_prompt: str = ""
     width: int = 512
@@ -20,18 +31,16 @@ class SDParams:
     controlnet: Optional[Dict] = None
 
 
-def generate(webui_url: str, params: SDParams) -> Image:
-    """Generate an image using the webui api, uses init_image if provided"""
+@tracing.traced
+def generate(webui_url: str, params: SDParams, codec=None, debug=False) -> Image:
+    """Generate an image using the webui api, uses init_image if provided.
+    codec is the webui_api.ImageCodec of the sent images, the fast PNG by default."""
     import webui_api
 
     use_img2img = params.init_image is not None
-    payload = (
-        webui_api.img2img_payload(params)
-        if use_img2img
-        else webui_api.txt2img_payload(params)
+    payload = webui_api.build_payload(
+        params, codec or webui_api.DEFAULT_CODEC, debug=debug
     )
-    if params.controlnet is not None:
-        payload = webui_api.inject_controlnet_payload(payload, params)
 
     img = None
     if use_img2img:
@@ -40,3 +49,235 @@ def generate(webui_url: str, params: SDParams) -> Image:
         img = webui_api.generate_txt2img(webui_url, payload)
 
     return img
+
+
+# images per batched request, bounded by the memory of the WebUI's GPU
+MAX_BATCH_SIZE = 8
+
+
+def _digest(image) -> Optional[bytes]:
+    if image is None:
+        return None
+    image = np.ascontiguousarray(image)
+    return hashlib.blake2b(image, digest_size=16).digest() + str(image.shape).encode()
+
+
+def _batch_key(params: SDParams):
+    """Key of parameters that can share a batch. The WebUI applies one mask and one
+    ControlNet image to a whole batch, so these are part of the key."""
+    depth = None if params.controlnet is None else params.controlnet["depth"]
+    return (
+        params.prompt,
+        params.negative_prompt,
+        params.width,
+        params.height,
+        params.steps,
+        params.cfg_scale,
+        params.init_image is None,
+        _digest(params.mask),
+        params.controlnet is None,
+        _digest(depth),
+    )
+
+
+def generate_batch(
+    webui_url: str,
+    params_list: List[SDParams],
+    codec=None,
+    debug=False,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    workers: int = 4,
+) -> List[Optional[Image.Image]]:
+    """Generate an image for each parameters, returned in the same order.
+    Parameters differing only in their init image are sent as batches, the others,
+    e.g. captures of different views with their own mask and depth map, as concurrent
+    single requests. Failed requests yield None."""
+    import webui_api
+
+    codec = codec or webui_api.DEFAULT_CODEC
+    groups = defaultdict(list)
+    for index, params in enumerate(params_list):
+        groups[_batch_key(params)].append(index)
+    jobs = [
+        indices[start : start + max_batch_size]
+        for indices in groups.values()
+        for start in range(0, len(indices), max_batch_size)
+    ]
+
+    def run(indices):
+        if len(indices) == 1:
+            return [generate(webui_url, params_list[indices[0]], codec, debug)]
+        payload = webui_api.build_batch_payload(
+            [params_list[i] for i in indices], codec
+        )
+        return webui_api.generate_batch(webui_url, payload)
+
+    images = [None] * len(params_list)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, indices): indices for indices in jobs}
+        for future, indices in futures.items():
+            try:
+                results = future.result()
+            except Exception:
+                traceback.print_exc()
+                continue
+            for index, image in zip(indices, results):
+                images[index] = image
+    return images
+
+
+def capture_params(capture, prompt: str, mask: np.ndarray = None, **kwargs):
+    """Parameters retexturing a screen_capture.ScreenCapture, the pixels are encoded
+    straight from its arrays, so keep the capture until the generation finished."""
+    return SDParams(
+        prompt,
+        init_image=capture.color,
+        width=capture.width,
+        height=capture.height,
+        mask=mask,
+        controlnet={"depth": capture.depth},
+        **kwargs,
+    )
+
+
+def generate_captures(
+    webui_url: str, captures: list, params_list: List[SDParams], **kwargs
+) -> List[Tuple[Image.Image, np.ndarray, tuple]]:
+    """Generate the parameters of several captures with generate_batch, return the
+    (image, ids, projected) arguments of SDPointCloud.retexture, skipping failed
+    generations."""
+    images = generate_batch(webui_url, params_list, **kwargs)
+    return [
+        (image, capture.ids, capture.projected)
+        for image, capture in zip(images, captures)
+        if image is not None
+    ]
+
+
+class GenerationQueue:
+    """Runs generations in the background, so the viewer keeps rendering.
+
+    Jobs are prepared one after another, as preparing may ask for input on the console,
+    and then generated by a pool of workers. Generated images are handed to the jobs'
+    apply callbacks by poll(), which is meant to be called from the render thread.
+    The workers are daemon threads and prepares should ask() instead of input(), so a
+    pending question doesn't keep the interpreter from exiting."""
+
+    def __init__(self, webui_url: str, workers: int = 1, codec=None, debug=False):
+        self.webui_url = webui_url
+        self.codec = codec
+        self.debug = debug
+        self._prepare_jobs = queue.Queue()
+        self._generate_jobs = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._work, args=(jobs,), name=name, daemon=True)
+            for jobs, name in [(self._prepare_jobs, "prepare")]
+            + [(self._generate_jobs, f"generate_{i}") for i in range(workers)]
+        ]
+        self._finished = queue.Queue()
+        self._stopped = threading.Event()
+        self.pending = 0
+        # all shared state exists before the workers start
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self,
+        prepare: Callable[[], Optional[SDParams]],
+        apply: Callable[[Image.Image], None],
+        cancel: Callable[[], None] = None,
+    ) -> None:
+        """Queue a job. prepare runs in the background and returns the parameters
+        or None to cancel, apply receives the generated image in poll().
+        prepare may also return a list of parameters, generated with generate_batch,
+        apply then receives the list of images, None where a generation failed.
+        cancel is called in poll() instead if the job was cancelled or failed."""
+        self.pending += 1
+        self._prepare_jobs.put((self._prepare, prepare, (apply, cancel)))
+
+    def poll(self, timeout: float = 0.0) -> int:
+        """Apply all finished generations on the calling thread, return their count.
+        With a timeout, waits up to timeout seconds for the first generation to finish.
+        """
+        applied = 0
+        block = timeout > 0
+        while True:
+            try:
+                (apply, cancel), img = self._finished.get(block, timeout or None)
+            except queue.Empty:
+                return applied
+            block = False
+            self.pending -= 1
+            if img is not None:
+                apply(img)
+                applied += 1
+            elif cancel is not None:
+                cancel()
+
+    def ask(self, question: str) -> Optional[str]:
+        """Like input(), but returns None once the queue is shut down."""
+        if os.name == "nt":
+            # select only polls sockets on Windows
+            return input(question)
+        print(question, end="", flush=True)
+        line = b""
+        while not self._stopped.is_set():
+            if not select.select([sys.stdin], [], [], 0.1)[0]:
+                continue
+            # unbuffered, a blocked read of sys.stdin would hold its lock at exit
+            chunk = os.read(sys.stdin.fileno(), 1024)
+            line += chunk
+            if not chunk or b"\n" in chunk:
+                return line.split(b"\n")[0].decode().rstrip("\r")
+        return None
+
+    def shutdown(self) -> None:
+        """Stop the workers, queued jobs are discarded and running jobs finish in the
+        background, pending questions return None."""
+        self._stopped.set()
+        for jobs in (self._prepare_jobs, self._generate_jobs):
+            while True:
+                try:
+                    jobs.get_nowait()
+                except queue.Empty:
+                    break
+        for thread in self._threads:
+            jobs = (
+                self._prepare_jobs if thread.name == "prepare" else self._generate_jobs
+            )
+            jobs.put(None)
+
+    @staticmethod
+    def _work(jobs: queue.Queue) -> None:
+        while (job := jobs.get()) is not None:
+            function, *args = job
+            function(*args)
+
+    def _prepare(self, prepare, callbacks) -> None:
+        params = self._report_errors(prepare)
+        if params is None:
+            self._finished.put((callbacks, None))
+            return
+        self._generate_jobs.put((self._generate, params, callbacks))
+
+    def _generate(self, params, callbacks) -> None:
+        if isinstance(params, list):
+            img = self._report_errors(
+                generate_batch, self.webui_url, params, self.codec, self.debug
+            )
+            if img is not None and all(image is None for image in img):
+                img = None
+        else:
+            img = self._report_errors(
+                generate, self.webui_url, params, self.codec, self.debug
+            )
+        self._finished.put((callbacks, img))
+
+    @staticmethod
+    def _report_errors(function, *args):
+        # exceptions of the workers' jobs would otherwise go unnoticed
+        try:
+            return function(*args)
+        except Exception:
+            traceback.print_exc()
+            return None
@@ -0,0 +1,238 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+import moderngl
+import numpy as np
+
+
+def inject_definition(shader_code, injection):
+    # "#version xxx" must be the first line
+    lines = shader_code.split("\n")
+    index = 0
+
+    for i, line in enumerate(lines):
+        if line.strip() != "":
+            index = i + 1
+            break
+
+    lines.insert(index, injection)
+    return "\n".join(lines)
+
+
+@dataclass
+class PointBuffers:
+    """Persistent GPU buffers of a point cloud and the points version they were
+    uploaded at."""
+
+    points_version: int
+    vbo_points: moderngl.Buffer
+    vbo_colors: moderngl.Buffer
+    # point ids in octree order, uploaded on first use
+    ibo_octree: moderngl.Buffer = None
+
+
+class GPUResources:
+    """Caches the GPU objects of a single moderngl context.
+
+    Programs are compiled once per shader path and defines, every point cloud keeps
+    one persistent position and color buffer, and framebuffers, pixel buffers and
+    the host arrays pixels are read into are pooled by size and format. Nothing is
+    released implicitly, call release() or the specific release methods when the
+    objects are no longer needed."""
+
+    def __init__(self, ctx: moderngl.Context) -> None:
+        self.ctx = ctx
+        self._programs = {}
+        self._point_buffers = {}
+        # (point cloud, program) -> vertex array
+        self._vertex_arrays = {}
+        # (size, color formats, depth) -> unused framebuffers
+        self._framebuffers = defaultdict(list)
+        # (shape, dtype) -> unused host arrays, size -> unused pixel buffers
+        self._host_arrays = defaultdict(list)
+        self._pixel_buffers = defaultdict(list)
+
+    @classmethod
+    def of(cls, ctx: moderngl.Context) -> "GPUResources":
+        """Return the resources of the context, they are created on first use."""
+        # same convention as moderngl_window's scenes for per-context objects
+        if ctx.extra is None:
+            ctx.extra = {}
+        if "GPU_RESOURCES" not in ctx.extra:
+            ctx.extra["GPU_RESOURCES"] = cls(ctx)
+        return ctx.extra["GPU_RESOURCES"]
+
+    def program(
+        self, path: str, defines: dict = None, varyings: tuple = None
+    ) -> moderngl.Program:
+        """Return the program of a shader file relative to this module, compiled on first use.
+        With varyings, only the vertex shader is compiled for transform feedback."""
+        defines = defines or {}
+        key = (path, tuple(sorted(defines.items())), varyings)
+        if key not in self._programs:
+            shader_file_path = Path(__file__).parent / path
+            with shader_file_path.open("r") as shader_file:
+                shader_source = shader_file.read()
+            for name, value in defines.items():
+                shader_source = inject_definition(
+                    shader_source, f"#define {name} {value}"
+                )
+            vertex_shader = inject_definition(shader_source, "#define VERTEX_SHADER")
+            if varyings:
+                self._programs[key] = self.ctx.program(
+                    vertex_shader=vertex_shader, varyings=varyings
+                )
+            else:
+                self._programs[key] = self.ctx.program(
+                    vertex_shader=vertex_shader,
+                    fragment_shader=inject_definition(
+                        shader_source, "#define FRAGMENT_SHADER"
+                    ),
+                )
+        return self._programs[key]
+
+    def point_buffers(self, pcd) -> tuple[moderngl.Buffer, moderngl.Buffer]:
+        """Return the position and color buffer of the point cloud.
+        Buffers are only uploaded again if the points changed, color changes
+        are written for the dirty ranges only."""
+        buffers = self._point_buffers.get(pcd)
+        if buffers is not None and buffers.points_version != pcd._points_version:
+            self.release_point_cloud(pcd)
+            buffers = None
+        if buffers is None:
+            pcd.track_color_updates(self)
+            buffers = PointBuffers(
+                pcd._points_version,
+                self.ctx.buffer(np.ascontiguousarray(pcd._points, dtype="f4")),
+                self.ctx.buffer(np.ascontiguousarray(pcd._colors, dtype="f4")),
+            )
+            self._point_buffers[pcd] = buffers
+        # only the changed color ranges are written, positions stay untouched
+        for ranges in pcd.take_color_updates(self):
+            for start, stop in ranges:
+                buffers.vbo_colors.write(
+                    np.ascontiguousarray(pcd._colors[start:stop], dtype="f4"),
+                    offset=int(start) * 3 * 4,
+                )
+        return buffers.vbo_points, buffers.vbo_colors
+
+    def octree_index_buffer(self, pcd) -> moderngl.Buffer:
+        """Return the index buffer of the point ids in the order of the point cloud's octree."""
+        self.point_buffers(pcd)
+        buffers = self._point_buffers[pcd]
+        if buffers.ibo_octree is None:
+            buffers.ibo_octree = self.ctx.buffer(pcd.octree.order)
+        return buffers.ibo_octree
+
+    def vertex_array(
+        self, pcd, program: moderngl.Program, octree: bool = False
+    ) -> moderngl.VertexArray:
+        """Return a vertex array rendering the point cloud with the program.
+        With octree, vertices are indexed in octree order, gl_VertexID stays the point id.
+        """
+        vbo_points, vbo_colors = self.point_buffers(pcd)
+        key = (pcd, program, octree)
+        if key not in self._vertex_arrays:
+            self._vertex_arrays[key] = self.ctx.vertex_array(
+                program,
+                [(vbo_points, "3f", "in_position"), (vbo_colors, "3f", "in_color")],
+                index_buffer=self.octree_index_buffer(pcd) if octree else None,
+                index_element_size=4,
+            )
+        return self._vertex_arrays[key]
+
+    def screen_vertex_array(self, program: moderngl.Program) -> moderngl.VertexArray:
+        """Return a vertex array without buffers for image passes, 3 vertices render
+        a triangle covering the viewport."""
+        key = (None, program, False)
+        if key not in self._vertex_arrays:
+            self._vertex_arrays[key] = self.ctx.vertex_array(program, [])
+        return self._vertex_arrays[key]
+
+    def release_point_cloud(self, pcd) -> None:
+        """Release the buffers and vertex arrays of the point cloud."""
+        for key in [key for key in self._vertex_arrays if key[0] is pcd]:
+            self._vertex_arrays.pop(key).release()
+        buffers = self._point_buffers.pop(pcd, None)
+        if buffers is not None:
+            pcd.untrack_color_updates(self)
+            buffers.vbo_points.release()
+            buffers.vbo_colors.release()
+            if buffers.ibo_octree is not None:
+                buffers.ibo_octree.release()
+
+    def framebuffer(
+        self,
+        size: tuple[int, int],
+        color_formats: tuple = ((4, "f1"),),
+        depth: bool = False,
+        textures: bool = False,
+    ) -> moderngl.Framebuffer:
+        """Acquire a framebuffer with a renderbuffer per (components, dtype) color format
+        and optionally a depth texture. Return it with release_framebuffer once read.
+        With textures, the color attachments are textures, e.g. for image passes."""
+        key = (tuple(size), tuple(color_formats), depth, textures)
+        if self._framebuffers[key]:
+            return self._framebuffers[key].pop()
+        attachment = self.ctx.texture if textures else self.ctx.renderbuffer
+        fbo = self.ctx.framebuffer(
+            color_attachments=[
+                attachment(size, components, dtype=dtype)
+                for components, dtype in color_formats
+            ],
+            depth_attachment=self.ctx.depth_texture(size) if depth else None,
+        )
+        fbo.extra = key
+        return fbo
+
+    def release_framebuffer(self, fbo: moderngl.Framebuffer) -> None:
+        """Return the framebuffer to the pool."""
+        self._framebuffers[fbo.extra].append(fbo)
+
+    def host_array(self, shape: tuple, dtype) -> np.ndarray:
+        """Acquire a host array to read pixels into, return it with release_host_array.
+        Arrays never returned are simply garbage collected."""
+        key = (tuple(shape), np.dtype(dtype))
+        if self._host_arrays[key]:
+            return self._host_arrays[key].pop()
+        return np.empty(shape, dtype=dtype)
+
+    def release_host_array(self, array: np.ndarray) -> None:
+        """Return a host array, or a view of the whole array, to the pool."""
+        while array.base is not None and isinstance(array.base, np.ndarray):
+            array = array.base
+        self._host_arrays[(array.shape, array.dtype)].append(array)
+
+    def pixel_buffer(self, size: int) -> moderngl.Buffer:
+        """Acquire a buffer of size bytes for asynchronous pixel transfers,
+        return it with release_pixel_buffer."""
+        if self._pixel_buffers[size]:
+            return self._pixel_buffers[size].pop()
+        return self.ctx.buffer(reserve=size, dynamic=True)
+
+    def release_pixel_buffer(self, buffer: moderngl.Buffer) -> None:
+        self._pixel_buffers[buffer.size].append(buffer)
+
+    def release(self) -> None:
+        """Release all cached objects."""
+        for pcd in list(self._point_buffers):
+            self.release_point_cloud(pcd)
+        for vertex_array in self._vertex_arrays.values():
+            vertex_array.release()
+        self._vertex_arrays.clear()
+        for program in self._programs.values():
+            program.release()
+        self._programs.clear()
+        for framebuffers in self._framebuffers.values():
+            for fbo in framebuffers:
+                for attachment in (*fbo.color_attachments, fbo.depth_attachment):
+                    if attachment is not None:
+                        attachment.release()
+                fbo.release()
+        self._framebuffers.clear()
+        self._host_arrays.clear()
+        for buffers in self._pixel_buffers.values():
+            for buffer in buffers:
+                buffer.release()
+        self._pixel_buffers.clear()
@@ -0,0 +1,244 @@
+import numpy as np
+
+# points drawn per point sized square of the projected leaf, before the point budget
+LOD_DENSITY = 2.0
+# points processed at once while computing and sorting the morton codes,
+# with about 64 bytes of temporaries each
+CHUNK_SIZE = 2**18
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """Spread the lower 21 bits of v so that two zero bits follow each bit."""
+    v = v.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in (
+        (32, 0x1F00000000FFFF),
+        (16, 0x1F0000FF0000FF),
+        (8, 0x100F00F00F00F00F),
+        (4, 0x10C30C30C30C30C3),
+        (2, 0x1249249249249249),
+    ):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_codes(cells: np.ndarray) -> np.ndarray:
+    """Interleave the bits of (n, 3) integer cell coordinates, x being the lowest bit."""
+    return (
+        _spread_bits(cells[:, 0])
+        | (_spread_bits(cells[:, 1]) << np.uint64(1))
+        | (_spread_bits(cells[:, 2]) << np.uint64(2))
+    )
+
+
+def frustum_planes(mvp: np.ndarray) -> np.ndarray:
+    """Return the (6, 4) frustum planes of a MVP matrix as written to the shaders,
+    i.e. clip = [point, 1] @ mvp. Points inside satisfy plane[:3] @ point + plane[3] >= 0.
+    """
+    m = np.asarray(mvp, dtype=np.float64).T
+    planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1]])
+    return np.concatenate((planes, [m[3] + m[2], m[3] - m[2]]))
+
+
+def argsort_codes(
+    codes: np.ndarray, bits: int, bucket_bits: int = 12, max_bucket: int = CHUNK_SIZE
+) -> np.ndarray:
+    """Stable argsort of bits wide codes as uint32 point ids. The ids are grouped by
+    the top bucket_bits of their codes first, buckets of more than max_bucket ids by
+    their next bucket_bits and so on, so only the int64 indices of at most max_bucket
+    ids are sorted at a time instead of 8 bytes per point, also if far outliers put
+    almost all points into one bucket. Grouping a bucket takes 4 bytes per id."""
+    return _bucket_sort(codes, None, bits, bucket_bits, max_bucket)
+
+
+def _bucket_sort(codes, ids, bits, bucket_bits, max_bucket) -> np.ndarray:
+    # ids None are all points, codes only differ in their low bits
+    n_ids = len(codes) if ids is None else len(ids)
+    shift = np.uint64(max(bits - bucket_bits, 0))
+    mask = np.uint64(2 ** min(bits, bucket_bits) - 1)
+
+    def chunks():
+        for start in range(0, n_ids, CHUNK_SIZE):
+            if ids is None:
+                chunk_ids = np.arange(start, min(start + CHUNK_SIZE, n_ids))
+            else:
+                chunk_ids = ids[start : start + CHUNK_SIZE]
+            yield chunk_ids, ((codes[chunk_ids] >> shift) & mask).astype(np.intp)
+
+    counts = np.zeros(int(mask) + 1, dtype=np.int64)
+    for _, buckets in chunks():
+        counts += np.bincount(buckets, minlength=len(counts))
+    starts = np.cumsum(counts) - counts
+    order = np.empty(n_ids, dtype=np.uint32)
+    offsets = starts.copy()
+    for chunk_ids, buckets in chunks():
+        chunk_order = np.argsort(buckets, kind="stable")
+        buckets = buckets[chunk_order]
+        chunk_counts = np.bincount(buckets, minlength=len(counts))
+        rank = (
+            np.arange(len(buckets)) - (np.cumsum(chunk_counts) - chunk_counts)[buckets]
+        )
+        order[offsets[buckets] + rank] = chunk_ids[chunk_order]
+        offsets += chunk_counts
+    if shift == 0:
+        # the buckets hold equal codes
+        return order
+    for start, count in zip(starts, counts):
+        bucket = order[start : start + count]
+        if count > max_bucket:
+            bucket[:] = _bucket_sort(codes, bucket, int(shift), bucket_bits, max_bucket)
+        elif count > 1:
+            bucket[:] = bucket[np.argsort(codes[bucket], kind="stable")]
+    return order
+
+
+class Octree:
+    """Octree over the points of a point cloud, used for culling and level of detail.
+
+    Points are split until a node holds at most max_points, only the leaves are kept.
+    The points of a leaf are a contiguous range of the order array (uint32 point ids,
+    4 bytes per point), shuffled so that every prefix of a leaf is a uniform subsample.
+    """
+
+    def __init__(
+        self, points: np.ndarray, max_points: int = 2**15, max_depth: int = 16
+    ) -> None:
+        self.max_points = max_points
+        self.max_depth = max_depth
+        lower = points.min(axis=0).astype(np.float64)
+        size = float(np.max(points.max(axis=0) - lower)) or 1.0
+        cells_per_axis = 2**max_depth
+        codes = np.empty(len(points), dtype=np.uint64)
+        for start in range(0, len(points), CHUNK_SIZE):
+            chunk = points[start : start + CHUNK_SIZE]
+            cells = (chunk - lower) * (cells_per_axis / size)
+            cells = np.clip(cells, 0, cells_per_axis - 1).astype(np.uint32)
+            codes[start : start + CHUNK_SIZE] = morton_codes(cells)
+        order = argsort_codes(codes, 3 * max_depth)
+        # same as codes[order], without another 8 bytes per point
+        codes.sort()
+
+        self._starts, self._counts, self._lowers, self._sizes = [], [], [], []
+        self._split(codes, 0, len(codes), 0, 0, lower, size)
+        del codes
+        self.starts = np.array(self._starts, dtype=np.int64)
+        self.counts = np.array(self._counts, dtype=np.int64)
+        self.lowers = np.array(self._lowers, dtype=np.float64).reshape(-1, 3)
+        self.sizes = np.array(self._sizes, dtype=np.float64)
+        del self._starts, self._counts, self._lowers, self._sizes
+
+        # shuffle within the leaves, deterministic to keep frames stable
+        rng = np.random.default_rng(0)
+        for start, count in zip(self.starts, self.counts):
+            rng.shuffle(order[start : start + count])
+        self.order = order
+
+    def _split(self, codes, start, stop, level, prefix, lower, size) -> None:
+        if stop - start <= self.max_points or level == self.max_depth:
+            if stop > start:
+                self._starts.append(start)
+                self._counts.append(stop - start)
+                self._lowers.append(lower)
+                self._sizes.append(size)
+            return
+        shift = np.uint64(3 * (self.max_depth - level - 1))
+        children = (prefix << 3) + np.arange(9, dtype=np.uint64)
+        # codes >> shift < child equals codes < child << shift, without a temporary
+        bounds = start + np.searchsorted(codes[start:stop], children << shift)
+        half = size / 2
+        for child in range(8):
+            offset = np.array([child & 1, (child >> 1) & 1, (child >> 2) & 1]) * half
+            self._split(
+                codes,
+                bounds[child],
+                bounds[child + 1],
+                level + 1,
+                int(children[child]),
+                lower + offset,
+                half,
+            )
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def visible(self, mvp: np.ndarray) -> np.ndarray:
+        """Return the mask of leaves intersecting the view frustum."""
+        planes = frustum_planes(mvp)
+        half = self.sizes / 2
+        centers = self.lowers + half[:, None]
+        distances = centers @ planes[:, :3].T + planes[:, 3]
+        radii = half[:, None] * np.abs(planes[:, :3]).sum(axis=1)
+        return np.all(distances >= -radii, axis=1)
+
+    def select(
+        self, mvp: np.ndarray, height: int, point_size: float, point_budget: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return (first, count) ranges of the order array to draw. Visible leaves are
+        drawn with as many points as needed to cover their projected size, scaled
+        down to fit the point budget."""
+        mvp = np.asarray(mvp, dtype=np.float64)
+        visible = self.visible(mvp)
+        half = self.sizes[visible] / 2
+        centers = self.lowers[visible] + half[:, None]
+        # distance to the camera (clip w) and the pixels per unit at distance 1
+        w = centers @ mvp[:3, 3] + mvp[3, 3]
+        pixels_per_unit = np.linalg.norm(mvp[:3, 1]) * height / 2
+        side = 2 * half * pixels_per_unit / np.maximum(w - half * np.sqrt(3), 1e-6)
+        counts = self.counts[visible]
+        needed = np.minimum(counts, LOD_DENSITY * (side / point_size) ** 2)
+        total = needed.sum()
+        if total > point_budget:
+            needed *= point_budget / total
+        needed = np.maximum(needed.astype(np.int64), 1)
+        return merge_ranges(self.starts[visible], needed, counts)
+
+
+def merge_ranges(
+    starts: np.ndarray, counts: np.ndarray, full_counts: np.ndarray = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """Merge consecutive ranges into one when the first of them is drawn completely."""
+    if len(starts) == 0:
+        return starts, counts
+    full_counts = counts if full_counts is None else full_counts
+    joins = (starts[:-1] + full_counts[:-1] == starts[1:]) & (
+        counts[:-1] == full_counts[:-1]
+    )
+    first = np.concatenate(([True], ~joins))
+    group = np.cumsum(first) - 1
+    merged_starts = starts[first]
+    ends = np.zeros(len(merged_starts), dtype=np.int64)
+    np.maximum.at(ends, group, starts + counts)
+    return merged_starts, ends - merged_starts
+
+
+def test_octree():
+    rng = np.random.default_rng(0)
+    points = rng.random((500_000, 3)).astype(np.float32) * 2 - 1
+    octree = Octree(points, max_points=2**12)
+    assert np.array_equal(np.sort(octree.order), np.arange(len(points)))
+    codes = np.random.default_rng(1).integers(0, 2**20, 100_000).astype(np.uint64)
+    expected = np.argsort(codes, kind="stable")
+    assert np.array_equal(argsort_codes(codes, 20, bucket_bits=6), expected)
+    # far outliers leave almost all codes in the first bucket
+    codes >>= np.uint64(10)
+    codes[::1000] |= np.uint64(1 << 19)
+    expected = np.argsort(codes, kind="stable")
+    sorted_ids = argsort_codes(codes, 20, bucket_bits=6, max_bucket=1000)
+    assert np.array_equal(sorted_ids, expected)
+    for leaf in rng.choice(len(octree), 10):
+        start, count = octree.starts[leaf], octree.counts[leaf]
+        leaf_points = points[octree.order[start : start + count]]
+        assert np.all(leaf_points >= octree.lowers[leaf] - 1e-6)
+        assert np.all(leaf_points <= octree.lowers[leaf] + octree.sizes[leaf] + 1e-6)
+
+    assert octree.visible(np.eye(4)).all()
+    # orthographic view of the half x > 0.5 only
+    mvp = np.diag([4.0, 1.0, 1.0, 1.0])
+    mvp[3, 0] = -3.0
+    assert not octree.visible(mvp).all()
+    starts, counts = octree.select(mvp, 512, 1.0, point_budget=10_000)
+    assert counts.sum() <= 10_000 + len(octree)
+    print(f"Octree with {len(octree)} leaves selects {counts.sum()} points.")
+
+
+if __name__ == "__main__":
+    test_octree()
@@ -0,0 +1,136 @@
+import time
+
+import moderngl
+import numpy as np
+
+import point_cloud_rendering_utils as pcru
+from camera_poses import orbit_poses
+from gen_control import GenerationQueue, capture_params
+from pointcloud import SDPointCloud
+from screen_capture import begin_screen_capture
+
+
+class OrbitScheduler:
+    """Retextures a ring of views around the point cloud without interaction.
+
+    Views are generated one group of batch_size views after another, each mask
+    covering the points retextured by all previous groups. The views of a group are
+    sent together with generate_batch and applied in order, retexture never
+    overwrites, so earlier views of a group win where they overlap. While a group is
+    generating, the next one is already captured, a view per frame and read back a
+    frame later, once the group is applied only the masks and the screen images of
+    the next one are updated from the new colors before it is submitted."""
+
+    def __init__(
+        self,
+        sd_pcd: SDPointCloud,
+        generation_queue: GenerationQueue,
+        prompt: str,
+        width: int,
+        height: int,
+        views: int = 8,
+        batch_size: int = 1,
+        debug: bool = False,
+    ):
+        self.sd_pcd = sd_pcd
+        self.generation_queue = generation_queue
+        self.prompt = prompt
+        self.width = width
+        self.height = height
+        self.views = views
+        self.batch_size = batch_size
+        self.debug = debug
+        self.mvps = []
+        self.index = 0
+        self.next_captures = []
+        self.pending_capture = None
+        self.generating = False
+        self.start_time = None
+
+    @property
+    def done(self) -> bool:
+        return self.index == len(self.mvps) and not self.generating
+
+    def start(self, eye: np.ndarray, projection: np.ndarray) -> None:
+        """Start an orbit around the origin through the camera position eye."""
+        if not self.done:
+            print("Orbit already running")
+            return
+        self.start_views([projection * view for view in orbit_poses(eye, self.views)])
+
+    def start_views(self, mvps: list) -> None:
+        """Start retexturing the views of the MVP matrices in order."""
+        self.mvps = list(mvps)
+        self.index = 0
+        self.next_captures = []
+        self.pending_capture = None
+        self.start_time = time.perf_counter()
+
+    def step(self, ctx: moderngl.Context) -> None:
+        """Advance the orbit, meant to be called every frame after the generation
+        queue was polled, the render thread owns the GL context."""
+        group = min(self.batch_size, len(self.mvps) - self.index)
+        if self.pending_capture is None and len(self.next_captures) < group:
+            self.pending_capture = begin_screen_capture(
+                ctx,
+                self.sd_pcd.pcd,
+                self.mvps[self.index + len(self.next_captures)],
+                self.width,
+                self.height,
+                self.debug,
+            )
+            if self.generating:
+                # read back on the next step, after the frame in between was rendered
+                return
+        if self.pending_capture is not None:
+            self.next_captures.append(self.pending_capture.result())
+            self.pending_capture = None
+        if self.generating or group == 0 or len(self.next_captures) < group:
+            return
+
+        captures, self.next_captures = self.next_captures, []
+        mvps = self.mvps[self.index : self.index + group]
+        first = self.index + 1
+        self.index += group
+        views = f"view {first}" if group == 1 else f"views {first}-{self.index}"
+        views += f"/{len(self.mvps)}"
+        params = []
+        for capture in captures:
+            # the previous group was applied after this capture was rendered
+            capture.color = pcru.ids_to_colors(
+                self.sd_pcd.pcd, capture.raw_ids, out=capture.color
+            )
+            params.append(
+                capture_params(
+                    capture, self.prompt, self.sd_pcd.mask_retextured(capture.ids)
+                )
+            )
+
+        def apply(images: list) -> None:
+            for img, capture, mvp in zip(images, captures, mvps):
+                if img is not None:
+                    self.sd_pcd.retexture(
+                        img,
+                        capture.ids,
+                        capture.projected,
+                        pose=mvp,
+                        prompt=self.prompt,
+                    )
+                capture.release()
+            failed = sum(img is None for img in images)
+            failed = f", {failed} failed" if failed else ""
+            self._finished(f"Retextured {views}{failed}")
+
+        def cancel() -> None:
+            for capture in captures:
+                capture.release()
+            self._finished(f"Generation of {views} failed")
+
+        self.generating = True
+        self.generation_queue.submit(lambda: params, apply, cancel)
+
+    def _finished(self, message: str) -> None:
+        self.generating = False
+        print(message)
+        if self.done:
+            print(f"Orbit finished in {time.perf_counter() - self.start_time:.1f}s")
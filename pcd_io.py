@@ -1,34 +1,161 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import laspy
 import numpy as np
 
-from pointcloud import PointCloud
+import tracing
+from pointcloud import PointCloud, normalize
+from session_store import write_atomic
+from voxel_grid import voxel_downsample
+
+# points decoded at once per file, bounds the temporary memory of the loader
+CHUNK_SIZE = 2**18
+CACHE_DIR = Path.home() / ".cache" / "stablescan"
+# bump whenever the cached arrays change meaning
+CACHE_VERSION = 1
 
 
-def extract_las(*filenames: str):
-    point_data_list = []
-    point_color_list = []
+@tracing.traced
+def extract_las(*filenames: str, chunk_size: int = CHUNK_SIZE, workers: int = None):
+    """Read .las files into preallocated float32 arrays of points and 16-bit colors.
+    Files are read in parallel, each one streamed chunk by chunk into its slice.
+    Points are the raw integer coordinates relative to the smallest one of all files,
+    which keeps them precise in float32."""
     if not filenames:
         raise ValueError("No files provided for extraction.")
     for filename in filenames:
         if not filename.endswith(".las"):
             raise ValueError("Only .las files are supported.")
+
+    headers = []
+    for filename in filenames:
         with laspy.open(filename) as fh:
-            las = fh.read()
-            point_data = np.stack([las.X, las.Y, las.Z], axis=0).transpose((1, 0))
-            point_color = np.stack([las.red, las.green, las.blue], axis=0).transpose(
-                (1, 0)
-            )
-            point_data_list.append(point_data)
-            point_color_list.append(point_color)
-    return np.concatenate(point_data_list, axis=0), np.concatenate(
-        point_color_list, axis=0
+            headers.append(fh.header)
+    offsets = np.cumsum([0] + [header.point_count for header in headers])
+    origin = np.min(
+        [np.floor((h.mins - h.offsets) / h.scales) for h in headers], axis=0
     )
+    point_data = np.empty((offsets[-1], 3), dtype=np.float32)
+    point_color = np.empty((offsets[-1], 3), dtype=np.float32)
 
+    def read_file(index: int) -> None:
+        start = offsets[index]
+        with laspy.open(filenames[index]) as fh:
+            for chunk in fh.chunk_iterator(chunk_size):
+                stop = start + len(chunk)
+                for axis, dimension in enumerate(("X", "Y", "Z")):
+                    np.subtract(
+                        chunk[dimension],
+                        origin[axis],
+                        out=point_data[start:stop, axis],
+                        casting="unsafe",
+                    )
+                for channel, dimension in enumerate(("red", "green", "blue")):
+                    point_color[start:stop, channel] = chunk[dimension]
+                start = stop
 
-def read_pcd(*filenames: str):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() propagates exceptions of the workers
+        list(executor.map(read_file, range(len(filenames))))
+    return point_data, point_color
+
+
+@tracing.traced
+def read_pcd(*filenames: str, cache: bool = True, voxel_size: float = None):
     """
-    Read .las files and return a point cloud
+    Read .las files and return a point cloud.
+    With voxel_size in meters, the points within the same cell of a voxel grid are
+    merged, e.g. the duplicates of overlapping scans, see voxel_grid.voxel_downsample.
+    With cache, the normalized float32 points and colors are stored in CACHE_DIR
+    and memory-mapped, also right after the first read of the files.
     """
+    if not cache:
+        points, colors, voxel_index = _read_las(*filenames, voxel_size=voxel_size)
+        return PointCloud(points, colors, normalized=True, voxel_index=voxel_index)
+
+    key = cache_key(*filenames)
+    if voxel_size is not None:
+        key = f"{key}_voxel{voxel_size:g}"
+    points_file = CACHE_DIR / f"{key}_points.npy"
+    colors_file = CACHE_DIR / f"{key}_colors.npy"
+    index_file = CACHE_DIR / f"{key}_voxel_index.npy"
+    files = (points_file, colors_file) + ((index_file,) if voxel_size else ())
+    if not all(file.exists() for file in files):
+        points, colors, voxel_index = _read_las(*filenames, voxel_size=voxel_size)
+        _save_atomic(points_file, points)
+        _save_atomic(colors_file, colors)
+        if voxel_index is not None:
+            _save_atomic(index_file, voxel_index)
+        # the first load maps the cache as well, the arrays are freed
+        del points, colors, voxel_index
+    # colors are copy-on-write, retexturing must not modify the cache
+    return PointCloud(
+        np.load(points_file, mmap_mode="r"),
+        np.load(colors_file, mmap_mode="c"),
+        normalized=True,
+        voxel_index=np.load(index_file, mmap_mode="r") if voxel_size else None,
+    )
+
+
+def _read_las(*filenames: str, voxel_size: float = None):
+    """Return the normalized float32 points and colors, and the voxel index.
+    All steps reuse the arrays of extract_las, 24 bytes per point."""
+    if voxel_size is not None:
+        # the extracted points are in the integer units of the files
+        scales = []
+        for filename in filenames:
+            with laspy.open(filename) as fh:
+                scales.append(fh.header.scales.tolist())
+        if any(file_scales != scales[0] for file_scales in scales):
+            raise ValueError(
+                f"The files have different scales {scales}, voxel_size needs a "
+                "single unit of their coordinates."
+            )
+        scales = np.array(scales[0])
     point_data, point_color = extract_las(*filenames)
-    point_color = point_color / (2**16 - 1)
-    return PointCloud(point_data, point_color)
+    point_color /= 2**16 - 1
+    voxel_index = None
+    if voxel_size is not None:
+        point_data, point_color, voxel_index = voxel_downsample(
+            point_data, point_color, voxel_size / scales
+        )
+    return normalize(point_data, out=point_data), point_color, voxel_index
+
+
+def cache_key(*filenames: str) -> str:
+    """Hash of the contents of the files in order, file hashes are reused while
+    size and mtime of a file are unchanged."""
+    index_file = CACHE_DIR / "index.json"
+    index = json.loads(index_file.read_text()) if index_file.exists() else {}
+    key = hashlib.blake2b(f"v{CACHE_VERSION}".encode(), digest_size=16)
+    changed = False
+    for filename in filenames:
+        path = str(Path(filename).resolve())
+        stat = os.stat(path)
+        entry = index.get(path)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, _file_hash(path)]
+            index[path] = entry
+            changed = True
+        key.update(entry[2].encode())
+    if changed:
+        # concurrent runs may drop each other's entries, which are hashed again
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        write_atomic(index_file, lambda f: f.write(json.dumps(index).encode()))
+    return key.hexdigest()
+
+
+def _file_hash(path: str) -> str:
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while block := f.read(2**24):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _save_atomic(path: Path, array: np.ndarray) -> None:
+    write_atomic(path, lambda f: np.save(f, array))
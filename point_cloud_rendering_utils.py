@@ -1,42 +1,70 @@
-from pathlib import Path
-
 import moderngl
 import numpy as np
 from PIL import Image
 
 import depth_utils
 import pointcloud
+import tracing
+from gpu_resources import GPUResources
+from octree import merge_ranges
 
 # POINT SIZE OPITMIZED FOR 512x512
 POINT_SIZE = 1.5
+# distance of a projected point to the captured surface in pixel footprints, the width
+# of a pixel at the surface, large enough for neighbors on surfaces seen at a grazing
+# angle and small enough to keep the back of thin structures apart at any zoom
+PROJECTION_TOLERANCE = 4.0
+# radius of the Gaussian depth filter, the truncation of gaussian_filter at sigma = 1
+GAUSSIAN_RADIUS = 4
+# pixels per side of the blocks reduced by a pass of the depth range
+REDUCTION_BLOCK = 8
 
 
-def inject_definition(shader_code, injection):
-    # "#version xxx" must be the first line
-    lines = shader_code.split("\n")
-    index = 0
-
-    for i, line in enumerate(lines):
-        if line.strip() != "":
-            index = i + 1
-            break
+def get_program(
+    ctx: moderngl.Context, path: str, defines: dict = None, varyings: tuple = None
+) -> moderngl.Program:
+    return GPUResources.of(ctx).program(path, defines, varyings)
 
-    lines.insert(index, injection)
-    return "\n".join(lines)
 
-
-def get_program(ctx: moderngl.Context, path: str) -> moderngl.Program:
-    shader_file_path = Path(__file__).parent / path
-    with shader_file_path.open("r") as shader_file:
-        shader_source = shader_file.read()
-    program = ctx.program(
-        vertex_shader=inject_definition(shader_source, "#define VERTEX_SHADER"),
-        fragment_shader=inject_definition(shader_source, "#define FRAGMENT_SHADER"),
-    )
-    return program
+def draw_pointcloud(
+    ctx: moderngl.Context,
+    pcd: pointcloud.PointCloud,
+    program: moderngl.Program,
+    mvp: np.ndarray,
+    cull: bool = True,
+) -> None:
+    """Draw all points of the octree leaves inside the view frustum.
+    The points are indexed, so gl_VertexID is still the global point id."""
+    if not cull:
+        with tracing.gpu_span(ctx, "draw_pointcloud", points=len(pcd._points)):
+            pcd.get_va_from(ctx, program).render(mode=moderngl.POINTS)
+        return
+    octree = pcd.octree
+    with tracing.span("cull"):
+        visible = octree.visible(mvp)
+        starts, counts = merge_ranges(octree.starts[visible], octree.counts[visible])
+    va = GPUResources.of(ctx).vertex_array(pcd, program, octree=True)
+    with tracing.gpu_span(ctx, "draw_pointcloud", points=int(counts.sum())):
+        for start, count in zip(starts, counts):
+            va.render(mode=moderngl.POINTS, vertices=int(count), first=int(start))
+
+
+def read_ids(
+    fbo: moderngl.Framebuffer, attachment: int = 0, wide: bool = False
+) -> np.ndarray:
+    """Read the point ids of an integer id attachment, rows from top to bottom.
+    The shaders write id + 1 and the attachment is cleared to 0, so pixels without
+    a point wrap around to PointCloud.EMPTY, or PointCloud.EMPTY_WIDE for wide ids."""
+    components, dtype = (2, np.dtype("<u8")) if wide else (1, np.dtype("<u4"))
+    width, height = fbo.size
+    buffer = fbo.read(components=components, attachment=attachment, dtype="u4")
+    ids = np.frombuffer(buffer, dtype=dtype).reshape((height, width))
+    # in OpenGL the origin is at the bottom left corner
+    return ids[::-1] - dtype.type(1)
 
 
 # NOTE(memben): having ctx as an argument is a workaround for moderngl_window's context management.
+@tracing.traced
 def obtain_point_ids(
     ctx: moderngl.Context,
     pcd: pointcloud.PointCloud,
@@ -44,19 +72,18 @@ def obtain_point_ids(
     width: int,
     height: int,
     debug=False,
+    id_offset: int = 0,
+    wide: bool = False,
 ) -> np.ndarray:
     """Given the point cloud and the MVP (4x4) matrix, return the numpy array of shape (width, height)
     where each cell contains the id of the point that was rendered to that pixel.
-    Note that id = 2*32 - 1 means that no point was rendered."""
+    Note that id = 2*32 - 1 means that no point was rendered.
+    id_offset is added to all ids, e.g. for point clouds rendered in chunks. With wide,
+    the ids are uint64 and no point is marked by PointCloud.EMPTY_WIDE = 2**64 - 1."""
 
-    def buffer_to_id(buffer: bytes, width: int, height: int) -> np.ndarray:
-        dt = np.dtype(np.uint32)
-        # Little endian
-        dt = dt.newbyteorder("<")
-        rgba = np.frombuffer(buffer, dtype=dt).reshape((height, width))
-        return rgba
-
-    program = get_program(ctx, "shaders/point_id.glsl")
+    program = get_program(
+        ctx, "shaders/point_id.glsl", {"WIDE_IDS": 1} if wide else None
+    )
 
     ctx.enable(moderngl.PROGRAM_POINT_SIZE)
     ctx.enable(moderngl.DEPTH_TEST)
@@ -66,28 +93,29 @@ def obtain_point_ids(
     program["mvp"].write(mvp.astype("f4").tobytes())
     # NOTE(memben): distorted point color for values > 1.0 have been a problem in the past
     program["point_size"].value = POINT_SIZE
+    program["id_offset"].value = (id_offset & 0xFFFFFFFF, id_offset >> 32)
 
-    fbo = ctx.framebuffer(ctx.renderbuffer((width, height)))
+    resources = GPUResources.of(ctx)
+    id_format = (2, "u4") if wide else (1, "u4")
+    fbo = resources.framebuffer((width, height), (id_format,), depth=True)
     fbo.use()
-    fbo.clear(1.0, 1.0, 1.0, 1.0)  # white background
-    pcd.get_va_from(ctx, program).render(
-        mode=moderngl.POINTS, vertices=pcd._points.shape[0]
-    )
+    fbo.clear(0.0, 0.0, 0.0, 0.0, depth=1.0)  # empty ids
+    draw_pointcloud(ctx, pcd, program, mvp)
     ctx.finish()
-    buffer = fbo.read(components=4, alignment=1)
-    ids = buffer_to_id(buffer, width, height)
-    # in OpenGL the origin is at the bottom left corner
-    ids = np.flip(ids, axis=0)
+    ids = read_ids(fbo, wide=wide)
     if debug:
-        # Alpha channel cannot be displayed
-        img = Image.frombytes("RGB", fbo.size, fbo.read(), "raw", "RGB", 0, -1)
+        # lowest 3 bytes of the ids, higher bytes cannot be displayed
+        id_bytes = np.ascontiguousarray(ids).view(np.uint8)
+        img = Image.fromarray(id_bytes.reshape((height, width, -1))[..., :3])
         img.show("Point IDs")
         img.save("point_ids.png")
 
         print(f"Captured {len(np.unique(ids))} unique ids.")
+    resources.release_framebuffer(fbo)
     return ids
 
 
+@tracing.traced
 def render_pointcloud(
     ctx: moderngl.Context,
     pcd: pointcloud.PointCloud,
@@ -107,14 +135,14 @@ def render_pointcloud(
 
     program["mvp"].write(mvp.astype("f4").tobytes())
     program["point_size"].value = POINT_SIZE
-    fbo = ctx.framebuffer(ctx.renderbuffer((width, height)))
+    resources = GPUResources.of(ctx)
+    fbo = resources.framebuffer((width, height), depth=True)
     fbo.use()
-    fbo.clear(1.0, 1.0, 1.0, 1.0)  # white background
-    pcd.get_va_from(ctx, program).render(
-        mode=moderngl.POINTS, vertices=pcd._points.shape[0]
-    )
+    fbo.clear(1.0, 1.0, 1.0, 1.0, depth=1.0)  # white background
+    draw_pointcloud(ctx, pcd, program, mvp)
     ctx.finish()
     img = Image.frombytes("RGB", fbo.size, fbo.read(), "raw", "RGB", 0, -1)
+    resources.release_framebuffer(fbo)
 
     if debug:
         img.show("Screen Image")
@@ -122,6 +150,408 @@ def render_pointcloud(
     return img
 
 
+@tracing.traced
+def capture_pointcloud(
+    ctx: moderngl.Context,
+    pcd: pointcloud.PointCloud,
+    mvp: np.ndarray,
+    width: int,
+    height: int,
+    cull: bool = True,
+    debug=False,
+) -> tuple[Image.Image, np.ndarray, np.ndarray]:
+    """Render the point cloud once into a framebuffer with color, point id and depth attachments.
+    Return the screen image, the point ids as in obtain_point_ids
+    and the raw depth buffer as expected by depth_utils.create_depth_image.
+    The arrays are copies, the pooled arrays of capture_arrays are given back."""
+    arrays = capture_arrays(ctx, pcd, mvp, width, height, cull)
+    # the pooled arrays are flipped views, copies are contiguous
+    color, ids, depth = (np.ascontiguousarray(array) for array in arrays)
+    resources = GPUResources.of(ctx)
+    for array in arrays:
+        resources.release_host_array(array)
+    img = Image.fromarray(color)
+
+    if debug:
+        img.show("Screen Image")
+        print(f"Captured {len(np.unique(ids))} unique ids.")
+
+    return img, ids, depth
+
+
+class PendingCapture:
+    """Capture whose pixels are still transferred into pixel buffers."""
+
+    def __init__(self, ctx: moderngl.Context, fbos: list, transfers: list, finish):
+        self.ctx = ctx
+        self.fbos = fbos
+        self.transfers = transfers
+        self.finish = finish
+
+    def result(self):
+        """Wait for the transfers, return the arrays as the synchronous capture."""
+        resources = GPUResources.of(self.ctx)
+        with tracing.span("map pixel buffers"):
+            for buffer, array in self.transfers:
+                buffer.read_into(array)
+                resources.release_pixel_buffer(buffer)
+        return _finish_reads(resources, self.fbos, self.finish, self.transfers)
+
+
+def _read_pixels(ctx: moderngl.Context, fbos: list, reads: list, finish, asynchronous):
+    """Read every (source, read arguments, array) of the framebuffers, then call finish
+    with the arrays while the framebuffers are still acquired, e.g. to draw with their
+    textures, and return the framebuffers. With asynchronous, the pixels are read into
+    pixel buffers and a PendingCapture is returned."""
+    resources = GPUResources.of(ctx)
+    if asynchronous:
+        transfers = []
+        for source, kwargs, array in reads:
+            buffer = resources.pixel_buffer(array.nbytes)
+            source.read_into(buffer, **kwargs)
+            transfers.append((buffer, array))
+        return PendingCapture(ctx, fbos, transfers, finish)
+    with tracing.span("readback"):
+        for source, kwargs, array in reads:
+            source.read_into(array, **kwargs)
+    return _finish_reads(resources, fbos, finish, reads)
+
+
+def _finish_reads(resources: GPUResources, fbos: list, finish, reads: list):
+    result = finish(*(read[-1] for read in reads))
+    for fbo in fbos:
+        resources.release_framebuffer(fbo)
+    return result
+
+
+def _draw_capture(
+    ctx: moderngl.Context,
+    pcd: pointcloud.PointCloud,
+    mvp: np.ndarray,
+    width: int,
+    height: int,
+    cull: bool,
+) -> moderngl.Framebuffer:
+    """Draw the color, point id and depth attachments of a capture."""
+    program = get_program(ctx, "shaders/point_capture.glsl")
+
+    ctx.enable(moderngl.PROGRAM_POINT_SIZE)
+    ctx.enable(moderngl.DEPTH_TEST)
+    ctx.disable(moderngl.BLEND)
+    ctx.multisample = False
+
+    program["mvp"].write(mvp.astype("f4").tobytes())
+    program["point_size"].value = POINT_SIZE
+
+    resources = GPUResources.of(ctx)
+    fbo = resources.framebuffer((width, height), ((4, "f1"), (1, "u4")), depth=True)
+    fbo.use()
+    # integer attachments are cleared with the bits of the value, 0 are empty ids
+    fbo.clear(0.0, 0.0, 0.0, 0.0, depth=1.0)
+    draw_pointcloud(ctx, pcd, program, mvp, cull=cull)
+    return fbo
+
+
+def _capture_reads(resources: GPUResources, fbo: moderngl.Framebuffer) -> list:
+    width, height = fbo.size
+    return [
+        (
+            fbo,
+            dict(components=3, attachment=0),
+            resources.host_array((height, width, 3), np.uint8),
+        ),
+        (
+            fbo,
+            dict(components=1, attachment=1, dtype="u4"),
+            resources.host_array((height, width), np.uint32),
+        ),
+    ]
+
+
+@tracing.traced
+def capture_arrays(
+    ctx: moderngl.Context,
+    pcd: pointcloud.PointCloud,
+    mvp: np.ndarray,
+    width: int,
+    height: int,
+    cull: bool = True,
+    asynchronous: bool = False,
+):
+    """Like capture_pointcloud, but return the (height, width, 3) screen pixels,
+    the point ids and the depth buffer as views of pooled host arrays, without copies.
+    Give the arrays back with GPUResources.release_host_array once they are consumed.
+
+    With asynchronous, the pixels are transferred into pixel buffers in the background
+    and a PendingCapture is returned, e.g. to render a frame before the result is read.
+    """
+    resources = GPUResources.of(ctx)
+    fbo = _draw_capture(ctx, pcd, mvp, width, height, cull)
+    reads = _capture_reads(resources, fbo)
+    depth = resources.host_array((height, width), np.float32)
+    reads.append((fbo.depth_attachment, {}, depth))
+
+    def finish(color, ids, depth):
+        return _finish_capture(resources, color, ids, depth)
+
+    return _read_pixels(ctx, [fbo], reads, finish, asynchronous)
+
+
+@tracing.traced
+def capture_maps(
+    ctx: moderngl.Context,
+    pcd: pointcloud.PointCloud,
+    mvp: np.ndarray,
+    width: int,
+    height: int,
+    fill_radius: int = 1,
+    cull: bool = True,
+    asynchronous: bool = False,
+):
+    """Like capture_arrays, but the depth buffer never leaves the GPU. Return the
+    screen pixels, the point ids, the unfiltered and the filtered 8-bit depth maps of
+    create_depth_maps and the projected points of project_points. The screen pixels,
+    the point ids and the depth maps are pooled host arrays, the projected points are
+    allocated for every capture as their number varies."""
+    resources = GPUResources.of(ctx)
+    fbo = _draw_capture(ctx, pcd, mvp, width, height, cull)
+    maps = _depth_map_passes(ctx, fbo.depth_attachment, fill_radius)
+    reads = _capture_reads(resources, fbo)
+    for attachment in range(2):
+        kwargs = dict(components=1, attachment=attachment, dtype="f1")
+        depth_map = resources.host_array((height, width), np.uint8)
+        reads.append((maps, kwargs, depth_map))
+
+    def finish(color, ids, depth, depth_filtered):
+        color, ids, depth = _finish_capture(resources, color, ids, depth)
+        projected = project_points(ctx, pcd, mvp, fbo.depth_attachment, cull=cull)
+        return color, ids, depth, depth_filtered[::-1], projected
+
+    return _read_pixels(ctx, [fbo, maps], reads, finish, asynchronous)
+
+
+def _finish_capture(resources: GPUResources, color, ids, depth):
+    # ids are written as id + 1, the empty 0 wraps around to EMPTY
+    np.subtract(ids, 1, out=ids)
+    empty = resources.host_array(ids.shape, bool)
+    np.equal(ids, pointcloud.PointCloud.EMPTY, out=empty)
+    np.copyto(color, 255, where=empty[..., None])  # white background
+    resources.release_host_array(empty)
+    # in OpenGL the origin is at the bottom left corner
+    return color[::-1], ids[::-1], depth[::-1]
+
+
+@tracing.traced
+def ids_to_image(pcd: pointcloud.PointCloud, ids: np.ndarray) -> Image.Image:
+    """Return the screen image of point ids as captured by capture_pointcloud,
+    computed on the CPU from the current colors of the point cloud."""
+    return Image.fromarray(ids_to_colors(pcd, ids))
+
+
+def ids_to_colors(
+    pcd: pointcloud.PointCloud, ids: np.ndarray, out: np.ndarray = None
+) -> np.ndarray:
+    """Like ids_to_image, but return the (height, width, 3) pixels, written to out if given."""
+    image = np.empty((*ids.shape, 3), dtype=np.uint8) if out is None else out
+    valid = ids != pointcloud.PointCloud.EMPTY
+    image[~valid] = 255
+    colors = np.clip(pcd._colors[ids[valid]], 0.0, 1.0)
+    # same rounding as the conversion to the normalized framebuffer format
+    image[valid] = np.rint(colors * 255)
+    return image
+
+
+@tracing.traced
+def project_points(
+    ctx: moderngl.Context,
+    pcd: pointcloud.PointCloud,
+    mvp: np.ndarray,
+    depth,
+    tolerance: float = PROJECTION_TOLERANCE,
+    cull: bool = True,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Project every point onto the captured depth buffer with transform feedback.
+    Return the ids of all points within tolerance pixel footprints of the captured
+    surface and their flat pixel indices, rows from top to bottom. Unlike the ids of a
+    capture, which hold the single point winning the depth test of a pixel, this covers
+    all points seen by the view, e.g. to retexture them from a single generated image.
+    depth is the depth texture of the capture or the depth buffer read back."""
+    program = get_program(ctx, "shaders/point_project.glsl", varyings=("pixel",))
+    program["mvp"].write(mvp.astype("f4").tobytes())
+    inverse_mvp = np.linalg.inv(np.asarray(mvp, dtype=np.float64))
+    program["inverse_mvp"].write(inverse_mvp.astype("f4").tobytes())
+    program["tolerance"].value = tolerance
+
+    resources = GPUResources.of(ctx)
+    texture, uploaded = _depth_texture(ctx, depth)
+    texture.use(location=0)
+    program["depth"].value = 0
+
+    if cull:
+        octree = pcd.octree
+        with tracing.span("cull"):
+            visible = octree.visible(mvp)
+            starts, counts = merge_ranges(
+                octree.starts[visible], octree.counts[visible]
+            )
+        va = resources.vertex_array(pcd, program, octree=True)
+    else:
+        starts, counts = np.array([0]), np.array([len(pcd._points)])
+        va = resources.vertex_array(pcd, program)
+    n_points = int(counts.sum())
+    if n_points == 0:
+        if uploaded:
+            texture.release()
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64)
+
+    buffer = resources.pixel_buffer(n_points * 4)
+    with tracing.gpu_span(ctx, "project_points", points=n_points):
+        offset = 0
+        for start, count in zip(starts, counts):
+            va.transform(
+                buffer,
+                mode=moderngl.POINTS,
+                vertices=int(count),
+                first=int(start),
+                buffer_offset=offset * 4,
+            )
+            offset += int(count)
+    pixels = np.frombuffer(buffer.read(size=n_points * 4), dtype=np.int32)
+    resources.release_pixel_buffer(buffer)
+    if uploaded:
+        texture.release()
+
+    # the points were transformed in the order they were drawn
+    if cull:
+        order = pcd.octree.order
+        drawn = np.concatenate(
+            [order[start : start + count] for start, count in zip(starts, counts)]
+        )
+    else:
+        drawn = np.arange(n_points, dtype=np.uint32)
+    projected = pixels >= 0
+    return drawn[projected].astype(np.uint32), pixels[projected].astype(np.int64)
+
+
+def _depth_texture(ctx: moderngl.Context, depth) -> tuple[moderngl.Texture, bool]:
+    """Return a texture of the depth buffer and whether it was uploaded for the call."""
+    if isinstance(depth, moderngl.Texture):
+        if depth.depth:
+            # sample the depths instead of comparing them
+            depth.compare_func = ""
+        return depth, False
+    height, width = depth.shape
+    # the capture is flipped, the texture rows go from bottom to top
+    texture = ctx.texture(
+        (width, height), 1, np.ascontiguousarray(depth[::-1]), dtype="f4"
+    )
+    texture.filter = moderngl.NEAREST, moderngl.NEAREST
+    return texture, True
+
+
+def _image_pass(
+    ctx: moderngl.Context,
+    program: moderngl.Program,
+    fbo: moderngl.Framebuffer,
+    **textures: moderngl.Texture,
+) -> None:
+    """Draw every pixel of fbo with the textures bound to the samplers of their name."""
+    for location, (name, texture) in enumerate(textures.items()):
+        texture.use(location=location)
+        program[name].value = location
+    fbo.use()
+    vertex_array = GPUResources.of(ctx).screen_vertex_array(program)
+    vertex_array.render(mode=moderngl.TRIANGLES, vertices=3)
+
+
+def _depth_map_passes(
+    ctx: moderngl.Context, depth: moderngl.Texture, fill_radius: int
+) -> moderngl.Framebuffer:
+    """Run the passes of create_depth_maps, return the framebuffer of the two maps."""
+    resources = GPUResources.of(ctx)
+    depth, _ = _depth_texture(ctx, depth)
+    size = depth.size
+    ctx.disable(moderngl.DEPTH_TEST)
+    ctx.disable(moderngl.BLEND)
+
+    def program(name, value=1):
+        return get_program(ctx, "shaders/depth_filter.glsl", {name: value})
+
+    with tracing.gpu_span(ctx, "depth_map_passes", pixels=size[0] * size[1]):
+        # ping pong between two float textures
+        fbos = [resources.framebuffer(size, ((1, "f4"),), textures=True) for _ in "ab"]
+        textures = [fbo.color_attachments[0] for fbo in fbos]
+        fill = program("FILL_HOLES")
+        fill["radius"].value = fill_radius
+        # rounds of depth_utils.fill_zero_pixels, the last one writes the first texture
+        source = depth
+        for i in range(depth_utils.FILL_ITERATIONS):
+            target = (depth_utils.FILL_ITERATIONS - 1 - i) % 2
+            _image_pass(ctx, fill, fbos[target], depth=source)
+            source = textures[target]
+        _image_pass(ctx, program("MEDIAN"), fbos[1], depth=textures[0])
+        gaussian = program("GAUSSIAN", GAUSSIAN_RADIUS)
+        gaussian["weights"].write(_gaussian_weights().tobytes())
+        # rows first, the order of gaussian_filter
+        for direction, source in (((0, 1), 1), ((1, 0), 0)):
+            gaussian["direction"].value = direction
+            _image_pass(ctx, gaussian, fbos[1 - source], depth=textures[source])
+        resources.release_framebuffer(fbos[0])
+
+        # min and max of the unfiltered depth, reduced to a single pixel
+        reduce = program("MIN_MAX")
+        reduce["block"].value = REDUCTION_BLOCK
+        ranges, source = [], depth
+        while not ranges or source.size != (1, 1):
+            target_size = tuple(-(-side // REDUCTION_BLOCK) for side in source.size)
+            target = resources.framebuffer(target_size, ((2, "f4"),), textures=True)
+            reduce["first"].value = not ranges
+            _image_pass(ctx, reduce, target, depth=depth, range=source)
+            ranges.append(target)
+            source = target.color_attachments[0]
+
+        maps = resources.framebuffer(size, ((1, "f1"), (1, "f1")))
+        _image_pass(
+            ctx,
+            program("QUANTIZE"),
+            maps,
+            depth=depth,
+            filtered=textures[1],
+            range=source,
+        )
+    resources.release_framebuffer(fbos[1])
+    for fbo in ranges:
+        resources.release_framebuffer(fbo)
+    return maps
+
+
+def _gaussian_weights(sigma: float = 1.0) -> np.ndarray:
+    weights = np.exp(-0.5 * (np.arange(GAUSSIAN_RADIUS + 1) / sigma) ** 2)
+    return (weights / (2 * weights.sum() - weights[0])).astype("f4")
+
+
+@tracing.traced
+def create_depth_maps(
+    ctx: moderngl.Context, depth, fill_radius: int = 1
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the 8-bit depth maps of depth_utils.create_depth_map without and with
+    filter, rows from top to bottom. Hole filling, the median and Gaussian filters and
+    the depth range run as image passes on the GPU and only the maps are read back.
+    depth is the depth texture of a capture or the depth buffer read back."""
+    texture, uploaded = _depth_texture(ctx, depth)
+    maps = _depth_map_passes(ctx, texture, fill_radius)
+    if uploaded:
+        texture.release()
+    width, height = maps.size
+    arrays = []
+    for attachment in range(2):
+        pixels = maps.read(components=1, attachment=attachment, dtype="f1")
+        # in OpenGL the origin is at the bottom left corner
+        arrays.append(np.frombuffer(pixels, dtype=np.uint8).reshape(height, width))
+    GPUResources.of(ctx).release_framebuffer(maps)
+    return arrays[0][::-1], arrays[1][::-1]
+
+
 def create_screen_image(ctx: moderngl.Framebuffer, width: int, height: int) -> Image:
     # Taken from the moderngl_window's screenshot function
     source = ctx.screen
@@ -141,6 +571,7 @@ def create_screen_image(ctx: moderngl.Framebuffer, width: int, height: int) -> I
     return image
 
 
+@tracing.traced
 def create_depth_image(
     ctx: moderngl.Context,
     pcd: pointcloud.PointCloud,
@@ -148,6 +579,7 @@ def create_depth_image(
     width: int,
     height: int,
     filter: bool = True,
+    fill_radius: int = 1,
     debug=False,
 ) -> Image:
     """Given the point cloud and the MVP (4x4) matrix, return the numpy array of shape (width, height)
@@ -161,21 +593,21 @@ def create_depth_image(
     program["mvp"].write(mvp.astype("f4").tobytes())
     program["point_size"].value = POINT_SIZE
 
-    tex_depth = ctx.depth_texture(
-        (width, height)
-    )  # implicit -> dtype='f4', components=1
-    fbo_depth = ctx.framebuffer(depth_attachment=tex_depth)
+    resources = GPUResources.of(ctx)
+    fbo_depth = resources.framebuffer((width, height), (), depth=True)
     fbo_depth.use()
     fbo_depth.clear(depth=1.0)
-    pcd.get_va_from(ctx, program).render(
-        mode=moderngl.POINTS, vertices=pcd._points.shape[0]
-    )
+    draw_pointcloud(ctx, pcd, program, mvp)
     ctx.finish()
-    depth_from_dbo = np.frombuffer(tex_depth.read(), dtype=np.dtype("f4")).reshape(
-        (width, height)[::-1]
-    )
+    # implicit -> dtype='f4', components=1
+    depth_from_dbo = np.frombuffer(
+        fbo_depth.depth_attachment.read(), dtype=np.dtype("f4")
+    ).reshape((width, height)[::-1])
+    resources.release_framebuffer(fbo_depth)
     depth_from_dbo = np.flip(depth_from_dbo, axis=0)
-    return depth_utils.create_depth_image(depth_from_dbo, filter=filter)
+    return depth_utils.create_depth_image(
+        depth_from_dbo, filter=filter, fill_radius=fill_radius
+    )
 
 
 def test_obtain_point_ids():
@@ -196,6 +628,25 @@ def test_obtain_point_ids():
     print(ids)
 
 
+def test_wide_ids():
+    width, height = 256, 256
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    pcd = pointcloud.PointCloud(rng.random((width * height, 3)))
+    ctx = moderngl.create_standalone_context()
+    params = (ctx, pcd, MVP, width, height)
+    ids = obtain_point_ids(*params)
+    empty = ids == pointcloud.PointCloud.EMPTY
+    assert empty.any() and not empty.all()
+    # the offset carries into the high word for the larger ids
+    offset = 2**32 - len(pcd._points) // 2
+    wide_ids = obtain_point_ids(*params, id_offset=offset, wide=True)
+    assert wide_ids.dtype == np.uint64
+    assert np.all(wide_ids[empty] == pointcloud.PointCloud.EMPTY_WIDE)
+    assert np.array_equal(wide_ids[~empty], ids[~empty].astype(np.uint64) + offset)
+    print("Wide point ids match the 32-bit ids with an offset.")
+
+
 def test_obtain_depth():
     width, height = 512, 512
     n_points = width * height
@@ -225,6 +676,201 @@ def test_obtain_depth():
     depth_image.show()
 
 
+def test_capture_pointcloud():
+    width, height = 256, 256
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    pcd = pointcloud.PointCloud(rng.random((width * height, 3)))
+    ctx = moderngl.create_standalone_context()
+    params = (ctx, pcd, MVP, width, height)
+    img, ids, depth = capture_pointcloud(*params)
+    assert img.tobytes() == render_pointcloud(*params).tobytes()
+    assert np.array_equal(ids, obtain_point_ids(*params))
+    for filter in (False, True):
+        expected = create_depth_image(*params, filter=filter)
+        depth_image = depth_utils.create_depth_image(depth, filter=filter)
+        assert depth_image.tobytes() == expected.tobytes()
+    print("Single pass capture matches the separate render passes.")
+
+
+def test_ids_to_image():
+    width, height = 256, 256
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    pcd = pointcloud.PointCloud(rng.random((width * height // 4, 3)))
+    pcd.set_color(slice(None), rng.random((width * height // 4, 3)))
+    ctx = moderngl.create_standalone_context()
+    img, ids, _ = capture_pointcloud(ctx, pcd, MVP, width, height)
+    assert ids_to_image(pcd, ids).tobytes() == img.tobytes()
+    print("Screen image from the point ids matches the rendered one.")
+
+
+def test_culled_capture():
+    width, height = 256, 256
+    rng = np.random.default_rng(0)
+    pcd = pointcloud.PointCloud(rng.random((1_000_000, 3)))
+    # orthographic view of the corner x, y > 0.5
+    MVP = np.diag([4.0, 4.0, 1.0, 1.0]).astype(np.float32)
+    MVP[3, :2] = -3.0
+    ctx = moderngl.create_standalone_context()
+    params = (ctx, pcd, MVP, width, height)
+    img, ids, depth = capture_pointcloud(*params, cull=True)
+    expected_img, expected_ids, expected_depth = capture_pointcloud(*params, cull=False)
+    assert np.count_nonzero(pcd.octree.visible(MVP)) < len(pcd.octree)
+    assert img.tobytes() == expected_img.tobytes()
+    assert np.array_equal(ids, expected_ids)
+    assert np.array_equal(depth, expected_depth)
+    print("Frustum culled capture matches the full capture.")
+
+
+def test_gpu_resource_reuse():
+    width, height = 128, 128
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    pcd = pointcloud.PointCloud(rng.random((width * height, 3)))
+    ctx = moderngl.create_standalone_context()
+    resources = GPUResources.of(ctx)
+    capture_pointcloud(ctx, pcd, MVP, width, height)
+    buffers = resources.point_buffers(pcd)
+    framebuffers = {key: list(fbos) for key, fbos in resources._framebuffers.items()}
+    host_arrays = {key: len(arrays) for key, arrays in resources._host_arrays.items()}
+    for _ in range(3):
+        pcd.set_color(np.arange(10), np.zeros(3))
+        capture_pointcloud(ctx, pcd, MVP, width, height)
+    assert resources.point_buffers(pcd) == buffers
+    assert resources._framebuffers == framebuffers
+    assert {k: len(a) for k, a in resources._host_arrays.items()} == host_arrays
+    assert len(resources._programs) == 1 and len(resources._vertex_arrays) == 1
+    resources.release()
+    print("Repeated captures reuse all GPU resources.")
+
+
+def test_pending_capture():
+    width, height = 128, 96
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    pcd = pointcloud.PointCloud(rng.random((width * height, 3)))
+    ctx = moderngl.create_standalone_context()
+    resources = GPUResources.of(ctx)
+    params = (ctx, pcd, MVP, width, height)
+    expected = [array.copy() for array in capture_arrays(*params)]
+    pending = capture_arrays(*params, asynchronous=True)
+    arrays = pending.result()
+    for array, expected_array in zip(arrays, expected):
+        assert np.array_equal(array, expected_array)
+    for array in arrays:
+        resources.release_host_array(array)
+    # the released arrays are read into again
+    assert capture_arrays(*params)[1].base is arrays[1].base
+    resources.release()
+    print("Pending capture matches the synchronous capture.")
+
+
+def test_project_points():
+    width, height = 128, 128
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    # a dense front plane hiding a back plane, both filling the view
+    n_points = 4 * width * height
+    xy = rng.random((2 * n_points, 2)) * 2 - 1
+    z = np.repeat([0.0, 0.5], n_points)
+    pcd = pointcloud.PointCloud(np.column_stack((xy, z)))
+    # the front plane is normalized to z = -1, move it off the near plane
+    MVP[3, 2] = 0.5
+    ctx = moderngl.create_standalone_context()
+    _, ids, depth = capture_arrays(ctx, pcd, MVP, width, height)
+    point_ids, pixels = project_points(ctx, pcd, MVP, depth)
+    # points of the back plane are only seen through holes of the front plane
+    back = point_ids >= n_points
+    assert np.count_nonzero(~back) == n_points
+    assert (depth.reshape(-1)[pixels[back]] > 0.4).all()
+    xy = (pcd._points[point_ids, :2] * 0.5 + 0.5) * [width, height]
+    x, y = np.minimum(xy.astype(int), [width - 1, height - 1]).T
+    # points on pixel borders may round differently in float32
+    mismatches = np.count_nonzero(pixels != (height - 1 - y) * width + x)
+    assert mismatches <= len(pixels) // 1000
+    culled = project_points(ctx, pcd, MVP, depth, cull=False)
+    assert np.array_equal(np.sort(culled[0]), np.sort(point_ids))
+    print(f"Projected {len(point_ids)} points, {len(np.unique(ids))} won a pixel.")
+    # zoomed in on a thin sheet, the tolerance shrinks with the pixel footprint
+    sheet = np.column_stack((rng.random((2 * n_points, 2)) / 8 - 1 / 16, z / 50))
+    pcd = pointcloud.PointCloud(sheet.astype(np.float32), normalized=True)
+    MVP[0, 0] = MVP[1, 1] = 16
+    _, ids, depth = capture_arrays(ctx, pcd, MVP, width, height)
+    point_ids, pixels = project_points(ctx, pcd, MVP, depth)
+    # points of the back of the sheet are only seen through holes of the front
+    back = point_ids >= n_points
+    assert (depth.reshape(-1)[pixels[back]] > 0.7525).all()
+
+
+def test_depth_maps():
+    width, height = 192, 128
+    rng = np.random.default_rng(0)
+    MVP = np.eye(4, dtype=np.float32)
+    # a wavy surface with small holes between the points
+    xy = rng.random((width * height, 2)) * 2 - 1
+    z = 0.3 * np.sin(3 * xy[:, 0]) * np.cos(2 * xy[:, 1])
+    pcd = pointcloud.PointCloud(np.column_stack((xy, z)))
+    MVP[3, 2] = 0.5
+    ctx = moderngl.create_standalone_context()
+    params = (ctx, pcd, MVP, width, height)
+    _, ids, depth = capture_arrays(*params)
+    maps = create_depth_maps(ctx, depth)
+    for depth_map, filter in zip(maps, (False, True)):
+        expected = depth_utils.create_depth_map(depth, filter=filter)
+        # float32 rounding of the GPU may flip a quantization step
+        assert np.abs(depth_map.astype(int) - expected).max() <= 1
+    assert np.array_equal(maps[0], depth_utils.create_depth_map(depth))
+    *_, depth_map, filtered, projected = capture_maps(*params)
+    assert np.array_equal(depth_map, maps[0]) and np.array_equal(filtered, maps[1])
+    assert np.array_equal(projected[0], project_points(ctx, pcd, MVP, depth)[0])
+    pending = capture_maps(*params, asynchronous=True).result()
+    assert np.array_equal(pending[3], filtered)
+    print(
+        f"GPU depth maps match with {np.count_nonzero(ids == pcd.EMPTY)} empty pixels."
+    )
+
+
+def test_partial_color_update():
+    rng = np.random.default_rng(0)
+    pcd = pointcloud.PointCloud(rng.random((100_000, 3)), rng.random((100_000, 3)))
+    ctx = moderngl.create_standalone_context()
+    resources = GPUResources.of(ctx)
+    vbo_points, vbo_colors = resources.point_buffers(pcd)
+    points = vbo_points.read()
+    for _ in range(3):
+        ids = rng.choice(len(pcd._colors), size=1000, replace=False)
+        pcd.set_color(ids, rng.random((len(ids), 3)))
+    assert resources.point_buffers(pcd) == (vbo_points, vbo_colors)
+    colors = np.frombuffer(vbo_colors.read(), dtype="f4").reshape(-1, 3)
+    assert np.array_equal(colors, pcd._colors.astype("f4"))
+    assert vbo_points.read() == points
+    assert not pcd._color_updates
+
+    # updates are kept until every context wrote them
+    other = GPUResources.of(moderngl.create_standalone_context())
+    other.point_buffers(pcd)
+    pcd.set_color(np.arange(10), np.zeros(3))
+    resources.point_buffers(pcd)
+    assert len(pcd._color_updates) == 1
+    _, other_colors = other.point_buffers(pcd)
+    assert not pcd._color_updates and other_colors.read() == vbo_colors.read()
+    resources.release()
+    other.release()
+    pcd.set_color(np.arange(10), np.ones(3))
+    assert not pcd._color_updates
+    print("Color changes are written to the existing buffers.")
+
+
 if __name__ == "__main__":
     test_obtain_point_ids()
+    test_wide_ids()
     test_obtain_depth()
+    test_capture_pointcloud()
+    test_ids_to_image()
+    test_culled_capture()
+    test_gpu_resource_reuse()
+    test_pending_capture()
+    test_project_points()
+    test_depth_maps()
+    test_partial_color_update()
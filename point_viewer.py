@@ -7,6 +7,10 @@ import depth_utils
 import point_cloud_rendering_utils as pcru
 import pointcloud
 from base_viewer import CameraWindow
+from gpu_resources import GPUResources
+
+# points drawn per frame at most, larger point clouds are rendered with level of detail
+POINT_BUDGET = 10_000_000
 
 
 class PointCloudViewer(CameraWindow):
@@ -17,13 +21,15 @@ class PointCloudViewer(CameraWindow):
         pcd: pointcloud.PointCloud,
         callbacks: dict[callable],
         debug: bool = False,
-        **kwargs
+        point_budget: int = POINT_BUDGET,
+        **kwargs,
     ):
         super().__init__(**kwargs)
         # self.wnd.mouse_exclusivity = True
         self.pcd = pcd
         self.callbacks = callbacks
         self.debug = debug
+        self.point_budget = point_budget
         self.prog = self.load_program("point_color.glsl")
         self.fbo = None
 
@@ -38,7 +44,21 @@ class PointCloudViewer(CameraWindow):
         mvp = self.camera.projection.matrix * self.camera.matrix
         self.prog["mvp"].write(mvp)
         self.prog["point_size"].value = self.pcd._point_size
-        self.pcd.vao.render(self.prog)
+        if len(self.pcd._points) <= self.point_budget:
+            self.pcd.vao.render(self.prog)
+        else:
+            self.render_lod(mvp)
+
+    def render_lod(self, mvp):
+        """Render the octree leaves with the number of points their screen size needs,
+        within the point budget."""
+        _, __, ___, height = self.ctx.viewport
+        starts, counts = self.pcd.octree.select(
+            mvp, height, max(self.pcd._point_size, 1.0), self.point_budget
+        )
+        va = GPUResources.of(self.ctx).vertex_array(self.pcd, self.prog, octree=True)
+        for start, count in zip(starts, counts):
+            va.render(moderngl.POINTS, vertices=int(count), first=int(start))
 
     def key_event(self, key, action, modifiers):
         super().key_event(key, action, modifiers)
@@ -56,6 +76,8 @@ class PointCloudViewer(CameraWindow):
             self.callbacks["save"]()
         elif key == self.wnd.keys.L:
             self.callbacks["load"]()
+        elif key == self.wnd.keys.U:
+            self.callbacks["undo"]()
 
         elif key == self.wnd.keys.X and self.debug:
             self.callbacks["retexture_only"]()
@@ -67,14 +89,17 @@ class PointCloudViewer(CameraWindow):
         # Show the indices of the points
         elif key == self.wnd.keys.I and self.debug:
             pcru.obtain_point_ids(self.ctx, self.pcd, mvp, width, height, debug=True)
-            self.prog = self.load_program("point_id.glsl")
+            self.prog = self.load_program("point_id_color.glsl")
 
         # Show the effect of the applied filters, red are the points that were removed
         elif key == self.wnd.keys.F and self.debug:
-            params = (self.ctx, self.pcd, mvp, width, height)
-            depth_image = pcru.create_depth_image(*params, filter=False)
-            depth_image_filtered = pcru.create_depth_image(*params, filter=True)
-            raw_ids = pcru.obtain_point_ids(*params)
+            _, raw_ids, depth_buffer = pcru.capture_pointcloud(
+                self.ctx, self.pcd, mvp, width, height
+            )
+            depth_image = depth_utils.create_depth_image(depth_buffer, filter=False)
+            depth_image_filtered = depth_utils.create_depth_image(
+                depth_buffer, filter=True
+            )
             depth_image.show("Depth Image")
             depth_image_filtered.show("Depth Image Filtered")
             ids, ids_removed = depth_utils.filter_ids(
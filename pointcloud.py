@@ -1,22 +1,58 @@
+import weakref
+from pathlib import Path
+
 import moderngl
+import moderngl_window
 import numpy as np
 from moderngl_window.opengl.vao import VAO
 from PIL import Image
 
+import tracing
+from gpu_resources import GPUResources
+from octree import Octree
+from session_store import Delta, SessionStore
+
+# points normalized at once, bounds the temporary memory
+CHUNK_SIZE = 2**20
+
 
 class PointCloud:
+    """Points and colors as float32 arrays, 24 bytes per point. Colors must be
+    float32 too, else they are converted once. Both are uploaded to the GPU without
+    copies, see GPUResources.point_buffers."""
+
     EMPTY = 2**32 - 1
+    # empty id of the 64-bit ids of pcru.obtain_point_ids
+    EMPTY_WIDE = 2**64 - 1
+    # unchanged points between two dirty ranges up to which both are uploaded in one write
+    DIRTY_RANGE_GAP = 1024
 
     def __init__(
-        self, points: np.ndarray, colors: np.ndarray = None, point_size: float = 1.0
+        self,
+        points: np.ndarray,
+        colors: np.ndarray = None,
+        point_size: float = 1.0,
+        normalized: bool = False,
+        voxel_index: np.ndarray = None,
     ) -> None:
         # to provide a uniform camera experience
-        self._points = normalize(points)
+        self._points = points if normalized else normalize(points)
+        # point of every point of the scan files, if read_pcd merged them on a voxel grid
+        self.voxel_index = voxel_index
         self._point_size = point_size
         if colors is None:
             colors = np.random.rand(points.shape[0], 3).astype(np.float32)
-        self._colors = colors
+        self._colors = colors if colors.dtype == np.float32 else colors.astype("f4")
+        # bumped on every change of the points, GPU buffers are uploaded again if outdated
+        self._points_version = 0
+        # dirty (start, stop) ranges of the set_color calls not yet taken by every
+        # consumer, the first one is update number _color_updates_offset
+        self._color_updates = []
+        self._color_updates_offset = 0
+        # consumer, e.g. the GPU buffers of a context -> number of updates taken
+        self._color_consumers = weakref.WeakKeyDictionary()
         self._vao = None
+        self._octree = None
 
     @property
     def point_size(self) -> float:
@@ -24,135 +60,385 @@ class PointCloud:
 
     @property
     def vao(self) -> VAO:
+        # syncs the changed colors to the shared buffers of the window context
+        GPUResources.of(moderngl_window.ctx()).point_buffers(self)
         if self._vao is None:
             self._vao = self._create_pc()
         return self._vao
 
+    @property
+    def octree(self) -> Octree:
+        """Octree over the points, built on first use."""
+        if self._octree is None:
+            self._octree = Octree(self._points)
+        return self._octree
+
     def get_va_from(
         self, ctx: moderngl.Context, program: moderngl.Program
     ) -> moderngl.VertexArray:
-        """Create a vertex array from the points and colors."""
-        vbo_points = ctx.buffer(self._points.astype("f4").tobytes())
-        vbo_colors = ctx.buffer(self._colors.astype("f4").tobytes())
-        va = ctx.vertex_array(
-            program, [(vbo_points, "3f", "in_position"), (vbo_colors, "3f", "in_color")]
-        )
-        return va
+        """Return the cached vertex array of the points and colors for the program."""
+        return GPUResources.of(ctx).vertex_array(self, program)
 
     def _create_pc(self) -> VAO:
         _vao = VAO(mode=moderngl.POINTS)
-        vbo = self._points.astype("f4").tobytes()
-        _vao.buffer(vbo, "3f", "in_position")
-        vbo = self._colors.astype("f4").tobytes()
-        _vao.buffer(vbo, "3f", "in_color")
+        vbo_points, vbo_colors = GPUResources.of(moderngl_window.ctx()).point_buffers(
+            self
+        )
+        _vao.buffer(vbo_points, "3f", "in_position")
+        _vao.buffer(vbo_colors, "3f", "in_color")
         return _vao
 
     def set_color(self, ids: np.array, colors: np.array) -> None:
         """Set the color of all points with ids in the ids set."""
         self._colors[ids] = colors
-        self._vao = None
+        if self._color_consumers:
+            self._color_updates.append(dirty_ranges(ids, len(self._colors)))
+
+    def track_color_updates(self, consumer) -> None:
+        """Record the color updates from now on until the consumer takes them,
+        e.g. for GPU buffers holding the current colors."""
+        self._color_consumers[consumer] = self._color_update_count
+
+    def untrack_color_updates(self, consumer) -> None:
+        self._color_consumers.pop(consumer, None)
+        self._drop_color_updates()
+
+    def take_color_updates(self, consumer) -> list[np.ndarray]:
+        """Return the dirty ranges of the color updates since the consumer last took
+        them. Updates taken by every consumer are dropped."""
+        start = self._color_consumers[consumer] - self._color_updates_offset
+        updates = self._color_updates[max(start, 0) :]
+        self._color_consumers[consumer] = self._color_update_count
+        self._drop_color_updates()
+        return updates
+
+    @property
+    def _color_update_count(self) -> int:
+        return self._color_updates_offset + len(self._color_updates)
+
+    def _drop_color_updates(self) -> None:
+        taken = min(self._color_consumers.values(), default=self._color_update_count)
+        dropped = taken - self._color_updates_offset
+        if dropped > 0:
+            del self._color_updates[:dropped]
+            self._color_updates_offset = taken
 
     def set_pcd(self, points: np.ndarray, colors: np.ndarray):
         self._points = normalize(points)
         self._colors = colors
-        self._vao = None
+        self._points_changed()
 
     def filter(self, u_ids: np.array) -> None:
         """Discard all points except those with ids in the ids array."""
         self._points = self._points[u_ids]
         self._colors = self._colors[u_ids]
+        self._points_changed()
+
+    def _points_changed(self) -> None:
+        self._points_version += 1
+        self._color_updates_offset = self._color_update_count
+        self._color_updates = []
         self._vao = None
+        self._octree = None
 
 
 class SDPointCloud:
-    """A point cloud wrapper that provides additional retexturing functionality for StableScan."""
+    """A point cloud wrapper that provides additional retexturing functionality for StableScan.
+
+    The retexture state is a dense uint16 layer id per point (2 bytes per point):
+    0 marks an untouched point, k > 0 the generation that retextured it.
+    Next to the point cloud itself, only the original colors are kept (one copy,
+    same dtype as the point cloud colors), the original points are shared.
+    Colors memory-mapped copy-on-write, as read from the cache of read_pcd, keep
+    their originals as a read-only map of the same file instead of a copy.
+    Once saved or loaded, the changes since the last save are kept as
+    session_store.Delta until the next save."""
+
+    MAX_GENERATIONS = np.iinfo(np.uint16).max
 
     def __init__(self, pcd: PointCloud, debug=False) -> None:
-        self.original_points = pcd._points.copy()
-        self.original_colors = pcd._colors.copy()
+        # PointCloud never modifies its points in place, sharing them is safe
+        self.original_points = pcd._points
+        self.original_colors = _original(pcd._colors)
         self.pcd = pcd
         self.debug = debug
-        self.retextured_points = set()
+        self.layers = np.zeros(len(pcd._points), dtype=np.uint16)
+        self.generation = 0
+        # original index of each point, only set once the point cloud was filtered
+        self._original_index = None
+        # sorted ids of the flagged points and their colors before they were flagged
+        self._flag_ids = np.empty(0, dtype=np.int64)
+        self._flag_colors = np.empty((0, 3), dtype=pcd._colors.dtype)
+        # changes since the last save and the session they are appended to
+        self._deltas = []
+        self._store = None
 
     @property
     def retextured_point_ids(self) -> np.ndarray:
-        return np.array(list(self.retextured_points))
+        return np.flatnonzero(self.layers)
 
-    def retexture(self, texture: Image, ids: np.ndarray) -> None:
-        """Given a texture and a 2D array of ids, retexture the point cloud."""
+    @tracing.traced
+    def retexture(
+        self,
+        texture: Image,
+        ids: np.ndarray,
+        projected: tuple = None,
+        pose: np.ndarray = None,
+        prompt: str = None,
+    ) -> None:
+        """Given a texture and a 2D array of ids, retexture the point cloud.
+        projected are the (point ids, pixel indices) of point_cloud_rendering_utils.
+        project_points, all of these points are retextured as well.
+        The MVP matrix pose and the prompt of the view are saved with the session."""
         assert texture.width == ids.shape[1]
         assert texture.height == ids.shape[0]
-        retexture_ids = []
-        retexture_colors = []
-        for y in range(texture.height):
-            for x in range(texture.width):
-                id = ids[y, x]
-                if id == PointCloud.EMPTY:
-                    continue
-                if id in self.retextured_points:
-                    continue
-                color = texture.getpixel((x, y))
-                color = np.array(color, dtype=np.float32) / 255.0
-                retexture_ids.append(id)
-                retexture_colors.append(color)
-        retexture_ids = np.array(retexture_ids)
-        retexture_colors = np.array(retexture_colors)
-        self.pcd.set_color(retexture_ids, retexture_colors)
-        self.retextured_points.update(retexture_ids)
+        pixels = np.asarray(texture.convert("RGB")).reshape(-1, 3)
+        ids = ids.reshape(-1)
+        pixel_indices = np.flatnonzero(ids != PointCloud.EMPTY)
+        point_ids = ids[pixel_indices]
+        if projected is not None:
+            # a point takes the color of the pixel it projects to, points only seen
+            # in pixels beyond the tolerance of the projection keep that color
+            point_ids = np.concatenate((projected[0], point_ids))
+            pixel_indices = np.concatenate((projected[1], pixel_indices))
+            point_ids, first = np.unique(point_ids, return_index=True)
+            pixel_indices = pixel_indices[first]
+        keep = self.layers[point_ids] == 0
+        retexture_ids = point_ids[keep]
+        retexture_colors = pixels[pixel_indices[keep]].astype(np.float32) / 255.0
+        if len(retexture_ids) > 0:
+            if self.generation == self.MAX_GENERATIONS:
+                raise ValueError(
+                    f"Cannot retexture more than {self.MAX_GENERATIONS} generations."
+                )
+            self.generation += 1
+            self._unflag(retexture_ids)
+            self.pcd.set_color(retexture_ids, retexture_colors)
+            self.layers[retexture_ids] = self.generation
+            self._record(
+                Delta(
+                    "retexture",
+                    self.generation,
+                    retexture_ids,
+                    retexture_colors,
+                    pose,
+                    prompt,
+                )
+            )
 
         if self.debug:
             print(f"Retextured {len(retexture_ids)} points.")
 
+    def undo(self, generations: int = 1) -> None:
+        """Undo the last generations, restoring the original colors of their points."""
+        generations = min(generations, self.generation)
+        if generations <= 0:
+            return
+        self.generation -= generations
+        ids = np.flatnonzero(self.layers > self.generation)
+        original_ids = (
+            ids if self._original_index is None else self._original_index[ids]
+        )
+        self._unflag(ids)
+        self.pcd.set_color(ids, self.original_colors[original_ids])
+        self.layers[ids] = 0
+        self._record(Delta("undo", self.generation))
+
+        if self.debug:
+            print(f"Undid {generations} generations, restored {len(ids)} points.")
+
     def flag(self, ids: np.ndarray) -> None:
-        """Flag all points with ids in the ids set."""
+        """Flag all points with ids in the ids set. Flagged points are shown red until
+        they are retextured or restored, sessions are saved without the flags."""
+        ids = np.setdiff1d(ids, self._flag_ids)
+        flag_ids = np.concatenate((self._flag_ids, ids))
+        order = np.argsort(flag_ids)
+        self._flag_ids = flag_ids[order]
+        self._flag_colors = np.concatenate((self._flag_colors, self.pcd._colors[ids]))[
+            order
+        ]
         self.pcd.set_color(ids, np.array([1.0, 0.0, 0.0], dtype=np.float32))
 
+    def _unflag(self, ids: np.ndarray) -> None:
+        # the colors of the ids are about to change, they are no longer flagged
+        if len(self._flag_ids) > 0:
+            keep = ~np.isin(self._flag_ids, ids)
+            self._flag_ids = self._flag_ids[keep]
+            self._flag_colors = self._flag_colors[keep]
+
+    def _saved_colors(self, ids: np.ndarray) -> np.ndarray:
+        """Return the colors of the ids, those of flagged points from before the flag."""
+        colors = self.pcd._colors[ids]
+        if len(self._flag_ids) > 0:
+            positions = np.minimum(
+                np.searchsorted(self._flag_ids, ids), len(self._flag_ids) - 1
+            )
+            flagged = self._flag_ids[positions] == ids
+            colors[flagged] = self._flag_colors[positions[flagged]]
+        return colors
+
     def filter(self, ids: np.ndarray) -> None:
         """Discard all points except those with ids in the ids array."""
+        ids = np.asarray(ids)
+        if len(self._flag_ids) > 0:
+            # the flags move to the new positions of their points
+            flagged = np.zeros(len(self.layers), dtype=bool)
+            flagged[self._flag_ids] = True
+            new_ids = np.flatnonzero(flagged[ids])
+            positions = np.searchsorted(self._flag_ids, ids[new_ids])
+            self._flag_ids = new_ids
+            self._flag_colors = self._flag_colors[positions]
         self.pcd.filter(ids)
+        self.layers = self.layers[ids]
+        self._original_index = (
+            ids if self._original_index is None else self._original_index[ids]
+        )
+        # the ids changed, the next save writes a new snapshot
+        self._close_store()
 
+    @tracing.traced
     def save(self, filename: str) -> None:
-        """Save the change on the point cloud to two .npy files."""
-        ids = np.array(list(self.retextured_points))
-        colors = self.pcd._colors[ids]
-        np.save(filename + "_ids.npy", ids)
-        np.save(filename + "_colors.npy", colors)
+        """Save the retexture session to the directory filename, see session_store.
+        The first save to a directory and saves of a log outgrowing the snapshot
+        write a snapshot of all retextured points, the other saves only append the
+        changes since the last save. Files are written in the background.
+        The ids refer to the points of the scan files, even if they were merged on a
+        voxel grid, so saves stay valid with any voxel size."""
+        path = Path(filename)
+        if self._store is None or self._store.path != path:
+            self._close_store()
+            self._store = SessionStore(path)
+            snapshot = True
+        else:
+            snapshot = self._store.should_compact(self._deltas)
+        if snapshot:
+            scan_ids, ids = self._scan_ids(self.retextured_point_ids)
+            self._store.write_snapshot(
+                scan_ids, self._saved_colors(ids), self.layers[ids], self.generation
+            )
+        else:
+            self._store.append([self._scan_delta(delta) for delta in self._deltas])
+        self._deltas = []
 
+    @tracing.traced
     def load(self, filename: str) -> None:
-        """Load two .npy files and retexture the point cloud."""
+        """Load a saved session and retexture the point cloud, later saves to the same
+        directory append to it. Sessions of the former .npy files are loaded too."""
+        path = Path(filename)
+        if not (path / "session.json").exists():
+            self._load_npy(filename)
+            return
+        self.reset()
+        if self._store is None or self._store.path != path:
+            self._close_store()
+            self._store = SessionStore(path)
+        snapshot, deltas = self._store.read()
+        self._set_scan_colors(snapshot.ids, snapshot.colors, snapshot.layers)
+        self.generation = snapshot.generation
+        for delta in deltas:
+            if delta.kind == "retexture":
+                self._set_scan_colors(delta.ids, delta.colors, delta.generation)
+                self.generation = delta.generation
+            elif delta.kind == "undo":
+                self.undo(self.generation - delta.generation)
+            elif delta.kind == "reset":
+                self.reset()
+        self._deltas = []
+
+    def _load_npy(self, filename: str) -> None:
         self.reset()
         ids = np.load(filename + "_ids.npy")
         colors = np.load(filename + "_colors.npy")
+        layers_file = Path(filename + "_layers.npy")
+        # saves without layers are restored as a single generation
+        layers = np.load(layers_file) if layers_file.exists() else 1
+        self._set_scan_colors(ids, colors, layers)
+        self.generation = int(self.layers.max(initial=0))
+        self._deltas = []
+
+    def _set_scan_colors(self, scan_ids: np.ndarray, colors, layers) -> None:
+        ids = scan_ids
+        if self.pcd.voxel_index is not None:
+            # merged points take the values of the last scan point saved
+            ids = self.pcd.voxel_index[scan_ids]
         self.pcd.set_color(ids, colors)
-        self.retextured_points.update(ids)
+        self.layers[ids] = layers
+
+    def _scan_delta(self, delta: Delta) -> Delta:
+        """Return the delta with the ids of the scan points merged into its points."""
+        if delta.ids is None:
+            return delta
+        scan_ids, ids = self._scan_ids(delta.ids)
+        if scan_ids is delta.ids:
+            return delta
+        # position of the last occurrence of every point, the color it was set to
+        order = np.argsort(delta.ids, kind="stable")
+        positions = order[np.searchsorted(delta.ids[order], ids, side="right") - 1]
+        return Delta(
+            delta.kind,
+            delta.generation,
+            scan_ids,
+            delta.colors[positions],
+            delta.pose,
+            delta.prompt,
+        )
+
+    def _record(self, delta: Delta) -> None:
+        # without a session, the next save writes a snapshot anyway
+        if self._store is not None:
+            self._deltas.append(delta)
+
+    def _close_store(self) -> None:
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _scan_ids(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the ids of the scan points merged into the points of ids and the
+        point of each of them. Ids of a filtered point cloud are mapped to the
+        points they were filtered from first."""
+        original_ids = ids
+        if self._original_index is not None:
+            original_ids = self._original_index[ids]
+        voxel_index = self.pcd.voxel_index
+        if voxel_index is None:
+            return original_ids, ids
+        selected = np.zeros(len(self.original_points), dtype=bool)
+        selected[original_ids] = True
+        scan_ids = np.flatnonzero(selected[voxel_index])
+        if self._original_index is None:
+            return scan_ids, voxel_index[scan_ids]
+        point_of_original = np.empty(len(self.original_points), dtype=np.int64)
+        point_of_original[original_ids] = ids
+        return scan_ids, point_of_original[voxel_index[scan_ids]]
 
     def reset(self) -> None:
         """Reset the point cloud to its original state."""
-        self.pcd.set_pcd(self.original_points.copy(), self.original_colors.copy())
-        self.retextured_points.clear()
+        if self._original_index is None:
+            self.pcd.set_color(slice(None), self.original_colors)
+            self.layers.fill(0)
+        else:
+            self.pcd.set_pcd(self.original_points, self.original_colors.copy())
+            self.layers = np.zeros(len(self.original_points), dtype=np.uint16)
+            self._original_index = None
+        self._unflag(self._flag_ids)
+        self.generation = 0
+        self._record(Delta("reset"))
 
+    @tracing.traced
     def mask_retextured(self, ids: np.ndarray) -> np.ndarray:
         """Given a 2D ids array, mask seen ids with 1, and unseen ids with 0."""
-        mask = np.zeros_like(ids, dtype=np.uint8)
-        debug = np.zeros((*ids.shape, 3), dtype=np.uint8)
-        mask_count = 0
-        for x in range(ids.shape[1]):
-            for y in range(ids.shape[0]):
-                id = ids[y, x]
-                if id == PointCloud.EMPTY:
-                    debug[y, x] = [0, 0, 0]
-                    mask[y, x] = 1
-                    continue
-                if id in self.retextured_points:
-                    debug[y, x] = [0, 255, 0]
-                    mask[y, x] = 0
-                    mask_count += 1
-                else:
-                    debug[y, x] = [255, 0, 0]
-                    mask[y, x] = 1
+        empty = ids == PointCloud.EMPTY
+        seen = ~empty
+        seen[seen] = self.layers[ids[seen]] != 0
+        mask = (~seen).astype(np.uint8)
+        mask_count = int(np.count_nonzero(seen))
 
         if self.debug:
             print(f"Keeping the color of {mask_count} points.")
+            debug = np.zeros((*ids.shape, 3), dtype=np.uint8)
+            debug[~empty] = [255, 0, 0]
+            debug[seen] = [0, 255, 0]
             Image.fromarray(debug, mode="RGB").show()
 
         mask_ratio = mask_count / (ids.shape[0] * ids.shape[1])
@@ -169,14 +455,50 @@ class SDPointCloud:
         return mask
 
 
+def _original(colors: np.ndarray) -> np.ndarray:
+    if isinstance(colors, np.memmap) and colors.mode == "c":
+        # unmodified pages are shared with the file, the copy-on-write map never
+        # writes back to it
+        return np.memmap(
+            colors.filename,
+            dtype=colors.dtype,
+            mode="r",
+            offset=colors.offset,
+            shape=colors.shape,
+        )
+    return colors.copy()
+
+
 # TODO(memben): Slighly shifts the point cloud one pixel to the bottom and right.
-def normalize(points: np.ndarray) -> np.ndarray:
+def normalize(points: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Scale the points into [-1, 1] along their largest extent, as float32.
+    Computed in chunks without temporary copies, out may be points itself."""
     min_coords = np.min(points, axis=0)
     max_coords = np.max(points, axis=0)
     ranges = max_coords - min_coords
     scaling_factor = 2.0 / np.max(ranges)
-    normalized_points = (points - min_coords) * scaling_factor - 1.0
-    return normalized_points
+    if out is None:
+        out = np.empty(points.shape, dtype=np.float32)
+    for start in range(0, len(points), CHUNK_SIZE):
+        chunk = out[start : start + CHUNK_SIZE]
+        np.subtract(points[start : start + CHUNK_SIZE], min_coords, out=chunk)
+        chunk *= scaling_factor
+        chunk -= 1.0
+    return out
+
+
+def dirty_ranges(ids, n_points: int) -> np.ndarray:
+    """Return the sorted (start, stop) ranges covering the ids, ranges closer than
+    PointCloud.DIRTY_RANGE_GAP are merged."""
+    if isinstance(ids, slice):
+        return np.array([ids.indices(n_points)[:2]])
+    ids = np.unique(ids)
+    if len(ids) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(ids) > PointCloud.DIRTY_RANGE_GAP)
+    starts = ids[np.concatenate(([0], breaks + 1))]
+    stops = ids[np.concatenate((breaks, [len(ids) - 1]))] + 1
+    return np.stack((starts, stops), axis=1).astype(np.int64)
 
 
 def flatten_and_filter(ids: np.ndarray) -> np.ndarray:
@@ -184,3 +506,283 @@ def flatten_and_filter(ids: np.ndarray) -> np.ndarray:
     ids = ids.flatten()
     ids = ids[ids != PointCloud.EMPTY]
     return ids
+
+
+def _random_capture(width: int, height: int, seed: int = 0):
+    """Create a point cloud, a texture and an ids array resembling a screen capture."""
+    rng = np.random.default_rng(seed)
+    n_points = width * height
+    pcd = PointCloud(rng.random((n_points, 3)), rng.random((n_points, 3)))
+    # a point may cover several pixels, and some pixels stay empty
+    ids = rng.integers(0, n_points, size=(height, width)).astype(np.uint32)
+    ids[rng.random((height, width)) < 0.2] = PointCloud.EMPTY
+    texture = Image.fromarray(
+        rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8), mode="RGB"
+    )
+    return pcd, texture, ids
+
+
+def _retexture_loop(
+    pcd: PointCloud, retextured_points: set, texture: Image, ids: np.ndarray
+) -> None:
+    """Per-pixel reference implementation of SDPointCloud.retexture."""
+    retexture_ids = []
+    retexture_colors = []
+    for y in range(texture.height):
+        for x in range(texture.width):
+            id = ids[y, x]
+            if id == PointCloud.EMPTY:
+                continue
+            if id in retextured_points:
+                continue
+            color = texture.getpixel((x, y))
+            color = np.array(color, dtype=np.float32) / 255.0
+            retexture_ids.append(id)
+            retexture_colors.append(color)
+    retexture_ids = np.array(retexture_ids)
+    retexture_colors = np.array(retexture_colors)
+    pcd.set_color(retexture_ids, retexture_colors)
+    retextured_points.update(retexture_ids)
+
+
+def _mask_retextured_loop(retextured_points: set, ids: np.ndarray) -> np.ndarray:
+    """Per-pixel reference implementation of SDPointCloud.mask_retextured."""
+    mask = np.zeros_like(ids, dtype=np.uint8)
+    for x in range(ids.shape[1]):
+        for y in range(ids.shape[0]):
+            id = ids[y, x]
+            if id == PointCloud.EMPTY or id not in retextured_points:
+                mask[y, x] = 1
+    return mask
+
+
+def test_retexture_parity():
+    width, height = 128, 96
+    pcd, texture, ids = _random_capture(width, height)
+    _, second_texture, second_ids = _random_capture(width, height, seed=1)
+    sd_pcd = SDPointCloud(pcd)
+    reference = PointCloud(pcd._points, pcd._colors.copy())
+    retextured_points = set()
+
+    for view_texture, view_ids in ((texture, ids), (second_texture, second_ids)):
+        # the second view overlaps the first one, its points must keep their color
+        sd_pcd.retexture(view_texture, view_ids)
+        _retexture_loop(reference, retextured_points, view_texture, view_ids)
+
+    assert set(sd_pcd.retextured_point_ids) == retextured_points
+    assert np.array_equal(sd_pcd.pcd._colors, reference._colors)
+    mask = sd_pcd.mask_retextured(second_ids)
+    assert np.array_equal(mask, _mask_retextured_loop(retextured_points, second_ids))
+    print("retexture and mask_retextured match the per-pixel reference.")
+
+
+def test_undo():
+    pcd, texture, ids = _random_capture(64, 64)
+    _, second_texture, second_ids = _random_capture(64, 64, seed=1)
+    sd_pcd = SDPointCloud(pcd)
+    sd_pcd.retexture(texture, ids)
+    first_colors = sd_pcd.pcd._colors.copy()
+    first_layers = sd_pcd.layers.copy()
+    sd_pcd.retexture(second_texture, second_ids)
+
+    sd_pcd.undo()
+    assert np.array_equal(sd_pcd.pcd._colors, first_colors)
+    assert np.array_equal(sd_pcd.layers, first_layers)
+    sd_pcd.undo(5)
+    assert np.array_equal(sd_pcd.pcd._colors, sd_pcd.original_colors)
+    assert sd_pcd.generation == 0 and not sd_pcd.layers.any()
+    print("undo restores previous generations.")
+
+
+def test_retexture_projected():
+    width, height = 64, 48
+    pcd, texture, ids = _random_capture(width, height)
+    rng = np.random.default_rng(2)
+    # every third point projects to a random pixel, some of them won another pixel
+    point_ids = np.arange(0, len(pcd._colors), 3, dtype=np.uint32)
+    pixels = rng.integers(0, width * height, size=len(point_ids))
+    sd_pcd = SDPointCloud(pcd)
+    sd_pcd.retexture(texture, ids, (point_ids, pixels))
+
+    texture_colors = np.asarray(texture).reshape(-1, 3).astype(np.float32) / 255.0
+    assert np.array_equal(sd_pcd.pcd._colors[point_ids], texture_colors[pixels])
+    winners = np.setdiff1d(ids[ids != PointCloud.EMPTY], point_ids)
+    expected = set(winners) | set(point_ids)
+    assert set(sd_pcd.retextured_point_ids) == expected
+    print("retexture colors projected points from the pixel they project to.")
+
+
+def test_voxel_save():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = str(Path(tmp_dir) / "voxel_save")
+        rng = np.random.default_rng(0)
+        # 8 scan points merged into 4 points
+        voxel_index = np.array([0, 1, 2, 3, 3, 2, 1, 0], dtype=np.uint32)
+        pcd = PointCloud(
+            rng.random((4, 3)), rng.random((4, 3)), voxel_index=voxel_index
+        )
+        sd_pcd = SDPointCloud(pcd)
+        sd_pcd.pcd.set_color([1, 3], np.zeros(3))
+        sd_pcd.layers[[1, 3]] = 1
+        sd_pcd.save(filename)
+        sd_pcd._close_store()
+        assert np.array_equal(SessionStore(filename).read()[0].ids, [1, 3, 4, 6])
+
+        loaded = SDPointCloud(PointCloud(pcd._points, sd_pcd.original_colors.copy()))
+        loaded.pcd.voxel_index = voxel_index
+        loaded.load(filename)
+        assert np.array_equal(loaded.pcd._colors, sd_pcd.pcd._colors)
+        assert np.array_equal(loaded.layers, sd_pcd.layers)
+        loaded._close_store()
+
+        # ids of a filtered point cloud are mapped back to the scan points
+        sd_pcd.filter(np.array([3, 1, 2]))
+        sd_pcd.retexture(Image.new("RGB", (1, 1)), np.array([[2]]))
+        sd_pcd.save(filename)
+        sd_pcd._close_store()
+        assert np.array_equal(SessionStore(filename).read()[0].ids, [1, 2, 3, 4, 5, 6])
+        loaded.load(filename)
+        loaded._close_store()
+        assert np.array_equal(loaded.pcd._colors[[3, 1, 2]], sd_pcd.pcd._colors)
+        assert np.array_equal(loaded.layers[[3, 1, 2]], sd_pcd.layers)
+        print("Saves of merged points refer to the scan points.")
+
+
+def test_session_save():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = str(Path(tmp_dir) / "session_save")
+        pcd, texture, ids = _random_capture(64, 64)
+        n_points = len(pcd._points)
+        # every point is merged from two scan points
+        voxel_index = np.tile(np.arange(n_points, dtype=np.uint32), 2)
+        pcd.voxel_index = voxel_index
+        sd_pcd = SDPointCloud(pcd)
+        sd_pcd.retexture(texture, ids)
+        sd_pcd.save(filename)
+        snapshot_file = Path(filename) / "snapshot_colors_0.npy"
+        for seed in (1, 2):
+            _, view_texture, view_ids = _random_capture(64, 64, seed=seed)
+            sd_pcd.retexture(
+                view_texture, view_ids, pose=np.eye(4), prompt=f"view {seed}"
+            )
+        sd_pcd.undo()
+        sd_pcd.save(filename)
+        _, view_texture, view_ids = _random_capture(64, 64, seed=3)
+        sd_pcd.retexture(view_texture, view_ids)
+        sd_pcd.save(filename)
+        sd_pcd._store.flush()
+        # only the first save wrote a snapshot, the others appended to the log
+        assert sorted(f.name for f in Path(filename).glob("snapshot_*")) == [
+            "snapshot_colors_0.npy",
+            "snapshot_ids_0.npy",
+            "snapshot_layers_0.npy",
+        ]
+        _, deltas = SessionStore(filename).read()
+        kinds = [delta.kind for delta in deltas]
+        assert kinds == ["retexture", "retexture", "undo", "retexture"]
+        assert deltas[1].prompt == "view 2" and deltas[2].generation == 2
+
+        loaded = SDPointCloud(PointCloud(pcd._points, sd_pcd.original_colors.copy()))
+        loaded.pcd.voxel_index = voxel_index
+        loaded.load(filename)
+        assert np.array_equal(loaded.pcd._colors, sd_pcd.pcd._colors)
+        assert np.array_equal(loaded.layers, sd_pcd.layers)
+        assert loaded.generation == sd_pcd.generation == 3
+        # saving the loaded session appends as well
+        loaded.undo()
+        loaded.save(filename)
+        loaded._close_store()
+        sd_pcd.load(filename)
+        assert np.array_equal(sd_pcd.layers, loaded.layers) and snapshot_file.exists()
+        sd_pcd._close_store()
+        print("Saves append the changes of every view to the session.")
+
+
+def test_flag_save():
+    import tempfile
+
+    pcd, texture, ids = _random_capture(64, 64)
+    n_points = len(pcd._points)
+    sd_pcd = SDPointCloud(pcd)
+    sd_pcd.retexture(texture, ids)
+    # flags of retextured and untouched points are shown but not saved
+    sd_pcd.flag(np.arange(0, n_points, 7))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sd_pcd.save(tmp_dir)
+        _, view_texture, view_ids = _random_capture(64, 64, seed=1)
+        sd_pcd.retexture(view_texture, view_ids)
+        sd_pcd.save(tmp_dir)
+        sd_pcd._close_store()
+        loaded = SDPointCloud(PointCloud(pcd._points, sd_pcd.original_colors.copy()))
+        loaded.load(tmp_dir)
+        loaded._close_store()
+    flagged = sd_pcd._flag_ids
+    assert len(flagged) > 0 and (sd_pcd.pcd._colors[flagged] == [1, 0, 0]).all()
+    assert np.array_equal(loaded.pcd._colors, sd_pcd._saved_colors(np.arange(n_points)))
+    assert np.array_equal(loaded.layers, sd_pcd.layers)
+    assert (loaded.pcd._colors[flagged] != [1, 0, 0]).any(axis=1).all()
+    print("Flagged points are saved with their colors from before the flag.")
+
+
+def test_normalize():
+    rng = np.random.default_rng(0)
+    points = (rng.random((CHUNK_SIZE + 1000, 3)) * [4e5, 2e5, 1e4]).astype(np.float32)
+    lower = points.min(axis=0)
+    expected = (points - lower) * (2.0 / np.max(points.max(axis=0) - lower)) - 1.0
+    normalized = normalize(points)
+    assert normalized.dtype == np.float32
+    assert np.allclose(normalized, expected, atol=1e-6)
+    assert normalize(points, out=points) is points
+    assert np.array_equal(points, normalized)
+    print("normalize works in place on float32 points.")
+
+
+def test_dirty_ranges():
+    gap = PointCloud.DIRTY_RANGE_GAP
+    ids = np.array([5, 3, 4, 5 + gap, 20 + 3 * gap])
+    expected = [[3, 6 + gap], [20 + 3 * gap, 21 + 3 * gap]]
+    assert dirty_ranges(ids, 200 + 3 * gap).tolist() == expected
+    assert dirty_ranges(slice(None), 42).tolist() == [[0, 42]]
+    assert dirty_ranges(np.array([], dtype=np.uint32), 42).shape == (0, 2)
+    print("dirty_ranges merges close ids.")
+
+
+def benchmark_retexture(resolutions=(256, 512, 1024)):
+    import time
+
+    for size in resolutions:
+        pcd, texture, ids = _random_capture(size, size)
+
+        reference = PointCloud(pcd._points, pcd._colors.copy())
+        retextured_points = set()
+        start = time.perf_counter()
+        _retexture_loop(reference, retextured_points, texture, ids)
+        _mask_retextured_loop(retextured_points, ids)
+        loop = time.perf_counter() - start
+
+        sd_pcd = SDPointCloud(PointCloud(pcd._points, pcd._colors.copy()))
+        start = time.perf_counter()
+        sd_pcd.retexture(texture, ids)
+        sd_pcd.mask_retextured(ids)
+        vectorized = time.perf_counter() - start
+
+        print(
+            f"{size}x{size}: loop {loop:.3f}s, numpy {vectorized:.4f}s, "
+            f"speedup {loop / vectorized:.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    test_retexture_parity()
+    test_undo()
+    test_retexture_projected()
+    test_voxel_save()
+    test_session_save()
+    test_flag_save()
+    test_normalize()
+    test_dirty_ranges()
+    benchmark_retexture()
@@ -0,0 +1,152 @@
+from dataclasses import dataclass, field
+
+import moderngl
+import numpy as np
+from PIL import Image
+
+import depth_utils
+import point_cloud_rendering_utils as pcru
+import tracing
+from gpu_resources import GPUResources
+from pointcloud import PointCloud
+
+
+@dataclass
+class ScreenCapture:
+    # (height, width, 3) screen pixels, a view of a pooled host array
+    color: np.ndarray
+    # filtered 8-bit depth map, a view of a pooled host array
+    depth: np.ndarray
+    width: int
+    height: int
+    ids: np.ndarray
+    # unfiltered point id of every pixel, EMPTY where no point was rendered
+    raw_ids: np.ndarray = None
+    # (point ids, pixel indices) of all points seen, see pcru.project_points
+    projected: tuple = None
+    # MVP matrix of the captured view
+    mvp: np.ndarray = None
+    resources: GPUResources = field(default=None, repr=False)
+
+    @property
+    def color_image(self) -> Image.Image:
+        return Image.fromarray(self.color)
+
+    @property
+    def depth_image(self) -> Image.Image:
+        return Image.fromarray(self.depth, mode="L")
+
+    def release(self) -> None:
+        """Return the pooled arrays, the capture can't be used afterwards."""
+        if self.resources is None:
+            return
+        self.resources.release_host_array(self.color)
+        self.resources.release_host_array(self.raw_ids)
+        self.resources.release_host_array(self.depth)
+        self.resources = None
+
+
+class PendingScreenCapture:
+    """Screen capture whose pixels are still transferred, see begin_screen_capture."""
+
+    def __init__(self, pending: pcru.PendingCapture, mvp: np.ndarray, debug):
+        self.pending = pending
+        self.mvp = mvp
+        self.debug = debug
+
+    def result(self) -> ScreenCapture:
+        return _screen_capture(
+            self.pending.ctx, self.mvp, *self.pending.result(), self.debug
+        )
+
+
+@tracing.traced
+def create_screen_capture(
+    ctx: moderngl.Context,
+    pcd: PointCloud,
+    mvp: np.ndarray,
+    width: int,
+    height: int,
+    debug: bool = False,
+) -> ScreenCapture:
+    """Capture the point cloud, call release() on the capture once it is consumed
+    to reuse its arrays."""
+    arrays = pcru.capture_maps(ctx, pcd, mvp, width, height)
+    return _screen_capture(ctx, mvp, *arrays, debug)
+
+
+@tracing.traced
+def begin_screen_capture(
+    ctx: moderngl.Context,
+    pcd: PointCloud,
+    mvp: np.ndarray,
+    width: int,
+    height: int,
+    debug: bool = False,
+) -> PendingScreenCapture:
+    """Like create_screen_capture, but the pixels are transferred in the background
+    until result() is called, e.g. after the next frame was rendered."""
+    pending = pcru.capture_maps(ctx, pcd, mvp, width, height, asynchronous=True)
+    return PendingScreenCapture(pending, mvp, debug)
+
+
+def _screen_capture(
+    ctx: moderngl.Context, mvp, color, raw_ids, depth, depth_filtered, projected, debug
+) -> ScreenCapture:
+    resources = GPUResources.of(ctx)
+    height, width = raw_ids.shape
+    # unlike the pooled arrays, filter_ids allocates the filtered ids every capture
+    ids, ids_removed = depth_utils.filter_ids(
+        raw_ids, depth_filtered, depth, debug=debug
+    )
+    resources.release_host_array(depth)
+    projected = _remove_rejected(projected, ids_removed)
+    capture = ScreenCapture(
+        color, depth_filtered, width, height, ids, raw_ids, projected, mvp, resources
+    )
+    if debug:
+        capture.color_image.show("Screen Image")
+    return capture
+
+
+def _remove_rejected(projected: tuple, ids_removed: np.ndarray) -> tuple:
+    """Drop the projected points rejected by filter_ids and those projecting to their
+    pixels, which were within tolerance of the rejected points, not of the surface."""
+    ids_removed = ids_removed.reshape(-1)
+    rejected = ids_removed != PointCloud.EMPTY
+    if not rejected.any():
+        return projected
+    point_ids, pixels = projected
+    keep = ~rejected[pixels] & ~np.isin(point_ids, ids_removed[rejected])
+    return point_ids[keep], pixels[keep]
+
+
+def test_rejected_outlier():
+    from pointcloud import SDPointCloud
+
+    width, height = 128, 128
+    rng = np.random.default_rng(0)
+    # a dense slanted plane and an outlier floating in front of it
+    xy = rng.random((4 * width * height, 2)) * 2 - 1
+    points = np.column_stack((xy, 0.3 * xy[:, 0]))
+    points = np.vstack((points, [[0.1, 0.1, -0.5]]))
+    pcd = PointCloud(points, np.zeros_like(points))
+    outlier = len(points) - 1
+    mvp = np.eye(4, dtype=np.float32)
+    mvp[3, 2] = 0.5
+    ctx = moderngl.create_standalone_context()
+    capture = create_screen_capture(ctx, pcd, mvp, width, height)
+    assert outlier in capture.raw_ids and outlier not in capture.ids
+    assert capture.mvp is mvp
+    assert outlier not in capture.projected[0]
+    sd_pcd = SDPointCloud(pcd)
+    texture = Image.new("RGB", (width, height), (255, 255, 255))
+    sd_pcd.retexture(texture, capture.ids, capture.projected)
+    assert (sd_pcd.pcd._colors[outlier] == 0).all()
+    assert sd_pcd.layers[:outlier].any()
+    capture.release()
+    print("Outliers rejected by filter_ids keep their colors.")
+
+
+if __name__ == "__main__":
+    test_rejected_outlier()
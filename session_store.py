@@ -0,0 +1,343 @@
+import io
+import json
+import os
+import re
+import struct
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+import tracing
+
+SESSION_VERSION = 1
+# points per compressed log record, bounds the memory of compressing a large view
+RECORD_SIZE = 2**20
+# the log is compacted once it outgrows the snapshot and this many bytes
+MIN_COMPACT_SIZE = 2**24
+_LENGTH = struct.Struct("<Q")
+# the files of a store, with the index of their snapshot
+_SESSION_FILE = re.compile(
+    r"(?:snapshot_(?:ids|colors|layers)_(\d+)\.npy|log_(\d+)\.bin)(?:\.[0-9a-f]{32}\.tmp)?"
+)
+
+
+@dataclass
+class Delta:
+    """A change of the retexture state, the ids refer to the points of the scan files.
+    A "retexture" sets the colors of the ids in generation, an "undo" discards the
+    generations after generation and a "reset" restores all original colors."""
+
+    kind: str
+    generation: int = 0
+    ids: np.ndarray = None
+    colors: np.ndarray = None
+    # MVP matrix and prompt of the view that was retextured
+    pose: np.ndarray = None
+    prompt: str = None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.ids, self.colors) if a is not None)
+
+
+@dataclass
+class Snapshot:
+    """Retexture state of all points of a session, read-only memory maps."""
+
+    ids: np.ndarray
+    colors: np.ndarray
+    layers: np.ndarray
+    generation: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.colors.nbytes + self.layers.nbytes
+
+
+class SessionStore:
+    """Retexture session in a directory: a snapshot of uncompressed .npy files and
+    an append-only log of compressed deltas since the snapshot.
+
+    Loading maps the snapshot and replays the log, saving appends the new deltas.
+    Once the log outgrows the snapshot, should_compact() asks for a new snapshot,
+    which replaces the old one and starts an empty log. All writes run in order on
+    a background thread, call flush() to wait for them. A crash leaves the previous
+    snapshot and the complete records of the log."""
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._writes = []
+        manifest = self.path / "session.json"
+        self._manifest = json.loads(manifest.read_text()) if manifest.exists() else None
+        # uncompressed bytes of the snapshot and the log, estimated on the caller's
+        # thread so compaction doesn't wait for the writer
+        self._snapshot_size = 0
+        self._log_size = 0
+        # the log was read or started, appends know where it ends
+        self._appendable = False
+        # end of the last complete record, only changed by the writer once appendable,
+        # a torn tail is truncated before appends
+        self._log_end = 0
+
+    @property
+    def exists(self) -> bool:
+        return self._manifest is not None
+
+    def _file(self, name: str, index: int = None) -> Path:
+        index = self._manifest["index"] if index is None else index
+        return self.path / f"{name}_{index}.{'bin' if name == 'log' else 'npy'}"
+
+    def read(self) -> tuple[Snapshot, list[Delta]]:
+        """Return the snapshot and the deltas of the log, in the order they were saved."""
+        self.flush()
+        if not self.exists:
+            raise FileNotFoundError(f"No retexture session in {self.path}.")
+        snapshot = Snapshot(
+            *(
+                np.load(self._file(f"snapshot_{name}"), mmap_mode="r")
+                for name in ("ids", "colors", "layers")
+            ),
+            self._manifest["generation"],
+        )
+        deltas = []
+        self._log_end = 0
+        with tracing.span("read log"), open(self._file("log"), "rb") as log:
+            while len(header := log.read(_LENGTH.size)) == _LENGTH.size:
+                record = log.read(_LENGTH.unpack(header)[0])
+                if len(record) < _LENGTH.unpack(header)[0]:
+                    break
+                deltas.append(_decode(record))
+                self._log_end = log.tell()
+        self._snapshot_size = snapshot.nbytes
+        self._log_size = sum(delta.nbytes for delta in deltas)
+        self._appendable = True
+        return snapshot, deltas
+
+    def should_compact(self, deltas: list[Delta] = ()) -> bool:
+        """Whether the log with the deltas outgrows the snapshot."""
+        size = self._log_size + sum(delta.nbytes for delta in deltas)
+        return size > max(self._snapshot_size, MIN_COMPACT_SIZE)
+
+    def append(self, deltas: list[Delta]) -> None:
+        """Append the deltas to the log in the background."""
+        if not self._appendable:
+            raise RuntimeError("Write a snapshot or read the session before appends.")
+        self._log_size += sum(delta.nbytes for delta in deltas)
+        log_file = self._file("log")
+
+        @tracing.traced(name="session_store.append")
+        def write():
+            with open(log_file, "r+b") as log:
+                log.truncate(self._log_end)
+                log.seek(self._log_end)
+                for delta in deltas:
+                    for record in _encode(delta):
+                        log.write(_LENGTH.pack(len(record)))
+                        log.write(record)
+                log.flush()
+                os.fsync(log.fileno())
+                self._log_end = log.tell()
+
+        self._submit(write)
+
+    def write_snapshot(
+        self, ids: np.ndarray, colors: np.ndarray, layers: np.ndarray, generation: int
+    ) -> None:
+        """Replace the session by the state of the ids in the background and start
+        an empty log. The arrays must not be modified afterwards."""
+        old_index = None if self._manifest is None else self._manifest["index"]
+        manifest = {
+            "version": SESSION_VERSION,
+            "index": 0 if old_index is None else old_index + 1,
+            "generation": int(generation),
+        }
+        self._manifest = manifest
+        self._snapshot_size = ids.nbytes + colors.nbytes + layers.nbytes
+        self._log_size = 0
+        self._appendable = True
+        files = {
+            name: self._file(f"snapshot_{name}", manifest["index"])
+            for name in ("ids", "colors", "layers")
+        }
+        log_file = self._file("log", manifest["index"])
+
+        @tracing.traced(name="session_store.write_snapshot")
+        def write():
+            self.path.mkdir(parents=True, exist_ok=True)
+            for name, array in zip(files, (ids, colors, layers)):
+                write_atomic(files[name], lambda f: np.save(f, array))
+            log_file.write_bytes(b"")
+            self._log_end = 0
+            # switching the manifest commits the snapshot
+            manifest_text = json.dumps(manifest).encode()
+            write_atomic(self.path / "session.json", lambda f: f.write(manifest_text))
+            # older snapshots, also of sessions interrupted before their manifest,
+            # other files of the directory are left alone
+            for file in self.path.iterdir():
+                match = _SESSION_FILE.fullmatch(file.name)
+                if match and int(match[1] or match[2]) < manifest["index"]:
+                    file.unlink()
+
+        self._submit(write)
+
+    def _submit(self, write) -> None:
+        self._writes = [w for w in self._writes if not w.done() or w.exception()]
+        self._writes.append(self._writer.submit(write))
+
+    def flush(self) -> None:
+        """Wait until all writes finished, raise the error of a failed write."""
+        writes, self._writes = self._writes, []
+        for write in writes:
+            write.result()
+
+    def close(self) -> None:
+        self.flush()
+        self._writer.shutdown()
+
+
+def _encode(delta: Delta) -> list[bytes]:
+    """Return the compressed records of the delta, large deltas span several records."""
+    if delta.ids is None:
+        chunks = [{}]
+    else:
+        chunks = [
+            {
+                "ids": delta.ids[s : s + RECORD_SIZE],
+                "colors": delta.colors[s : s + RECORD_SIZE],
+            }
+            for s in range(0, max(len(delta.ids), 1), RECORD_SIZE)
+        ]
+    records = []
+    for chunk in chunks:
+        fields = {
+            "kind": np.array(delta.kind),
+            "generation": np.array(delta.generation),
+        }
+        if delta.pose is not None:
+            fields["pose"] = np.asarray(delta.pose, dtype=np.float32)
+        if delta.prompt is not None:
+            fields["prompt"] = np.array(delta.prompt)
+        record = io.BytesIO()
+        np.savez_compressed(record, **fields, **chunk)
+        records.append(record.getvalue())
+    return records
+
+
+def _decode(record: bytes) -> Delta:
+    with np.load(io.BytesIO(record)) as fields:
+        return Delta(
+            kind=str(fields["kind"]),
+            generation=int(fields["generation"]),
+            ids=fields["ids"] if "ids" in fields else None,
+            colors=fields["colors"] if "colors" in fields else None,
+            pose=fields["pose"] if "pose" in fields else None,
+            prompt=str(fields["prompt"]) if "prompt" in fields else None,
+        )
+
+
+def write_atomic(path: Path, write: callable) -> None:
+    """Write the file with write(f) and replace path with it, readers never see
+    partially written files. The temporary file has a unique name, so concurrent
+    writers of the same path don't collide and the last replace wins."""
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def test_session_store():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as path:
+        rng = np.random.default_rng(0)
+        store = SessionStore(path)
+        ids = np.arange(0, 100, 2, dtype=np.uint32)
+        colors = rng.random((len(ids), 3), dtype=np.float32)
+        store.write_snapshot(ids, colors, np.ones(len(ids), dtype=np.uint16), 1)
+        pose = np.eye(4, dtype=np.float32)
+        first_ids = np.array([1, 3], dtype=np.uint32)
+        deltas = [
+            Delta("retexture", 2, first_ids, colors[:2], pose, "a"),
+            Delta("undo", 1),
+            Delta("retexture", 2, np.array([5], dtype=np.uint32), colors[2:3]),
+        ]
+        store.append(deltas[:2])
+        store.append(deltas[2:])
+        store.close()
+        snapshot_file = Path(path) / "snapshot_colors_0.npy"
+        snapshot_mtime = snapshot_file.stat().st_mtime_ns
+
+        # a torn record at the end of the log is ignored and overwritten
+        with open(Path(path) / "log_0.bin", "ab") as log:
+            log.write(_LENGTH.pack(1000) + b"torn")
+        store = SessionStore(path)
+        snapshot, read_deltas = store.read()
+        assert isinstance(snapshot.colors, np.memmap) and snapshot.generation == 1
+        assert np.array_equal(snapshot.ids, ids)
+        assert np.array_equal(snapshot.colors, colors)
+        assert [d.kind for d in read_deltas] == ["retexture", "undo", "retexture"]
+        assert read_deltas[0].prompt == "a"
+        assert np.array_equal(read_deltas[0].pose, pose)
+        assert read_deltas[1].ids is None and read_deltas[1].generation == 1
+        assert np.array_equal(read_deltas[2].colors, colors[2:3])
+        store.append([Delta("reset")])
+        store.flush()
+        assert [d.kind for d in SessionStore(path).read()[1]][-1] == "reset"
+        assert snapshot_file.stat().st_mtime_ns == snapshot_mtime
+
+        # compaction replaces the snapshot and starts an empty log
+        big = Delta(
+            "retexture", 3, np.arange(2**21, dtype=np.uint32), np.zeros((2**21, 3))
+        )
+        assert store.should_compact([big])
+        # files of the user in the same directory survive the compaction
+        np.save(Path(path) / "scan_backup.npy", ids)
+        (Path(path) / "notes_v2.bin").write_bytes(b"notes")
+        store.write_snapshot(ids[:1], colors[:1], np.ones(1, dtype=np.uint16), 3)
+        store.close()
+        snapshot, read_deltas = SessionStore(path).read()
+        assert len(snapshot.ids) == 1 and snapshot.generation == 3 and not read_deltas
+        assert sorted(f.name for f in Path(path).iterdir()) == [
+            "log_1.bin",
+            "notes_v2.bin",
+            "scan_backup.npy",
+            "session.json",
+            "snapshot_colors_1.npy",
+            "snapshot_ids_1.npy",
+            "snapshot_layers_1.npy",
+        ]
+        print("Session store replays the snapshot and the appended deltas.")
+
+
+def test_write_atomic():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as path:
+        file = Path(path) / "index.json"
+        contents = [bytes([i]) * 2**16 for i in range(32)]
+        # concurrent writers of the same file don't collide on the temporary file
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            writes = [
+                pool.submit(write_atomic, file, lambda f, c=c: f.write(c))
+                for c in contents
+            ]
+            for write in writes:
+                write.result()
+        assert file.read_bytes() in contents
+        assert [f.name for f in Path(path).iterdir()] == ["index.json"]
+        print("Atomic writes of the same file don't collide.")
+
+
+if __name__ == "__main__":
+    test_session_store()
+    test_write_atomic()
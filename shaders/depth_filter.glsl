@@ -0,0 +1,164 @@
+#version 330
+
+#if defined VERTEX_SHADER
+
+void main()
+{
+    // a triangle covering the viewport, drawn without vertex buffers
+    vec2 position = vec2((gl_VertexID << 1) & 2, gl_VertexID & 2);
+    gl_Position = vec4(position * 2.0 - 1.0, 0.0, 1.0);
+}
+
+#elif defined FRAGMENT_SHADER
+
+// passes of depth_utils.create_depth_map, the depth is 1.0 where no point was rendered
+uniform sampler2D depth;
+
+// the boundary modes of scipy.ndimage, "reflect" repeats the edge pixel
+int reflect(int i, int n)
+{
+    return i < 0 ? -i - 1 : (i >= n ? 2 * n - i - 1 : i);
+}
+
+float reflected(ivec2 xy)
+{
+    ivec2 size = textureSize(depth, 0);
+    return texelFetch(depth, ivec2(reflect(xy.x, size.x), reflect(xy.y, size.y)), 0).r;
+}
+
+#if defined FILL_HOLES
+
+uniform int radius;
+out float f_depth;
+
+void main()
+{
+    ivec2 xy = ivec2(gl_FragCoord.xy);
+    ivec2 size = textureSize(depth, 0);
+    f_depth = texelFetch(depth, xy, 0).r;
+    if (f_depth < 1.0) {
+        return;
+    }
+    // mean of the valid neighbors, outside the image is empty
+    float sum = 0.0;
+    int count = 0;
+    for (int dy = -radius; dy <= radius; dy++) {
+        for (int dx = -radius; dx <= radius; dx++) {
+            ivec2 neighbor = xy + ivec2(dx, dy);
+            if (any(lessThan(neighbor, ivec2(0))) || any(greaterThanEqual(neighbor, size))) {
+                continue;
+            }
+            float d = texelFetch(depth, neighbor, 0).r;
+            if (d < 1.0) {
+                sum += d;
+                count++;
+            }
+        }
+    }
+    if (count > 0) {
+        f_depth = sum / float(count);
+    }
+}
+
+#elif defined MEDIAN
+
+out float f_depth;
+
+void main()
+{
+    ivec2 xy = ivec2(gl_FragCoord.xy);
+    float v[9];
+    for (int i = 0; i < 9; i++) {
+        v[i] = reflected(xy + ivec2(i % 3 - 1, i / 3 - 1));
+    }
+    // partial selection sort, the 5th smallest is the median
+    for (int i = 0; i < 5; i++) {
+        for (int j = i + 1; j < 9; j++) {
+            float low = min(v[i], v[j]);
+            v[j] = max(v[i], v[j]);
+            v[i] = low;
+        }
+    }
+    f_depth = v[4];
+}
+
+#elif defined GAUSSIAN
+
+// one axis of the separable filter, weights of the offsets 0 to GAUSSIAN
+uniform ivec2 direction;
+uniform float weights[GAUSSIAN + 1];
+out float f_depth;
+
+void main()
+{
+    ivec2 xy = ivec2(gl_FragCoord.xy);
+    float sum = weights[0] * reflected(xy);
+    for (int i = 1; i <= GAUSSIAN; i++) {
+        sum += weights[i] * (reflected(xy - i * direction) + reflected(xy + i * direction));
+    }
+    f_depth = sum;
+}
+
+#elif defined MIN_MAX
+
+// reduces blocks of block x block pixels to the (min, max) of the valid depths,
+// of the depth texture in the first pass and of the previous (min, max) afterwards
+uniform sampler2D range;
+uniform int block;
+uniform bool first;
+out vec2 f_range;
+
+void main()
+{
+    ivec2 xy = ivec2(gl_FragCoord.xy) * block;
+    ivec2 size = first ? textureSize(depth, 0) : textureSize(range, 0);
+    // empty blocks are (1, 0), neutral for min and max
+    f_range = vec2(1.0, 0.0);
+    for (int dy = 0; dy < block; dy++) {
+        for (int dx = 0; dx < block; dx++) {
+            ivec2 pixel = xy + ivec2(dx, dy);
+            if (any(greaterThanEqual(pixel, size))) {
+                continue;
+            }
+            if (first) {
+                float d = texelFetch(depth, pixel, 0).r;
+                if (d < 1.0) {
+                    f_range = vec2(min(f_range.x, d), max(f_range.y, d));
+                }
+            } else {
+                vec2 r = texelFetch(range, pixel, 0).rg;
+                f_range = vec2(min(f_range.x, r.x), max(f_range.y, r.y));
+            }
+        }
+    }
+}
+
+#elif defined QUANTIZE
+
+// 8-bit maps of the unfiltered and the filtered depth, near is bright
+uniform sampler2D filtered;
+uniform sampler2D range;
+layout(location = 0) out float f_depth;
+layout(location = 1) out float f_filtered;
+
+float quantize(float d, vec2 r)
+{
+    float step = (r.y - r.x) / 255.0;
+    if (d >= 1.0) {
+        d = r.y;
+    }
+    float q = clamp(roundEven((d - r.x) / step), 0.0, 255.0);
+    return (255.0 - q) / 255.0;
+}
+
+void main()
+{
+    ivec2 xy = ivec2(gl_FragCoord.xy);
+    vec2 r = texelFetch(range, ivec2(0), 0).rg;
+    f_depth = quantize(texelFetch(depth, xy, 0).r, r);
+    f_filtered = quantize(texelFetch(filtered, xy, 0).r, r);
+}
+
+#endif
+
+#endif
@@ -0,0 +1,36 @@
+#version 330
+
+#if defined VERTEX_SHADER
+
+in vec3 in_position;
+in vec3 in_color;
+
+out vec3 color;
+// id + 1 of the point, 0 is left for pixels without a point
+flat out uint id;
+
+uniform mat4 mvp;
+uniform float point_size;
+
+void main()
+{
+    gl_Position = mvp * vec4(in_position, 1);
+    gl_PointSize = point_size;
+    color = in_color;
+    id = uint(gl_VertexID) + 1u;
+}
+
+#elif defined FRAGMENT_SHADER
+
+in vec3 color;
+flat in uint id;
+
+layout(location = 0) out vec4 f_color;
+layout(location = 1) out uint f_id;
+
+void main() {
+    f_color = vec4(color, 1.0);
+    f_id = id;
+}
+
+#endif
@@ -1,4 +1,3 @@
-
 #version 330
 
 #if defined VERTEX_SHADER
@@ -7,32 +6,44 @@ in vec3 in_position;
 // color only for uniformity between shaders
 in vec3 in_color;
 
-out vec4 color;
+// id + 1 of the point, 0 is left for pixels without a point
+#if defined WIDE_IDS
+flat out uvec2 id;
+#else
+flat out uint id;
+#endif
 
 uniform mat4 mvp;
 uniform float point_size;
+// added to the vertex ids, (low, high) words in the wide mode
+uniform uvec2 id_offset;
 
 void main()
 {
-    float r, g, b, a;
     gl_Position = mvp * vec4(in_position, 1);
     gl_PointSize = point_size;
-    int vertex_index = gl_VertexID;
-
-    r = mod(vertex_index, 256.0) / 255.0;
-    g = mod(floor(vertex_index / 256.0), 256.0) / 255.0;
-    b = mod(floor(vertex_index / 65536.0), 256.0) / 255.0;
-    a = floor(vertex_index / 16777216.0) / 255.0;
-    color = vec4(r, g, b, a);
+    uint low = id_offset.x + uint(gl_VertexID) + 1u;
+#if defined WIDE_IDS
+    // carry of the 32-bit addition into the high word
+    uint carry = low < id_offset.x ? 1u : 0u;
+    id = uvec2(low, id_offset.y + carry);
+#else
+    id = low;
+#endif
 }
 
 #elif defined FRAGMENT_SHADER
 
-in vec4 color;
-out vec4 f_color;
+#if defined WIDE_IDS
+flat in uvec2 id;
+out uvec2 f_id;
+#else
+flat in uint id;
+out uint f_id;
+#endif
 
 void main() {
-    f_color = color;
+    f_id = id;
 }
 
-#endif
\ No newline at end of file
+#endif
@@ -0,0 +1,49 @@
+#version 330
+
+#if defined VERTEX_SHADER
+
+in vec3 in_position;
+
+// pixel of the point, rows from top to bottom, -1 if the point is not visible
+out int pixel;
+
+uniform mat4 mvp;
+uniform mat4 inverse_mvp;
+// depth buffer of the capture, 1.0 where no point was rendered
+uniform sampler2D depth;
+// distance to the captured surface in pixel footprints, the width of a pixel there
+uniform float tolerance;
+
+vec3 unproject(vec2 ndc_xy, float d)
+{
+    vec4 p = inverse_mvp * vec4(ndc_xy, d * 2.0 - 1.0, 1.0);
+    return p.xyz / p.w;
+}
+
+void main()
+{
+    pixel = -1;
+    vec4 clip = mvp * vec4(in_position, 1);
+    if (clip.w <= 0.0) {
+        return;
+    }
+    vec3 ndc = clip.xyz / clip.w;
+    if (any(greaterThan(abs(ndc), vec3(1.0)))) {
+        return;
+    }
+    ivec2 size = textureSize(depth, 0);
+    ivec2 xy = min(ivec2((ndc.xy * 0.5 + 0.5) * vec2(size)), size - 1);
+    float surface_depth = texelFetch(depth, xy, 0).r;
+    if (surface_depth >= 1.0) {
+        return;
+    }
+    // the captured surface on the view ray through the point, and one pixel beside it
+    vec3 surface = unproject(ndc.xy, surface_depth);
+    vec3 beside = unproject(ndc.xy + vec2(2.0 / float(size.x), 0.0), surface_depth);
+    if (distance(surface, in_position) > tolerance * distance(surface, beside)) {
+        return;
+    }
+    pixel = (size.y - 1 - xy.y) * size.x + xy.x;
+}
+
+#endif
@@ -1,14 +1,20 @@
 import fire
 
-from gen_control import SDParams, generate
+import tracing
+from batch_control import create_context, retexture_batch
+from gen_control import GenerationQueue, capture_params
+from orbit_control import OrbitScheduler
 from pcd_io import read_pcd
 from pointcloud import SDPointCloud
-from view_control import ScreenCapture, ViewControl
+from screen_capture import ScreenCapture
+from view_control import ViewControl
+from webui_api import configure_client
 
 # best performant image size for SD
 WINDOW_WIDTH = 512
 WINDOW_HEIGHT = 512
 
+
 class StableScanCLI:
     def run(
         self,
@@ -17,6 +23,14 @@ class StableScanCLI:
         webui_api: str = "http://127.0.0.1:7860",
         width: int = WINDOW_WIDTH,
         height: int = WINDOW_HEIGHT,
+        cache: bool = True,
+        voxel_size: float = None,
+        views: int = 8,
+        batch_size: int = 1,
+        trace: str = None,
+        trace_memory: bool = False,
+        timeout: float = 600.0,
+        retries: int = 3,
     ):
         """Run the stablescan viewer with the given files.
         Navigate to desired camera position and press 'r' to retexture the point cloud.
@@ -28,8 +42,34 @@ class StableScanCLI:
             webui_api: The url of the webui api.
             width: The width of the window.
             height: The height of the window.
+            cache: Cache the loaded point cloud to speed up later launches.
+            voxel_size: Merge the points within voxels of this size in meters,
+                e.g. the duplicates of overlapping scans.
+            views: The number of views around the point cloud.
+            batch_size: The number of views generated together, from the colors
+                before the group. Larger groups are faster but less consistent.
+            trace: Write a Chrome trace of the pipeline stages to this file.
+            trace_memory: Record the peak memory of the traced stages too, slows down
+                the traced run.
+            timeout: Seconds to wait for a generation of the webui api.
+            retries: Retries of requests the webui api didn't answer, e.g. while it
+                starts.
         """
-        pass
+        StableScan(
+            *filenames,
+            webui_api=webui_api,
+            width=width,
+            height=height,
+            cache=cache,
+            voxel_size=voxel_size,
+            trace=trace,
+            trace_memory=trace_memory,
+            timeout=timeout,
+            retries=retries,
+            prompt=prompt,
+            orbit_views=views,
+            batch_size=batch_size,
+        )
 
     def control(
         self,
@@ -37,19 +77,46 @@ class StableScanCLI:
         webui_api: str = "http://127.0.0.1:7860",
         width: int = WINDOW_WIDTH,
         height: int = WINDOW_HEIGHT,
+        cache: bool = True,
+        voxel_size: float = None,
+        trace: str = None,
+        trace_memory: bool = False,
+        timeout: float = 600.0,
+        retries: int = 3,
     ):
         """Run the stablescan viewer with the given files.
         Navigate to desired camera position and press 'r' to retexture the point cloud.
         It will only retexture the points that are visible in the current view.
         Previous generations will be used as a basis for the retexture.
+        Press 'u' to undo the last retexture.
 
         Args:
             *filenames: The filenames to load.
             webui_api: The url of the webui api.
             width: The width of the window.
             height: The height of the window.
+            cache: Cache the loaded point cloud to speed up later launches.
+            voxel_size: Merge the points within voxels of this size in meters,
+                e.g. the duplicates of overlapping scans.
+            trace: Write a Chrome trace of the pipeline stages to this file.
+            trace_memory: Record the peak memory of the traced stages too, slows down
+                the traced run.
+            timeout: Seconds to wait for a generation of the webui api.
+            retries: Retries of requests the webui api didn't answer, e.g. while it
+                starts.
         """
-        StableScan(*filenames, webui_api=webui_api, width=width, height=height)
+        StableScan(
+            *filenames,
+            webui_api=webui_api,
+            width=width,
+            height=height,
+            cache=cache,
+            voxel_size=voxel_size,
+            trace=trace,
+            trace_memory=trace_memory,
+            timeout=timeout,
+            retries=retries,
+        )
 
     def debug(
         self,
@@ -57,6 +124,12 @@ class StableScanCLI:
         webui_api: str = "http://127.0.0.1:7860",
         width: int = WINDOW_WIDTH,
         height: int = WINDOW_HEIGHT,
+        cache: bool = True,
+        voxel_size: float = None,
+        trace: str = None,
+        trace_memory: bool = False,
+        timeout: float = 600.0,
+        retries: int = 3,
     ):
         """Run the stablescan viewer with the given files.
         Extending the capabilities of the control mode.
@@ -74,10 +147,85 @@ class StableScanCLI:
             webui_api: The url of the webui api.
             width: The width of the window.
             height: The height of the window.
+            cache: Cache the loaded point cloud to speed up later launches.
+            voxel_size: Merge the points within voxels of this size in meters,
+                e.g. the duplicates of overlapping scans.
+            trace: Write a Chrome trace of the pipeline stages to this file.
+            trace_memory: Record the peak memory of the traced stages too, slows down
+                the traced run.
+            timeout: Seconds to wait for a generation of the webui api.
+            retries: Retries of requests the webui api didn't answer, e.g. while it
+                starts.
         """
         StableScan(
-            *filenames, webui_api=webui_api, width=width, height=height, debug=True
+            *filenames,
+            webui_api=webui_api,
+            width=width,
+            height=height,
+            cache=cache,
+            voxel_size=voxel_size,
+            trace=trace,
+            trace_memory=trace_memory,
+            timeout=timeout,
+            retries=retries,
+            debug=True,
+        )
+
+    def batch(
+        self,
+        prompt: str,
+        poses: str,
+        *filenames: str,
+        webui_api: str = "http://127.0.0.1:7860",
+        width: int = WINDOW_WIDTH,
+        height: int = WINDOW_HEIGHT,
+        cache: bool = True,
+        voxel_size: float = None,
+        output: str = "retexture",
+        backend: str = None,
+        batch_size: int = 1,
+        trace: str = None,
+        trace_memory: bool = False,
+        timeout: float = 600.0,
+        retries: int = 3,
+    ):
+        """Retexture the point cloud from the camera poses of a file, without a window.
+        Runs on machines without a display, several batches can run in parallel.
+
+        Args:
+            prompt: The prompt to retexture the point cloud
+            poses: A .json or .npy file of camera poses, see camera_poses.load_poses.
+            *filenames: The filenames to load.
+            webui_api: The url of the webui api.
+            width: The width of the captured views.
+            height: The height of the captured views.
+            cache: Cache the loaded point cloud to speed up later launches.
+            voxel_size: Merge the points within voxels of this size in meters,
+                e.g. the duplicates of overlapping scans.
+            output: The session directory the result is saved to, load it with 'l' in
+                the viewer.
+            backend: The backend of the OpenGL context, "egl" to render without a display.
+            batch_size: The number of views generated together, from the colors
+                before the group. Larger groups are faster but less consistent.
+            trace: Write a Chrome trace of the pipeline stages to this file.
+            trace_memory: Record the peak memory of the traced stages too, slows down
+                the traced run.
+            timeout: Seconds to wait for a generation of the webui api.
+            retries: Retries of requests the webui api didn't answer, e.g. while it
+                starts.
+        """
+        if trace:
+            tracing.enable(memory=trace_memory)
+        sd_pcd = SDPointCloud(read_pcd(*filenames, cache=cache, voxel_size=voxel_size))
+        ctx = create_context(backend)
+        configure_client(webui_api, read_timeout=timeout, retries=retries)
+        retexture_batch(
+            sd_pcd, ctx, poses, prompt, webui_api, width, height, batch_size
         )
+        sd_pcd.save(output)
+        ctx.release()
+        if trace:
+            tracing.export(trace)
 
 
 class StableScan:
@@ -91,40 +239,81 @@ class StableScan:
         webui_api: str,
         width: int,
         height: int,
+        cache: bool = True,
+        voxel_size: float = None,
+        prompt: str = None,
+        orbit_views: int = None,
+        batch_size: int = 1,
+        trace: str = None,
+        trace_memory: bool = False,
+        timeout: float = 600.0,
+        retries: int = 3,
         debug: bool = False,
     ):
-        self.pcd = SDPointCloud(read_pcd(*filenames), debug=debug)
-        self.default_prompt = None
+        if trace:
+            tracing.enable(memory=trace_memory)
+        self.pcd = SDPointCloud(
+            read_pcd(*filenames, cache=cache, voxel_size=voxel_size), debug=debug
+        )
+        self.default_prompt = prompt
+
+        configure_client(webui_api, read_timeout=timeout, retries=retries)
+        self.generation_queue = GenerationQueue(webui_api, debug=debug)
 
         def retexture_callback(screen_capture: ScreenCapture):
-            screen_capture.color_image.show()
-            screen_capture.depth_image.show()
-
-            response = input("Would you like to proceed? (Y/N): ").upper()
-            if response != "Y":
-                print("Cancelled")
-                return
-
-            prompt = self.default_prompt
-            if prompt is None:
-                prompt = input("Enter prompt: ")
-
-            print(f"Generating {prompt}...")
-
-            img = generate(
-                webui_api,
-                SDParams(
-                    prompt,
-                    init_image=screen_capture.color_image,
-                    width=screen_capture.width,
-                    height=screen_capture.height,
-                    mask=self.pcd.mask_retextured(screen_capture.ids),
-                    controlnet={"depth": screen_capture.depth_image},
-                ),
-            )
+            # the mask reflects the points retextured when the view was captured,
+            # views finishing in between keep their colors as retexture never overwrites
+            mask = self.pcd.mask_retextured(screen_capture.ids)
+            params = None
 
-            img.show()
-            self.pcd.retexture(img, screen_capture.ids)
+            def prepare():
+                nonlocal params
+                screen_capture.color_image.show()
+                screen_capture.depth_image.show()
+
+                response = self.generation_queue.ask(
+                    "Would you like to proceed? (Y/N): "
+                )
+                if response is None or response.upper() != "Y":
+                    print("Cancelled")
+                    return None
+
+                prompt = self.default_prompt
+                if prompt is None:
+                    prompt = self.generation_queue.ask("Enter prompt: ")
+                    if prompt is None:
+                        return None
+
+                print(f"Generating {prompt}...")
+                params = capture_params(screen_capture, prompt, mask)
+                return params
+
+            def apply(img):
+                if debug:
+                    img.show()
+                self.pcd.retexture(
+                    img,
+                    screen_capture.ids,
+                    screen_capture.projected,
+                    pose=screen_capture.mvp,
+                    prompt=params.prompt,
+                )
+                screen_capture.release()
+
+            self.generation_queue.submit(prepare, apply, screen_capture.release)
+
+        orbit = None
+        if orbit_views:
+            orbit = OrbitScheduler(
+                self.pcd,
+                self.generation_queue,
+                prompt,
+                WINDOW_WIDTH,
+                WINDOW_HEIGHT,
+                views=orbit_views,
+                batch_size=batch_size,
+                debug=debug,
+            )
 
         self.vc = ViewControl(
             self.pcd,
@@ -133,9 +322,13 @@ class StableScan:
             retexture_callback,
             retexture_width=WINDOW_WIDTH,
             retexture_height=WINDOW_HEIGHT,
+            generation_queue=self.generation_queue,
+            orbit=orbit,
             debug=debug,
         )
         self.vc.run()
+        if trace:
+            tracing.export(trace)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import moderngl
+
+_enabled = False
+_trace_memory = False
+_start_ns = 0
+_events = []
+_thread_names = {}
+_local = threading.local()
+_main_thread = threading.main_thread()
+# timer queries of every context for reuse, moderngl 5.8 can't release them
+_free_queries = {}
+
+
+def enable(memory: bool = False) -> None:
+    """Start recording spans, previous events are discarded.
+    With memory, the peak of the Python and numpy allocations of every span of the
+    main thread is recorded too, which slows down allocations while tracing.
+    tracemalloc only has a process-wide peak, so the peak includes the allocations
+    of other threads during the span, and spans of other threads record none."""
+    global _enabled, _trace_memory, _start_ns
+    _events.clear()
+    _thread_names.clear()
+    _start_ns = time.perf_counter_ns()
+    _trace_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name: str, category: str, args: dict) -> None:
+        self.name = name
+        self.category = category
+        self.args = args
+        self.peak = 0
+        # the process-wide peak is only reset by the main thread
+        self.memory = _trace_memory and threading.current_thread() is _main_thread
+
+    def set(self, **args) -> None:
+        """Add arguments shown with the span in the trace viewer."""
+        self.args.update(args)
+
+    def __enter__(self):
+        stack = _stack()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak since the last reset belongs to the enclosing span
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = self.peak = current
+        stack.append(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end_ns = time.perf_counter_ns()
+        stack = _stack()
+        stack.pop()
+        if self.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            self.args["process_peak_memory_mb"] = (
+                self.peak - self.start_memory
+            ) / 2**20
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        _record(self.name, self.category, self.start_ns, end_ns, self.args)
+        return False
+
+
+class _GPUSpan(_Span):
+    def __init__(self, ctx: moderngl.Context, name: str, args: dict) -> None:
+        super().__init__(name, "gpu", args)
+        queries = _free_queries.setdefault(ctx, [])
+        self.queries = queries
+        self.query = queries.pop() if queries else ctx.query(time=True)
+
+    def __enter__(self):
+        super().__enter__()
+        self.query.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.query.__exit__(*exc)
+        cpu_start_ns = self.start_ns
+        super().__exit__(*exc)
+        # waits for the GPU, the readbacks following the draws wait anyway
+        elapsed_ns = self.query.elapsed
+        self.queries.append(self.query)
+        _record(
+            self.name,
+            "gpu",
+            cpu_start_ns,
+            cpu_start_ns + elapsed_ns,
+            {},
+            thread="GPU",
+        )
+        return False
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _record(name, category, start_ns, end_ns, args, thread=None) -> None:
+    if thread is None:
+        thread = threading.current_thread().name
+    tid = _thread_names.setdefault(thread, len(_thread_names))
+    _events.append(
+        {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start_ns - _start_ns) / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args,
+        }
+    )
+
+
+def span(name: str, category: str = "cpu", **args):
+    """Context manager timing the enclosed block, a no-op while tracing is disabled."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+
+def gpu_span(ctx: moderngl.Context, name: str, **args):
+    """Like span, additionally timing the enclosed GL commands with a timer query.
+    The GPU time is shown on a separate GPU track."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _GPUSpan(ctx, name, args)
+
+
+def traced(function=None, *, name: str = None, category: str = "cpu"):
+    """Decorator wrapping every call of the function in a span,
+    named module.qualname unless a name is given."""
+    if function is None:
+        return functools.partial(traced, name=name, category=category)
+    span_name = name or f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        with _Span(span_name, category, {}):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def events() -> list[dict]:
+    """Return the recorded events in the Chrome trace event format."""
+    pid = os.getpid()
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": n}}
+        for n, tid in _thread_names.items()
+    ]
+    return metadata + list(_events)
+
+
+def export(filename: str) -> None:
+    """Write the recorded events as Chrome trace JSON, open it in chrome://tracing
+    or https://ui.perfetto.dev."""
+    Path(filename).write_text(json.dumps({"traceEvents": events()}))
+    print(f"Trace with {len(_events)} spans written to {filename}")
+
+
+def test_tracing():
+    @traced(name="stage")
+    def stage(size):
+        with span("allocate", size=size):
+            return bytearray(size)
+
+    def stage_in_thread():
+        with span("worker"):
+            bytearray(2**20)
+
+    enable(memory=True)
+    with span("pipeline") as pipeline:
+        stage(2**20)
+        pipeline.set(views=1)
+        # spans of other threads don't reset the peak of the main thread's spans
+        worker = threading.Thread(target=stage_in_thread)
+        worker.start()
+        worker.join()
+    disable()
+    recorded = {event["name"]: event for event in events() if event["ph"] == "X"}
+    assert set(recorded) == {"pipeline", "stage", "allocate", "worker"}
+    assert recorded["pipeline"]["args"]["views"] == 1
+    assert recorded["allocate"]["args"]["size"] == 2**20
+    assert "process_peak_memory_mb" not in recorded.pop("worker")["args"]
+    for name in recorded:
+        assert recorded[name]["args"]["process_peak_memory_mb"] >= 1.0
+    assert recorded["pipeline"]["dur"] >= recorded["allocate"]["dur"]
+
+    events_before = len(events())
+    calls = 100_000
+    start = time.perf_counter()
+    for _ in range(calls):
+        with span("disabled"):
+            pass
+    overhead = (time.perf_counter() - start) / calls
+    stage(1)
+    assert len(events()) == events_before
+    print(f"Tracing records nested spans, {overhead * 1e9:.0f} ns per disabled span.")
+
+
+if __name__ == "__main__":
+    test_tracing()
@@ -1,24 +1,14 @@
 from collections import defaultdict
-from dataclasses import dataclass
 
 import moderngl
 import numpy as np
 from moderngl_window.timers.clock import Timer
-from PIL import Image
 
-import depth_utils
-import point_cloud_rendering_utils as pcru
+from gen_control import GenerationQueue
+from orbit_control import OrbitScheduler
 from point_viewer import PointCloudViewer
 from pointcloud import SDPointCloud
-
-
-@dataclass
-class ScreenCapture:
-    color_image: Image
-    depth_image: Image
-    width: int
-    height: int
-    ids: np.ndarray
+from screen_capture import ScreenCapture, create_screen_capture
 
 
 class ViewControl:
@@ -32,9 +22,13 @@ class ViewControl:
         retexture_callback: callable,
         retexture_width: int,
         retexture_height: int,
+        generation_queue: GenerationQueue = None,
+        orbit: OrbitScheduler = None,
         debug: bool = False,
     ):
         self.sd_pcd = sd_pcd
+        self.generation_queue = generation_queue
+        self.orbit = orbit
         self.debug = debug
 
         callbacks = defaultdict(lambda: lambda: print("Action not defined"))
@@ -44,8 +38,14 @@ class ViewControl:
                 ctx, mvp, retexture_width, retexture_height, debug
             )
         )
+        if orbit is not None:
+            # retexture the orbit starting at the current camera position
+            callbacks["retexture"] = lambda ctx, mvp: orbit.start(
+                self.viewer.camera.position, self.viewer.camera.projection.matrix
+            )
         callbacks["load"] = lambda: self.sd_pcd.load("retexture")
         callbacks["save"] = lambda: self.sd_pcd.save("retexture")
+        callbacks["undo"] = lambda: self.sd_pcd.undo()
 
         if debug:
             callbacks["reset"] = lambda: self.sd_pcd.reset()
@@ -71,7 +71,14 @@ class ViewControl:
         timer = Timer()
         timer.start()
         while not self.viewer.wnd.is_closing:
+            if self.generation_queue is not None:
+                # retexture on the render thread, it owns the GL context
+                self.generation_queue.poll()
+            if self.orbit is not None:
+                self.orbit.step(self.viewer.ctx)
             self.viewer.step(timer)
+        if self.generation_queue is not None:
+            self.generation_queue.shutdown()
         self.viewer.wnd.destroy()
 
     def create_screen_capture(
@@ -82,14 +89,4 @@ class ViewControl:
         height: int,
         debug: bool = False,
     ) -> ScreenCapture:
-        params = (ctx, self.sd_pcd.pcd, mvp, width, height)
-        screen_image = pcru.render_pointcloud(*params, debug=debug)
-        depth_image = pcru.create_depth_image(*params, filter=False, debug=debug)
-        depth_image_filtered = pcru.create_depth_image(
-            *params, filter=True, debug=debug
-        )
-        raw_ids = pcru.obtain_point_ids(*params, debug=debug)
-        ids, _ = depth_utils.filter_ids(
-            raw_ids, depth_image_filtered, depth_image, debug=debug
-        )
-        return ScreenCapture(screen_image, depth_image_filtered, width, height, ids)
+        return create_screen_capture(ctx, self.sd_pcd.pcd, mvp, width, height, debug)
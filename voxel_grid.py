@@ -0,0 +1,135 @@
+import numpy as np
+
+import tracing
+
+# points merged at once, bounds the temporary memory of voxel_downsample
+SLAB_SIZE = 2**22
+
+
+def _cells(points: np.ndarray, origin: np.ndarray, cell_size: np.ndarray):
+    return np.floor((points - origin) / cell_size).astype(np.int64)
+
+
+@tracing.traced
+def voxel_downsample(
+    points: np.ndarray,
+    colors: np.ndarray,
+    cell_size,
+    slab_size: int = SLAB_SIZE,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge the points of every cell of a voxel grid into a single point at their
+    centroid with their mean color, e.g. duplicates of overlapping scans.
+
+    cell_size is a scalar or per axis, in the units of points. Return the float32
+    points and colors ordered by cell, and the uint32 index of the merged point of
+    every input point. The points are sorted in slabs of cells along x holding
+    about slab_size points each, so only the slab is copied at a time, and the
+    result doesn't depend on slab_size."""
+    n_points = len(points)
+    cell_size = np.broadcast_to(np.asarray(cell_size, dtype=np.float64), (3,))
+    origin = points.min(axis=0).astype(np.float64)
+    dims = _cells(points.max(axis=0), origin, cell_size) + 1
+    if np.prod(dims.astype(np.float64)) >= 2**63:
+        raise ValueError(f"Cell size {cell_size} is too small for the point extent.")
+
+    def chunks():
+        for start in range(0, n_points, slab_size):
+            yield start, _cells(points[start : start + slab_size], origin, cell_size)
+
+    # assign whole columns of cells along x to slabs
+    x_counts = np.zeros(dims[0], dtype=np.int64)
+    for _, cells in chunks():
+        x_counts += np.bincount(cells[:, 0], minlength=dims[0])
+    column_slab = (np.cumsum(x_counts) - x_counts) // slab_size
+    slab_counts = np.bincount(column_slab, weights=x_counts).astype(np.int64)
+    slab_starts = np.cumsum(slab_counts) - slab_counts
+
+    # stable counting sort of the point ids by slab
+    order = np.empty(n_points, dtype=np.uint32)
+    offsets = slab_starts.copy()
+    for start, cells in chunks():
+        slabs = column_slab[cells[:, 0]]
+        chunk_order = np.argsort(slabs, kind="stable")
+        slabs = slabs[chunk_order]
+        counts = np.bincount(slabs, minlength=len(slab_counts))
+        rank = np.arange(len(slabs)) - (np.cumsum(counts) - counts)[slabs]
+        order[offsets[slabs] + rank] = start + chunk_order
+        offsets += counts
+
+    merged_points, merged_colors = [], []
+    index = np.empty(n_points, dtype=np.uint32)
+    n_merged = 0
+    with tracing.span("merge slabs", slabs=len(slab_counts)):
+        for start, count in zip(slab_starts, slab_counts):
+            ids = order[start : start + count]
+            if len(ids) == 0:
+                continue
+            slab_points = points[ids]
+            cells = _cells(slab_points, origin, cell_size)
+            keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+            _, inverse, counts = np.unique(
+                keys, return_inverse=True, return_counts=True
+            )
+            merged_points.append(_mean(inverse, counts, slab_points))
+            merged_colors.append(_mean(inverse, counts, colors[ids]))
+            index[ids] = n_merged + inverse
+            n_merged += len(counts)
+    if not merged_points:
+        return points[:0].astype(np.float32), colors[:0].astype(np.float32), index
+    return np.concatenate(merged_points), np.concatenate(merged_colors), index
+
+
+def _mean(inverse: np.ndarray, counts: np.ndarray, values: np.ndarray) -> np.ndarray:
+    means = np.empty((len(counts), values.shape[1]), dtype=np.float32)
+    for axis in range(values.shape[1]):
+        # summed in the order of the input points, deterministic
+        means[:, axis] = np.bincount(inverse, weights=values[:, axis]) / counts
+    return means
+
+
+def test_voxel_downsample():
+    rng = np.random.default_rng(0)
+    points = rng.random((10_000, 3)).astype(np.float32) * 10
+    colors = rng.random((10_000, 3)).astype(np.float32)
+    # the second scan overlaps the first one
+    points = np.concatenate((points, points[:5000]))
+    colors = np.concatenate((colors, colors[:5000]))
+
+    merged_points, merged_colors, index = voxel_downsample(points, colors, 1.0)
+    assert len(merged_points) <= 1000 and index.max() == len(merged_points) - 1
+    cells = np.floor(points - points.min(axis=0)).astype(int)
+    for cell in range(0, len(merged_points), 97):
+        members = index == cell
+        assert len(np.unique(cells[members], axis=0)) == 1
+        assert np.allclose(merged_points[cell], points[members].mean(axis=0))
+        assert np.allclose(merged_colors[cell], colors[members].mean(axis=0))
+
+    # tiny cells only merge the duplicates
+    _, _, index = voxel_downsample(points, colors, 0.01)
+    assert np.array_equal(index[:5000], index[10_000:])
+    assert len(np.unique(index)) == 10_000
+
+    for slab_size in (1, 777, 2**20):
+        result = voxel_downsample(points, colors, 1.0, slab_size=slab_size)
+        assert np.array_equal(result[0], merged_points)
+        assert np.array_equal(result[1], merged_colors)
+    print("voxel_downsample merges the points of every cell deterministically.")
+
+
+def benchmark_voxel_downsample(n_points: int = 10_000_000, cell_size: float = 0.01):
+    import time
+
+    rng = np.random.default_rng(0)
+    points = rng.random((n_points, 3), dtype=np.float32)
+    colors = rng.random((n_points, 3), dtype=np.float32)
+    start = time.perf_counter()
+    merged_points, _, _ = voxel_downsample(points, colors, cell_size)
+    print(
+        f"{n_points:,} points merged into {len(merged_points):,} "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    test_voxel_downsample()
+    benchmark_voxel_downsample()
@@ -1,31 +1,66 @@
 import base64
 import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from typing import Optional
 
 import numpy as np
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import tracing
 from gen_control import SDParams
 
 
-def mask_to_base64(params: SDParams):
+@dataclass(frozen=True)
+class ImageCodec:
+    """Lossless encoding of the images sent to the WebUI."""
+
+    format: str = "PNG"  # "PNG" or "WEBP"
+    # zlib level 0-9 for PNG, method 0-6 for WebP, lower is faster
+    compress_level: int = 1
+
+    def save_options(self) -> dict:
+        if self.format == "WEBP":
+            return {"lossless": True, "method": self.compress_level, "quality": 0}
+        return {"compress_level": self.compress_level}
+
+
+DEFAULT_CODEC = ImageCodec()
+# init image, mask and depth map are encoded concurrently, PIL releases the GIL
+_encode_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="encode")
+
+
+def mask_image(params: SDParams, debug: bool = False) -> np.ndarray:
     # inpainting mask is black for pixels to keep, white for pixels to remove
     assert params.mask is not None
-    assert params.mask.shape == (params.width, params.height)
-    mask = Image.fromarray(params.mask.astype(np.uint8) * 255, mode="L")
+    assert params.mask.shape == (params.height, params.width)
+    mask = params.mask.astype(np.uint8) * 255
+
+    mask[0, 0] = 0
+
+    if debug:
+        Image.fromarray(mask, mode="L").show()
+    return mask
 
-    mask.putpixel((0, 0), 0)
 
-    mask.show()
-    return encode_image_to_base64(mask)
+def mask_to_base64(params: SDParams, codec: ImageCodec = DEFAULT_CODEC, debug=False):
+    return encode_image_to_base64(mask_image(params, debug), codec)
 
 
-def encode_image_to_base64(image):
+@tracing.traced
+def encode_image_to_base64(image, codec: ImageCodec = DEFAULT_CODEC):
+    """Encode a PIL image or an uint8 (h, w) or (h, w, c) array."""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
     image_byte_array = io.BytesIO()
-    image.save(image_byte_array, format="PNG")
-    image_byte_array = image_byte_array.getvalue()
-    encoded_image = base64.b64encode(image_byte_array).decode("utf-8")
-    return encoded_image
+    image.save(image_byte_array, format=codec.format, **codec.save_options())
+    return base64.b64encode(image_byte_array.getbuffer()).decode("ascii")
 
 
 def txt2img_payload(params: SDParams):
@@ -41,27 +76,35 @@ def txt2img_payload(params: SDParams):
     return payload
 
 
-def img2img_payload(params: SDParams):
+def img2img_payload(params: SDParams, codec: ImageCodec = DEFAULT_CODEC):
     assert params.init_image is not None
     _txt2img_payload = txt2img_payload(params)
-    encoded_image = encode_image_to_base64(params.init_image)
+    encoded_image = encode_image_to_base64(params.init_image, codec)
     payload = {
         **_txt2img_payload,
         "init_images": [encoded_image],
     }
 
     if params.mask is not None:
-        payload["mask"] = mask_to_base64(params)
+        payload["mask"] = mask_to_base64(params, codec)
 
     return payload
 
 
-def inject_controlnet_payload(payload: str, params: SDParams):
+def inject_controlnet_payload(
+    payload: str, params: SDParams, codec: ImageCodec = DEFAULT_CODEC
+):
     assert params.controlnet is not None
 
-    args = []
+    encoded_depth = None
     if params.controlnet["depth"] is not None:
-        encoded_depth = encode_image_to_base64(params.controlnet["depth"])
+        encoded_depth = encode_image_to_base64(params.controlnet["depth"], codec)
+    return _add_controlnet(payload, encoded_depth)
+
+
+def _add_controlnet(payload: dict, encoded_depth: Optional[str]):
+    args = []
+    if encoded_depth is not None:
         args.append(
             {
                 "input_image": encoded_depth,
@@ -75,25 +118,329 @@ def inject_controlnet_payload(payload: str, params: SDParams):
     return payload
 
 
+@tracing.traced
+def build_payload(
+    params: SDParams, codec: ImageCodec = DEFAULT_CODEC, debug: bool = False
+) -> dict:
+    """Build the txt2img or img2img payload of the parameters, including ControlNet.
+    Init image, mask and depth map are encoded in parallel."""
+    images = {}
+    if params.init_image is not None:
+        images["init"] = params.init_image
+        if params.mask is not None:
+            images["mask"] = mask_image(params, debug)
+    if params.controlnet is not None and params.controlnet["depth"] is not None:
+        images["depth"] = params.controlnet["depth"]
+    encoded = dict(
+        zip(
+            images,
+            _encode_executor.map(
+                encode_image_to_base64, images.values(), [codec] * len(images)
+            ),
+        )
+    )
+
+    payload = txt2img_payload(params)
+    if "init" in encoded:
+        payload["init_images"] = [encoded["init"]]
+    if "mask" in encoded:
+        payload["mask"] = encoded["mask"]
+    if params.controlnet is not None:
+        _add_controlnet(payload, encoded.get("depth"))
+    return payload
+
+
+@tracing.traced
+def build_batch_payload(
+    params_list: list[SDParams], codec: ImageCodec = DEFAULT_CODEC
+) -> dict:
+    """Build a single payload generating one image per parameters, which must only
+    differ in their init image. The WebUI applies one mask and one ControlNet image
+    to the whole batch, those of the first parameters."""
+    params = params_list[0]
+    payload = build_payload(replace(params, init_image=None), codec)
+    payload["batch_size"] = len(params_list)
+    if params.init_image is not None:
+        payload["init_images"] = list(
+            _encode_executor.map(
+                encode_image_to_base64,
+                [p.init_image for p in params_list],
+                [codec] * len(params_list),
+            )
+        )
+        if params.mask is not None:
+            payload["mask"] = encode_image_to_base64(mask_image(params), codec)
+    return payload
+
+
 def _decode_response(response):
-    r = response.json()
-    result = r["images"][0]
-    image = Image.open(io.BytesIO(base64.b64decode(result.split(",", 1)[0])))
-    return image
+    return _decode_images(response, 1)[0]
+
+
+@tracing.traced
+def _decode_images(response, count: int) -> list[Image.Image]:
+    # ControlNet appends its detected maps after the generated images
+    results = response.json()["images"][:count]
+    images = []
+    for result in results:
+        image = Image.open(io.BytesIO(base64.b64decode(result.split(",", 1)[0])))
+        # decode on the requesting thread instead of lazily on first access
+        image.load()
+        images.append(image)
+    return images
+
+
+@dataclass
+class RequestStats:
+    endpoint: str
+    latency: float  # seconds from sending the request to the received response body
+    payload_bytes: int
+    response_bytes: int
+    # seconds until the response headers arrived, the server's processing and the
+    # upload, not the transfer of the response body
+    headers_time: float
+
+
+class WebUIClient:
+    """Client of the WebUI API, keeps connections alive in a pool,
+    retries failed requests with backoff and records the stats of each request."""
+
+    def __init__(
+        self,
+        url: str,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 600.0,
+        retries: int = 3,
+        backoff_factor: float = 1.0,
+        pool_size: int = 8,
+    ):
+        self.url = url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            # generations have no side effects, POST is safe to retry
+            allowed_methods=None,
+            raise_on_status=False,
+            # a timed out generation may still run on the server, retrying it would
+            # block for another read_timeout
+            read=0,
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats = []
+        self._stats_lock = threading.Lock()
+
+    def post(self, endpoint: str, payload: dict) -> requests.Response:
+        with tracing.span("serialize payload"):
+            data = json.dumps(payload).encode("utf-8")
+        start = time.perf_counter()
+        with tracing.span(f"POST {endpoint}", "network") as span:
+            response = self.session.post(
+                url=f"{self.url}{endpoint}",
+                data=data,
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            stats = RequestStats(
+                endpoint,
+                time.perf_counter() - start,
+                len(data),
+                len(response.content),
+                response.elapsed.total_seconds(),
+            )
+            # the headers time is mostly the diffusion, the rest is transfer
+            span.set(**asdict(stats))
+        with self._stats_lock:
+            self.stats.append(stats)
+        return response
+
+    def txt2img(self, payload: dict) -> Image:
+        return _decode_response(self.post("/sdapi/v1/txt2img", payload))
+
+    def img2img(self, payload: dict) -> Image:
+        return _decode_response(self.post("/sdapi/v1/img2img", payload))
+
+    def batch(self, payload: dict) -> list[Image.Image]:
+        """Run a payload of build_batch_payload, return the images in order."""
+        endpoint = (
+            "/sdapi/v1/img2img" if "init_images" in payload else "/sdapi/v1/txt2img"
+        )
+        return _decode_images(self.post(endpoint, payload), payload["batch_size"])
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(url: str) -> WebUIClient:
+    """Return the shared client of the url."""
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = WebUIClient(url)
+        return _clients[url]
+
+
+def configure_client(url: str, **options) -> WebUIClient:
+    """Replace the shared client of the url by one with the options of WebUIClient,
+    e.g. the timeouts and retries."""
+    with _clients_lock:
+        old_client = _clients.get(url)
+        _clients[url] = WebUIClient(url, **options)
+    if old_client is not None:
+        old_client.close()
+    return _clients[url]
 
 
 def generate_txt2img(url, payload):
-    response = requests.post(url=f"{url}/sdapi/v1/txt2img", json=payload)
-    return _decode_response(response)
+    return get_client(url).txt2img(payload)
 
 
 def generate_img2img(url, payload):
-    response = requests.post(url=f"{url}/sdapi/v1/img2img", json=payload)
-    return _decode_response(response)
+    return get_client(url).img2img(payload)
+
+
+def generate_batch(url, payload):
+    return get_client(url).batch(payload)
+
+
+def test_client_retries():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    image = encode_image_to_base64(Image.new("RGB", (8, 8), (255, 0, 0)))
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            requests_seen.append(self.path)
+            if self.path == "/sdapi/v1/txt2img":
+                # a generation outlasting the read timeout
+                time.sleep(0.5)
+            elif len(requests_seen) == 1:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps({"images": [image]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    # the generate functions use the configured shared client
+    client = configure_client(url, read_timeout=0.2, backoff_factor=0.0)
+    assert get_client(url) is client
+    # the unavailable server is retried
+    assert generate_img2img(url, {}).getpixel((0, 0)) == (255, 0, 0)
+    assert len(requests_seen) == 2 and len(client.stats) == 1
+    stats = client.stats[0]
+    assert 0 < stats.headers_time <= stats.latency and stats.response_bytes > 0
+    # timed out generations are not retried
+    try:
+        generate_txt2img(url, {})
+        raise AssertionError("The read timeout was not raised.")
+    except requests.exceptions.RequestException:
+        pass
+    assert requests_seen.count("/sdapi/v1/txt2img") == 1
+    _clients.pop(url).close()
+    server.shutdown()
+    server.server_close()
+    print("The client retries unavailable servers but not timed out generations.")
+
+
+def test_build_payload():
+    rng = np.random.default_rng(0)
+    # smooth gradients with noise resemble the captures better than pure noise
+    gradient = np.linspace(0, 200, 512, dtype=np.float32)
+    color = (gradient[:, None, None] + rng.integers(0, 40, (512, 512, 3))).astype(
+        np.uint8
+    )
+    # unprojected pixels of the captures are black
+    color[rng.random((512, 512)) < 0.4] = 0
+    depth = np.broadcast_to(gradient.astype(np.uint8)[None, :], (512, 512)).copy()
+    params = SDParams(
+        prompt="test",
+        init_image=Image.fromarray(color),
+        mask=rng.random((512, 512)) < 0.5,
+        controlnet={"depth": depth},
+    )
+
+    def decode(encoded, mode="RGB"):
+        # WebP has no grayscale mode, single channel images come back as RGB
+        image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+        return np.asarray(image.convert(mode))
+
+    start = time.perf_counter()
+    reference = img2img_payload(params, ImageCodec(compress_level=6))
+    inject_controlnet_payload(reference, params, ImageCodec(compress_level=6))
+    reference_time = time.perf_counter() - start
+    reference_size = len(json.dumps(reference))
+    for codec in (ImageCodec(), ImageCodec("WEBP", 0)):
+        start = time.perf_counter()
+        payload = build_payload(params, codec)
+        build_time = time.perf_counter() - start
+        assert np.array_equal(decode(payload["init_images"][0]), color)
+        assert np.array_equal(
+            decode(payload["mask"], "L"), decode(reference["mask"], "L")
+        )
+        depth_arg = payload["alwayson_scripts"]["controlnet"]["args"][0]
+        assert np.array_equal(decode(depth_arg["input_image"], "L"), depth)
+        print(
+            f"{codec.format} level {codec.compress_level}: "
+            f"{build_time * 1000:.1f} ms, {len(json.dumps(payload)) / 1e6:.2f} MB "
+            f"(default PNG {reference_time * 1000:.1f} ms, "
+            f"{reference_size / 1e6:.2f} MB)"
+        )
+
+
+def test_build_batch_payload():
+    from gen_control import _batch_key
+
+    rng = np.random.default_rng(0)
+    mask = rng.random((64, 64)) < 0.5
+    depth = rng.integers(0, 255, (64, 64), dtype=np.uint8)
+    params_list = [
+        SDParams(
+            "test",
+            init_image=rng.integers(0, 255, (64, 64, 3), dtype=np.uint8),
+            mask=mask.copy(),
+            width=64,
+            height=64,
+            controlnet={"depth": depth.copy()},
+        )
+        for _ in range(3)
+    ]
+    # views sharing mask and depth map share a batch, other views don't
+    assert len({_batch_key(params) for params in params_list}) == 1
+    other = replace(params_list[0], mask=~mask)
+    assert _batch_key(other) != _batch_key(params_list[0])
+    payload = build_batch_payload(params_list)
+    single = build_payload(params_list[0])
+    assert payload["batch_size"] == 3 and len(payload["init_images"]) == 3
+    assert payload["mask"] == single["mask"]
+    assert payload["alwayson_scripts"] == single["alwayson_scripts"]
+    print("Batches share the mask and the ControlNet image of their views.")
 
 
 # Uuse python3 webui_api.py > payload.json && sed -i '' "s/'/\"/g" payload.json for debugging
 if __name__ == "__main__":
+    test_client_retries()
+    test_build_payload()
+    test_build_batch_payload()
     params = SDParams(
         prompt="cat with ocean blue eyes",
         init_image=Image.open("cat.png"),
@@ -103,8 +450,7 @@ if __name__ == "__main__":
         cfg_scale=7,
         controlnet={"depth": Image.open("depth.png")},
     )
-    payload = img2img_payload(params)
-    inject_controlnet_payload(payload, params)
+    payload = build_payload(params)
     payload["mask"] = encode_image_to_base64(Image.open("mask.png"))
     print(payload)
     generate_img2img("", payload).show()